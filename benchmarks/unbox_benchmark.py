@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+Benchmark dunbox on a synthetic workspace, without touching the network
+
+A dependency graph of local bare repositories is generated with a
+``.devbox.conf`` in each. Setup scripts are served by a local HTTP server, and
+pip installs (with ``--venvs``) come from a directory of stub wheels. The
+unbox is then timed end to end and per step, from its ``--trace`` events, for
+three kinds of runs:
+
+cold
+    A new workspace and an empty devbox cache
+warm
+    A new workspace, with the cache left by the cold run
+noop
+    The warm workspace unboxed again
+
+The results are written as JSON so they can be compared across versions::
+
+    python benchmarks/unbox_benchmark.py --repos 30 --depth 3 -o before.json
+
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import argparse
+
+try:
+    # pylint: disable=F0401
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+except ImportError:
+    # pylint: disable=F0401
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from devbox import unbox  # pylint: disable=C0413
+
+RUNS = ('cold', 'warm', 'noop')
+SETUP_SCRIPT = '#!/bin/sh\ntrue\n'
+
+
+class StaticHandler(SimpleHTTPRequestHandler):
+
+    """ Serve files from ``server.root`` instead of the current directory """
+
+    def translate_path(self, path):
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        return os.path.join(self.server.root, *[part for part in
+                                                path.split('/') if
+                                                part not in ('', '.', '..')])
+
+    def log_message(self, *_):
+        pass
+
+
+def git(cwd, *args):
+    """ Run a git command quietly """
+    subprocess.check_call(['git', '-C', cwd] + list(args),
+                          stdout=open(os.devnull, 'w'))
+
+
+def make_wheel(directory, name):
+    """ Write a minimal pure python wheel into the stub package index """
+    dist_info = '%s-1.0.dist-info' % name
+    files = {
+        '%s.py' % name: 'VALUE = %r\n' % name,
+        dist_info + '/METADATA': 'Metadata-Version: 2.1\nName: %s\n'
+                                 'Version: 1.0\n' % name,
+        dist_info + '/WHEEL': 'Wheel-Version: 1.0\nGenerator: devbox\n'
+                              'Root-Is-Purelib: true\nTag: py2.py3-none-any\n',
+    }
+    record = ''.join('%s,,\n' % path for path in sorted(files))
+    files[dist_info + '/RECORD'] = record + dist_info + '/RECORD,,\n'
+    filename = os.path.join(directory, '%s-1.0-py2.py3-none-any.whl' % name)
+    with zipfile.ZipFile(filename, 'w') as archive:
+        for path, contents in sorted(files.items()):
+            archive.writestr(path, contents)
+
+
+def make_remote(root, name, conf, files, submodules=()):
+    """ Create a bare repository and return its url """
+    source = os.path.join(root, 'src', name)
+    os.makedirs(source)
+    files = dict(files)
+    files[unbox.CONF_FILE] = json.dumps(conf, indent=2)
+    for filename, contents in files.items():
+        with open(os.path.join(source, filename), 'w') as outfile:
+            outfile.write(contents)
+    git(source, 'init', '-q')
+    for path, url in submodules:
+        git(source, 'submodule', 'add', '-q', url, path)
+    git(source, 'add', '.')
+    git(source, 'commit', '-qm', 'init')
+    bare = os.path.join(root, 'remotes', name + '.git')
+    git(source, 'clone', '-q', '--bare', source, bare)
+    return 'file://' + bare
+
+
+def make_workspace(root, args, server_url):
+    """
+    Generate the bare repositories of a synthetic workspace
+
+    The top repo is on level 0, and the other repos are spread over the
+    following levels. Each repo depends on ``fanout`` repos of the next level,
+    and every repo is reachable from the top.
+
+    Returns
+    -------
+    url : str
+        The url of the top repository
+
+    """
+    index = os.path.join(root, 'index')
+    os.makedirs(index)
+    levels = [['repo0']]
+    names = ['repo%d' % i for i in range(1, args.repos)]
+    per_level = max(1, -(-len(names) // max(args.depth, 1)))
+    while names:
+        levels.append(names[:per_level])
+        names = names[per_level:]
+
+    urls = {}
+    for depth in range(len(levels) - 1, -1, -1):
+        next_level = levels[depth + 1] if depth + 1 < len(levels) else []
+        for i, name in enumerate(levels[depth]):
+            deps = [next_level[(i * args.fanout + j) % len(next_level)] for
+                    j in range(min(args.fanout, len(next_level)))]
+            # Every repo of the next level is needed by at least one repo
+            deps.extend(dep for j, dep in enumerate(next_level) if
+                        j % len(levels[depth]) == i)
+            submodules = []
+            for j in range(args.submodules):
+                sub = '%s_sub%d' % (name, j)
+                submodules.append((sub, make_remote(
+                    root, sub, {}, {'README': sub * 100})))
+            post_setup = [server_url + '/setup.sh']
+            conf = {'dependencies': sorted(set(urls[dep] for dep in deps))}
+            if args.venvs:
+                make_wheel(index, name)
+                conf['env'] = {'path': 'venv', 'args': []}
+                post_setup.append('pip install -q --no-index --find-links '
+                                  '%s %s' % (index, name))
+            conf['post_setup'] = post_setup
+            files = dict(('file%d.txt' % j, '%s %d\n' % (name, j) * 50) for
+                         j in range(args.files))
+            urls[name] = make_remote(root, name, conf, files, submodules)
+    return urls['repo0']
+
+
+def phase_times(events):
+    """ Sum the trace events of a run by step name """
+    phases = {}
+    for event in events:
+        phase = phases.setdefault(event['name'], {'count': 0, 'total': 0.0,
+                                                  'max': 0.0})
+        duration = event['dur'] / 1e6
+        phase['count'] += 1
+        phase['total'] += duration
+        phase['max'] = max(phase['max'], duration)
+    for phase in phases.values():
+        phase['total'] = round(phase['total'], 4)
+        phase['max'] = round(phase['max'], 4)
+    return phases
+
+
+def time_unbox(url, workspace, cache, args):
+    """ Unbox into a workspace and return the timings """
+    trace = os.path.join(os.path.dirname(workspace), 'trace.json')
+    os.environ['DEVBOX_CACHE'] = cache
+    if not os.path.isdir(workspace):
+        os.makedirs(workspace)
+    with unbox.pushd(workspace):
+        start = time.time()
+        unbox.unbox(url, jobs=args.jobs, mirror=args.mirror, trace=trace)
+        total = time.time() - start
+    with open(trace, 'r') as infile:
+        events = json.load(infile)['traceEvents']
+    return {'total': round(total, 4), 'phases': phase_times(events)}
+
+
+def run_benchmark(args):
+    """ Run the benchmark and return the results """
+    root = tempfile.mkdtemp()
+    scripts = os.path.join(root, 'scripts')
+    os.makedirs(scripts)
+    with open(os.path.join(scripts, 'setup.sh'), 'w') as outfile:
+        outfile.write(SETUP_SCRIPT)
+    server = HTTPServer(('127.0.0.1', 0), StaticHandler)
+    server.root = scripts
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    environ = dict(os.environ)
+    os.environ.update({
+        'GIT_AUTHOR_NAME': 'devbox',
+        'GIT_AUTHOR_EMAIL': 'devbox@localhost',
+        'GIT_COMMITTER_NAME': 'devbox',
+        'GIT_COMMITTER_EMAIL': 'devbox@localhost',
+        # Allow submodules with local urls
+        'GIT_CONFIG_COUNT': '1',
+        'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+        'GIT_CONFIG_VALUE_0': 'always',
+    })
+    try:
+        url = make_workspace(root, args,
+                             'http://127.0.0.1:%d' % server.server_port)
+        runs = dict((name, []) for name in args.runs)
+        for i in range(args.repeat):
+            cache = os.path.join(root, 'cache%d' % i)
+            workspace = os.path.join(root, 'workspace%d' % i)
+            results = {'cold': time_unbox(url, workspace + '-cold', cache,
+                                          args)}
+            if 'warm' in args.runs or 'noop' in args.runs:
+                results['warm'] = time_unbox(url, workspace + '-warm', cache,
+                                             args)
+            if 'noop' in args.runs:
+                results['noop'] = time_unbox(url, workspace + '-warm', cache,
+                                             args)
+            for name in args.runs:
+                runs[name].append(results[name])
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        server.shutdown()
+        shutil.rmtree(root)
+
+    return {
+        'devbox': __import__('devbox').__version__,
+        'git': unbox.check_output(['git', '--version']),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'repos': args.repos,
+            'depth': args.depth,
+            'fanout': args.fanout,
+            'submodules': args.submodules,
+            'files': args.files,
+            'venvs': args.venvs,
+            'mirror': args.mirror,
+            'jobs': args.jobs,
+        },
+        'runs': runs,
+    }
+
+
+def main(args=None):
+    """ Benchmark dunbox on a synthetic workspace """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--repos', type=int, default=10,
+                        help="Number of repositories (default %(default)s)")
+    parser.add_argument('--depth', type=int, default=2,
+                        help="Number of dependency levels below the top "
+                        "repository (default %(default)s)")
+    parser.add_argument('--fanout', type=int, default=2,
+                        help="Dependencies of each repository "
+                        "(default %(default)s)")
+    parser.add_argument('--submodules', type=int, default=0,
+                        help="Submodules of each repository "
+                        "(default %(default)s)")
+    parser.add_argument('--files', type=int, default=20,
+                        help="Files in each repository (default %(default)s)")
+    parser.add_argument('--venvs', action='store_true',
+                        help="Give each repository a virtualenv that pip "
+                        "installs a stub package into (needs virtualenv)")
+    parser.add_argument('--mirror', action='store_true',
+                        help="Unbox with --mirror")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Jobs for unbox (default number of cpus)")
+    parser.add_argument('--runs', default=','.join(RUNS),
+                        help="Comma-separated runs to report, from %s "
+                        "(default all)" % ', '.join(RUNS))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Number of times to repeat the runs "
+                        "(default %(default)s)")
+    parser.add_argument('-o', '--output',
+                        help="File to write the JSON results to (default "
+                        "stdout)")
+    args = parser.parse_args(args)
+    args.runs = [name for name in args.runs.split(',') if name]
+    for name in args.runs:
+        if name not in RUNS:
+            parser.error("Unknown run %r" % name)
+    if args.venvs and unbox.find_executable('virtualenv') is None:
+        parser.error("--venvs needs the virtualenv command")
+
+    # Keep the output of git and the setup commands out of the results
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        results = run_benchmark(args)
+    finally:
+        os.dup2(stdout, 1)
+        os.close(stdout)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""
+Run autopep8 on the staged and unstaged python files in a git repository
+
+This file was carefully constructed to have no dependencies on other files in
+the ``devbox`` package. This allows it to be embedded directly in a project
+instead of requiring devbox to be installed.
+
+"""
+import hashlib
+import json
+import locale
+import os
+import subprocess
+import sys
+from multiprocessing import Pool
+
+import argparse
+
+try:
+    from ConfigParser import RawConfigParser  # pylint: disable=F0401
+except ImportError:
+    from configparser import RawConfigParser  # pylint: disable=F0401
+
+
+CONF_FILE = '.pep8.ini'
+CONF_OPTIONS = ('ignore', 'select', 'max-line-length')
+CACHE_FILE = os.path.join('devbox', 'autoformat.json')
+
+
+def check_output(cmd, stdin=None):
+    """ Run a command, optionally feeding it stdin, and return its stdout """
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    output = proc.communicate(stdin)[0]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+    return output
+
+
+def load_options(conf_file=CONF_FILE):
+    """
+    Read the autopep8 arguments out of the pep8 conf file
+
+    Returns
+    -------
+    args : list
+        List of command line flags for autopep8 (e.g. ['--ignore=E501'])
+
+    """
+    parser = RawConfigParser()
+    parser.read(conf_file)
+    args = []
+    if parser.has_section('pep8'):
+        for option in CONF_OPTIONS:
+            if parser.has_option('pep8', option):
+                args.append('--%s=%s' % (option, parser.get('pep8', option)))
+    return args
+
+
+def blob_sha(data):
+    """ Calculate the git blob sha of some file contents """
+    sha = hashlib.sha1(('blob %d\0' % len(data)).encode('utf-8'))
+    sha.update(data)
+    return sha.hexdigest()
+
+
+class FormatCache(object):
+
+    """
+    Set of blob shas that are known to be formatted with the current options
+
+    Parameters
+    ----------
+    filename : str
+        Path to the json file the cache is stored in
+    args : list
+        The autopep8 arguments. If they change, the cache is discarded.
+
+    """
+
+    def __init__(self, filename, args):
+        self.filename = filename
+        self.key = ' '.join(args)
+        self.blobs = set()
+        self.changed = False
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as infile:
+                    data = json.load(infile)
+            except ValueError:
+                data = {}
+            if data.get('key') == self.key:
+                self.blobs = set(data.get('blobs', []))
+
+    def __contains__(self, sha):
+        return sha in self.blobs
+
+    def add(self, sha):
+        """ Mark a blob as formatted """
+        if sha not in self.blobs:
+            self.blobs.add(sha)
+            self.changed = True
+
+    def save(self):
+        """ Write the cache to disk if it has changed """
+        if not self.changed:
+            return
+        directory = os.path.dirname(self.filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.filename, 'w') as outfile:
+            json.dump({'key': self.key, 'blobs': sorted(self.blobs)},
+                      outfile)
+        self.changed = False
+
+
+_OPTIONS = {}
+
+
+def format_source(job):
+    """
+    Run autopep8 on some python source
+
+    Parameters
+    ----------
+    job : tuple
+        (data, args) where data is the file contents as bytes and args is the
+        list of autopep8 arguments
+
+    Returns
+    -------
+    data : bytes
+        The formatted file contents
+
+    """
+    import autopep8  # pylint: disable=F0401
+    data, args = job
+    key = tuple(args)
+    # Parse the options once per worker process
+    if key not in _OPTIONS:
+        try:
+            _OPTIONS[key] = autopep8.parse_args(list(args) + [''],
+                                                apply_config=False)
+        except TypeError:
+            _OPTIONS[key] = autopep8.parse_args(list(args) + [''])
+    try:
+        source = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data
+    return autopep8.fix_code(source, options=_OPTIONS[key]).encode('utf-8')
+
+
+def map_jobs(func, jobs, processes=None):
+    """ Map a function over jobs on a process pool when there is enough work """
+    if len(jobs) <= 1 or processes == 1:
+        return [func(job) for job in jobs]
+    pool = Pool(processes)
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def modified_files():
+    """
+    Find the python files that have staged or unstaged changes
+
+    Returns
+    -------
+    staged : list
+    unstaged : list
+
+    """
+    output = check_output(['git', 'status', '--porcelain', '-z',
+                           '--untracked-files=no'])
+    encoding = locale.getdefaultlocale()[1] or 'utf-8'
+    entries = output.decode(encoding).split('\0')
+    staged, unstaged = [], []
+    i = 0
+    while i < len(entries):
+        entry = entries[i]
+        i += 1
+        if not entry:
+            continue
+        index, worktree, path = entry[0], entry[1], entry[3:]
+        # Renames and copies are followed by the original path
+        if index in 'RC':
+            i += 1
+        if not path.endswith('.py'):
+            continue
+        if index in 'ACMRT':
+            staged.append(path)
+        if worktree in 'ACMRT':
+            unstaged.append(path)
+    return staged, unstaged
+
+
+def format_files(filenames, args, cache, processes=None):
+    """
+    Format files in the working tree in place
+
+    Returns
+    -------
+    changed : list
+        The files that were modified
+
+    """
+    jobs = []
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            continue
+        with open(filename, 'rb') as infile:
+            data = infile.read()
+        if blob_sha(data) not in cache:
+            jobs.append((filename, data))
+
+    results = map_jobs(format_source, [(data, args) for _, data in jobs],
+                       processes)
+    changed = []
+    for (filename, data), formatted in zip(jobs, results):
+        if formatted != data:
+            with open(filename, 'wb') as outfile:
+                outfile.write(formatted)
+            changed.append(filename)
+        cache.add(blob_sha(formatted))
+    return changed
+
+
+def format_index(filenames, args, cache, processes=None):
+    """
+    Format the staged versions of files and write them back to the index
+
+    Returns
+    -------
+    changed : list
+        The files whose staged contents were modified
+
+    """
+    if not filenames:
+        return []
+    output = check_output(['git', 'ls-files', '-s', '-z', '--'] + filenames)
+    entries = []
+    for line in output.split(b'\0'):
+        if not line:
+            continue
+        info, path = line.split(b'\t', 1)
+        mode, sha, stage = info.split()
+        # Skip unmerged entries
+        if stage != b'0':
+            continue
+        sha = sha.decode('ascii')
+        if sha not in cache:
+            entries.append((mode.decode('ascii'), sha, path))
+    if not entries:
+        return []
+
+    # Read all the blobs with a single process
+    batch = check_output(['git', 'cat-file', '--batch'],
+                         ''.join(sha + '\n' for _, sha, _ in
+                                 entries).encode('ascii'))
+    blobs = []
+    offset = 0
+    for _ in entries:
+        header_end = batch.index(b'\n', offset)
+        size = int(batch[offset:header_end].split()[2])
+        start = header_end + 1
+        blobs.append(batch[start:start + size])
+        offset = start + size + 1
+
+    results = map_jobs(format_source, [(data, args) for data in blobs],
+                       processes)
+    index_info = []
+    changed = []
+    for (mode, sha, path), data, formatted in zip(entries, blobs, results):
+        if formatted != data:
+            sha = check_output(['git', 'hash-object', '-w', '--stdin',
+                                '--no-filters'],
+                               formatted).strip().decode('ascii')
+            index_info.append(mode.encode('ascii') + b' ' +
+                              sha.encode('ascii') + b'\t' + path + b'\0')
+            changed.append(path.decode('utf-8'))
+        cache.add(sha)
+    if index_info:
+        check_output(['git', 'update-index', '-z', '--index-info'],
+                     b''.join(index_info))
+    return changed
+
+
+def main(args=None):
+    """ Run autopep8 on the staged and unstaged python files """
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('all', nargs='?', choices=['all'],
+                        help="Format all python files in the repository, "
+                        "regardless of staging")
+    parser.add_argument('--index', action='store_true',
+                        help="Format the staged contents of files and write "
+                        "them back to the git index. The working tree is not "
+                        "modified.")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of processes to use (default number of "
+                        "cpus)")
+    parser.add_argument('-c', '--conf', default=CONF_FILE,
+                        help="Conf file to read pep8 options from (default "
+                        "%(default)s)")
+    args = parser.parse_args(args)
+
+    autopep8_args = load_options(args.conf)
+    git_dir = check_output(['git', 'rev-parse', '--git-dir']).strip()
+    cache = FormatCache(os.path.join(git_dir.decode('utf-8'), CACHE_FILE),
+                        autopep8_args)
+    try:
+        if args.all:
+            output = check_output(['git', 'ls-files', '-z', '--', '*.py'])
+            filenames = [name.decode('utf-8') for name in
+                         output.split(b'\0') if name]
+            staged, unstaged = filenames, filenames
+        else:
+            staged, unstaged = modified_files()
+        if args.index:
+            changed = format_index(staged, autopep8_args, cache, args.jobs)
+        else:
+            filenames = sorted(set(staged) | set(unstaged))
+            changed = format_files(filenames, autopep8_args, cache,
+                                   args.jobs)
+    finally:
+        cache.save()
+    for filename in changed:
+        print("Formatted %s" % filename)
+
+
+if __name__ == '__main__':
+    main()
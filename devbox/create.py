@@ -177,6 +177,12 @@ class SimpleTemplate(BoxTemplate):
                               hookfile=hookfile)
         self.chmod_exec(self.hook_dir, 'pre-commit')
 
+        prepush_file = os.path.join(self.hook_dir, 'pre-push')
+        if not os.path.exists(os.path.join(self.repo, prepush_file)):
+            self.render_write('pre-push.jinja2', prepush_file,
+                              hookfile=hookfile)
+        self.chmod_exec(self.hook_dir, 'pre-push')
+
         if not os.path.exists(os.path.join(self.repo, '.gitignore')):
             self.render_write('gitignore.jinja2', '.gitignore')
 
@@ -185,7 +191,7 @@ class PythonTemplate(SimpleTemplate):
 
     """ Template for python projects """
     description = """
-    Basic python template. Runs pylint, pep8, and unit tests on commit.
+    Basic python template. Runs pylint, devbox-lint, and unit tests on commit.
     Creates a virtualenv & autoenv file.
     """
 
@@ -208,10 +214,10 @@ class PythonTemplate(SimpleTemplate):
         self.conf['post_setup'].append('pip install -r requirements_dev.txt')
         self.conf['post_setup'].append('pip install -e .')
 
-        # Run pylint and pep8 on modified python files
+        # Run pylint and the built-in style checks on modified python files
         self.conf['hooks_modified'].extend([
             ['*.py', ['pylint', '--rcfile=.pylintrc']],
-            ['*.py', ['pep8', '--config=.pep8.ini']],
+            ['*.py', ['devbox-lint', '--config=.pep8.ini']],
         ])
         self.conf['hooks_all'].append('python setup.py test')
         self.copy_static('pylintrc', '.pylintrc')
@@ -241,8 +247,8 @@ class PythonTemplate(SimpleTemplate):
                           package=package)
 
         # Add a script that runs autopep8 on repo
-        self.copy_static('run_autopep8.sh')
-        self.chmod_exec('run_autopep8.sh')
+        self.write_source('devbox.autoformat', 'run_autopep8.py')
+        self.chmod_exec('run_autopep8.py')
 
         # Include the version_helper.py script
         version_helper = '%s_version.py' % package
@@ -261,6 +267,9 @@ class PythonTemplate(SimpleTemplate):
 
         self.render_write('pre-commit.jinja2', self.hook_dir,
                           'pre-commit', venv=venv)
+        self.render_write('pre-push.jinja2', self.hook_dir, 'pre-push',
+                          venv=venv, hookfile=os.path.join(self.hook_dir,
+                                                           'hook.py'))
         super(PythonTemplate, self).run()
 
 
@@ -7,19 +7,106 @@ the ``devbox`` package. This allows it to be embedded directly in a project
 instead of requiring devbox to be installed.
 
 """
+import argparse
+import array
+import ast
+import binascii
+import bisect
+import collections
 import contextlib
 import fnmatch
+import functools
+import hashlib
+import heapq
+import io
 import json
 import locale
+import math
+import mmap
 import os
 import shlex
 import shutil
+import sqlite3
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import tokenize
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+    import asyncio  # pylint: disable=F0401
+except ImportError:
+    asyncio = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from ConfigParser import RawConfigParser  # pylint: disable=F0401
+except ImportError:
+    from configparser import RawConfigParser  # pylint: disable=F0401
 
 
 CONF_FILE = '.devbox.conf'
+ZERO_SHA = '0' * 40
+DEFERRED_NICENESS = 10
+DEFERRED_LOG = os.path.join('devbox', 'deferred.log')
+QUEUE_DIR = os.path.join('devbox', 'queue')
+LINT_COMMAND = 'devbox-lint'
+LINT_CHECKS = []
+# Tool config files that checks commonly read from the repository root
+CONFIG_FILES = ('setup.cfg', 'tox.ini', 'pyproject.toml', '.pylintrc',
+                'pylintrc', '.pep8.ini', '.pep8', '.pycodestyle', '.flake8',
+                '.jshintrc', '.eslintrc')
+HISTORY_FILE = os.path.join('devbox', 'hook.sqlite')
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    duration REAL,
+    conf_hash TEXT,
+    files INTEGER,
+    retcode INTEGER
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER,
+    name TEXT,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS checks (
+    run_id INTEGER,
+    command TEXT,
+    filename TEXT,
+    duration REAL,
+    retcode INTEGER,
+    cached INTEGER
+);
+CREATE INDEX IF NOT EXISTS checks_run ON checks (run_id);
+CREATE TABLE IF NOT EXISTS deferred (
+    tree TEXT,
+    command TEXT,
+    status TEXT,
+    retcode INTEGER,
+    output TEXT,
+    updated REAL,
+    duration REAL,
+    PRIMARY KEY (tree, command)
+);
+CREATE TABLE IF NOT EXISTS test_durations (
+    command TEXT,
+    module TEXT,
+    duration REAL,
+    PRIMARY KEY (command, module)
+);
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    retcode INTEGER,
+    output TEXT
+);
+"""
 
 
 @contextlib.contextmanager
@@ -33,7 +120,7 @@ def pushd(directory):
         os.chdir(prevdir)
 
 
-def check_output(cmd):
+def check_output(cmd, cwd=None):
     """
     Nice wrapper around subprocess.check_output
 
@@ -42,11 +129,11 @@ def check_output(cmd):
     """
     encoding = locale.getdefaultlocale()[1] or 'utf-8'
     if hasattr(subprocess, 'check_output'):
-        output = subprocess.check_output(cmd)
+        output = subprocess.check_output(cmd, cwd=cwd)
     else:
         # Python 2.6 doesn't have check_output
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
+                                stderr=subprocess.STDOUT, cwd=cwd)
         output = proc.communicate()[0]
         if proc.returncode != 0:
             raise subprocess.CalledProcessError(proc.returncode, cmd,
@@ -54,48 +141,1635 @@ def check_output(cmd):
     return output.decode(encoding)
 
 
-def run_checks(hooks_all, hooks_modified, modified, path):
-    """ Run selected checks on the current git index """
+def split_command(command):
+    """ Convert a command from the conf file into a list of arguments """
+    if isinstance(command, dict):
+        command = command['command']
+    if not isinstance(command, list):
+        # Hacking around a unicode bug with shlex in old versions of python
+        if sys.version_info[0] < 3:
+            command = command.encode('utf-8')
+        command = shlex.split(command)
+    return command
+
+
+def git_dir(directory=None):
+    """
+    Get the absolute path to the .git directory of a repo
+
+    The repo is the current directory by default. It is never changed, so
+    this is safe to call from threads.
+
+    """
+    output = check_output(['git', 'rev-parse', '--git-dir'],
+                          cwd=directory).strip()
+    return os.path.join(os.path.abspath(directory or os.curdir), output)
+
+
+class History(object):
+
+    """
+    Timing data for a single hook run
+
+    Phases and checks are collected in memory while the hook runs and written
+    to a sqlite database under the ``.git`` directory by :meth:`~save`, so
+    recording them costs a single transaction per run.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the sqlite database
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.started = time.time()
+        self.conf_hash = None
+        self.files = 0
+        self.phases = []
+        self.checks = []
+
+    @classmethod
+    def for_repo(cls):
+        """ Create a History that writes to the current repo's database """
+        return cls(os.path.join(git_dir(), HISTORY_FILE))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the body of a 'with' block as a named phase of the run """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+
+    def set_conf(self, conf):
+        """ Remember which version of the conf file this run used """
+        data = json.dumps(conf, sort_keys=True).encode('utf-8')
+        self.conf_hash = hashlib.sha1(data).hexdigest()
+
+    def record_check(self, command, filename, duration, retcode,
+                     cached=False):
+        """ Record the result of running one check """
+        self.checks.append((' '.join(command), filename, duration, retcode,
+                            int(cached)))
+
+    def save(self, retcode):
+        """ Write the collected timings to the database """
+        conn = connect_history(self.filename)
+        try:
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO runs (started, duration, conf_hash, files, "
+                    "retcode) VALUES (?, ?, ?, ?, ?)",
+                    (self.started, time.time() - self.started,
+                     self.conf_hash, self.files, retcode))
+                run_id = cursor.lastrowid
+                conn.executemany(
+                    "INSERT INTO phases (run_id, name, duration) "
+                    "VALUES (?, ?, ?)",
+                    [(run_id,) + phase for phase in self.phases])
+                conn.executemany(
+                    "INSERT INTO checks (run_id, command, filename, duration, "
+                    "retcode, cached) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(run_id,) + check for check in self.checks])
+        finally:
+            conn.close()
+
+
+def ensure_dir(directory):
+    """ Create a directory and its parents if they don't exist """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have made it first
+            if not os.path.isdir(directory):
+                raise
+
+
+def connect_history(filename):
+    """ Open the hook history database, creating it if necessary """
+    ensure_dir(os.path.dirname(filename))
+    conn = sqlite3.connect(filename, timeout=30)
+    conn.executescript(HISTORY_SCHEMA)
+    return conn
+
+
+def save_history(history, retcode):
+    """ Save the history of a run without ever failing the hook """
+    if history is None:
+        return
+    try:
+        history.save(retcode)
+    except (sqlite3.Error, OSError, IOError) as e:
+        sys.stderr.write("Could not record hook timings: %s\n" % e)
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+def load_stats(filename, days=30, top=10):
+    """
+    Aggregate the hook history database
+
+    Parameters
+    ----------
+    filename : str
+        Path to the sqlite database
+    days : int, optional
+        Only look at runs from this many days ago (default 30)
+    top : int, optional
+        Number of slowest files to report (default 10)
+
+    Returns
+    -------
+    stats : dict
+        Dictionary with the keys 'checks', 'trend', 'files', and 'runs'. See
+        :meth:`~format_stats` for what they contain.
+
+    """
+    conn = connect_history(filename)
+    since = time.time() - days * 24 * 60 * 60
+    try:
+        durations = {}
+        cached = {}
+        for command, duration, hit in conn.execute(
+                "SELECT command, checks.duration, cached FROM checks "
+                "JOIN runs ON runs.id = checks.run_id WHERE started >= ?",
+                (since,)):
+            durations.setdefault(command, []).append(duration)
+            cached[command] = cached.get(command, 0) + hit
+        checks = []
+        for command, values in sorted(durations.items()):
+            checks.append({
+                'command': command,
+                'count': len(values),
+                'sum': sum(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'cache_hit_rate': float(cached[command]) / len(values),
+            })
+
+        runs = []
+        days_seen = {}
+        for started, duration, conf_hash, files in conn.execute(
+                "SELECT started, duration, conf_hash, files FROM runs "
+                "WHERE started >= ? ORDER BY started", (since,)):
+            runs.append(duration)
+            day = time.strftime('%Y-%m-%d', time.localtime(started))
+            entry = days_seen.get(day)
+            if entry is None:
+                entry = days_seen[day] = {
+                    'day': day,
+                    'durations': [],
+                    'files': 0,
+                    'confs': [],
+                }
+            entry['durations'].append(duration)
+            entry['files'] += files
+            if conf_hash and conf_hash not in entry['confs']:
+                entry['confs'].append(conf_hash)
+        trend = []
+        for day in sorted(days_seen):
+            entry = days_seen[day]
+            trend.append({
+                'day': day,
+                'count': len(entry['durations']),
+                'files': entry['files'],
+                'p50': percentile(entry['durations'], 50),
+                'p95': percentile(entry['durations'], 95),
+                'confs': entry['confs'],
+            })
+
+        files = []
+        for filename, total, count, failures in conn.execute(
+                "SELECT filename, SUM(checks.duration), COUNT(*), "
+                "SUM(checks.retcode != 0) FROM checks "
+                "JOIN runs ON runs.id = checks.run_id "
+                "WHERE started >= ? AND filename IS NOT NULL "
+                "GROUP BY filename ORDER BY SUM(checks.duration) DESC "
+                "LIMIT ?", (since, top)):
+            files.append({
+                'filename': filename,
+                'sum': total,
+                'count': count,
+                'failures': failures,
+            })
+    finally:
+        conn.close()
+    return {
+        'checks': checks,
+        'trend': trend,
+        'files': files,
+        'runs': {
+            'count': len(runs),
+            'sum': sum(runs),
+            'p50': percentile(runs, 50),
+            'p95': percentile(runs, 95),
+        },
+    }
+
+
+def format_stats(stats):
+    """ Render the output of :meth:`~load_stats` as a text report """
+    lines = ['Check latency', '=============']
+    for check in stats['checks']:
+        lines.append("%7.2fs p50 %7.2fs p95 %5d runs %4.0f%% cached  %s" %
+                     (check['p50'], check['p95'], check['count'],
+                      100 * check['cache_hit_rate'], check['command']))
+    lines.extend(['', 'Trend', '====='])
+    prev_conf = None
+    for day in stats['trend']:
+        line = ("%s %7.2fs p50 %7.2fs p95 %5d runs %6d files" %
+                (day['day'], day['p50'], day['p95'], day['count'],
+                 day['files']))
+        confs = [conf for conf in day['confs'] if conf != prev_conf]
+        if confs:
+            line += '  %s %s' % (CONF_FILE, ' '.join(conf[:7] for conf in
+                                                     confs))
+            prev_conf = day['confs'][-1]
+        lines.append(line)
+    lines.extend(['', 'Slowest files', '============='])
+    for entry in stats['files']:
+        lines.append("%8.2fs %5d checks %4d failed  %s" %
+                     (entry['sum'], entry['count'], entry['failures'],
+                      entry['filename']))
+    return '\n'.join(lines)
+
+
+def _metric_label(value):
+    """ Escape a string for use as an OpenMetrics label value """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def format_openmetrics(stats):
+    """ Render the output of :meth:`~load_stats` in OpenMetrics text format """
+    lines = []
+    name = 'devbox_hook_run_duration_seconds'
+    lines.append('# TYPE %s summary' % name)
+    lines.append('# UNIT %s seconds' % name)
+    lines.append('# HELP %s Total duration of a hook run.' % name)
+    runs = stats['runs']
+    for quantile in ('0.5', '0.95'):
+        key = 'p50' if quantile == '0.5' else 'p95'
+        lines.append('%s{quantile="%s"} %f' % (name, quantile, runs[key]))
+    lines.append('%s_sum %f' % (name, runs['sum']))
+    lines.append('%s_count %d' % (name, runs['count']))
+
+    name = 'devbox_hook_check_duration_seconds'
+    lines.append('# TYPE %s summary' % name)
+    lines.append('# UNIT %s seconds' % name)
+    lines.append('# HELP %s Duration of a single check.' % name)
+    for check in stats['checks']:
+        label = 'check="%s"' % _metric_label(check['command'])
+        for quantile in ('0.5', '0.95'):
+            key = 'p50' if quantile == '0.5' else 'p95'
+            lines.append('%s{%s,quantile="%s"} %f' %
+                         (name, label, quantile, check[key]))
+        lines.append('%s_sum{%s} %f' % (name, label, check['sum']))
+        lines.append('%s_count{%s} %d' % (name, label, check['count']))
+
+    name = 'devbox_hook_check_cache_hit_ratio'
+    lines.append('# TYPE %s gauge' % name)
+    lines.append('# HELP %s Fraction of check results served from cache.' %
+                 name)
+    for check in stats['checks']:
+        lines.append('%s{check="%s"} %f' %
+                     (name, _metric_label(check['command']),
+                      check['cache_hit_rate']))
+    lines.append('# EOF')
+    return '\n'.join(lines)
+
+
+CheckResult = collections.namedtuple('CheckResult', [
+    'command', 'filename', 'retcode', 'output', 'duration', 'cached',
+    'skipped', 'env'])
+CheckResult.__doc__ = """
+The outcome of running a single check
+
+Attributes
+----------
+command : list
+    The command that was run
+filename : str or None
+    The file that was passed to the command, or None for ``hooks_all``
+retcode : int
+    The exit code of the command
+output : str or None
+    The combined stdout and stderr of the command, or None if it was not
+    captured
+duration : float
+    Number of seconds the check took
+cached : bool
+    True if the result was taken from the cache instead of running the command
+skipped : str or None
+    If the check was not run, the reason why. One of 'generated', 'vendored',
+    'devbox-check', or 'max_size'.
+env : str or None
+    The virtualenv a ``hooks_all`` command ran in, if it has a list of
+    'envs'
+
+"""
+CHECK_ATTRIBUTES = ('devbox-check', 'linguist-generated', 'linguist-vendored')
+
+
+def load_attributes(filenames, cached=False, cwd=None, env=None):
+    """
+    Look up the git attributes that control check routing
+
+    All files are looked up with a single ``git check-attr`` call.
+
+    Parameters
+    ----------
+    filenames : list
+        Paths relative to the repository root
+    cached : bool, optional
+        If True, read the .gitattributes files from the index instead of the
+        working tree (default False)
+    cwd : str, optional
+        The repository to look in (default current directory)
+    env : dict, optional
+        Environment for the git command (e.g. to set GIT_INDEX_FILE)
+
+    Returns
+    -------
+    attributes : dict
+        Mapping of filename to a dict of attribute name to value. The value is
+        'set', 'unset', 'unspecified', or the string that was assigned.
+
+    """
+    attributes = dict((filename, {}) for filename in filenames)
+    if not filenames:
+        return attributes
+    cmd = ['git', 'check-attr', '--stdin', '-z']
+    if cached:
+        cmd.append('--cached')
+    proc = subprocess.Popen(cmd + list(CHECK_ATTRIBUTES),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            cwd=cwd, env=env)
+    data = ''.join(filename + '\0' for filename in filenames)
+    output = proc.communicate(data.encode('utf-8'))[0]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+    fields = output.decode('utf-8').split('\0')
+    for i in range(0, len(fields) - 2, 3):
+        filename, name, value = fields[i:i + 3]
+        attributes.setdefault(filename, {})[name] = value
+    return attributes
+
+
+def hook_name(command):
+    """ The name used to refer to a check in the devbox-check attribute """
+    if isinstance(command, dict) and 'name' in command:
+        return command['name']
+    return os.path.basename(split_command(command)[0])
+
+
+def skip_reason(command, attributes, size=None):
+    """
+    Decide if a hooks_modified command should skip a file
+
+    Parameters
+    ----------
+    command : str, list, or dict
+        The command from the conf file
+    attributes : dict
+        The attributes of the file from :meth:`~load_attributes`
+    size : int, optional
+        The size of the file in bytes
+
+    Returns
+    -------
+    reason : str or None
+        Why the file should be skipped, or None if the check should run
+
+    """
+    for kind in ('generated', 'vendored'):
+        if attributes.get('linguist-' + kind) in ('set', 'true'):
+            return kind
+    value = attributes.get('devbox-check', 'unspecified')
+    if value == 'unset':
+        return 'devbox-check'
+    elif value not in ('set', 'unspecified'):
+        name = hook_name(command)
+        names = [item.strip() for item in value.split(',') if item.strip()]
+        allowed = [item for item in names if not item.startswith('-')]
+        if '-' + name in names or (allowed and name not in allowed):
+            return 'devbox-check'
+    max_size = command.get('max_size') if isinstance(command, dict) else None
+    if max_size is not None and size is not None and size > max_size:
+        return 'max_size'
+    return None
+
+
+def blob_sha(filename):
+    """ Calculate the git blob sha of a file without calling git """
+    with open(filename, 'rb') as infile:
+        data = infile.read()
+    sha = hashlib.sha1(('blob %d\0' % len(data)).encode('utf-8'))
+    sha.update(data)
+    return sha.hexdigest()
+
+
+class UnsupportedIndex(ValueError):
+
+    """ The git index uses a format that :class:`~.GitIndex` can't read """
+
+
+class GitIndex(object):
+
+    """
+    Read-only view of the stage 0 entries of a git index file
+
+    Reads versions 2 to 4 of the DIRC format directly from a memory map of the
+    file, so looking up what is staged doesn't need a git process. Entries
+    are stored in flat arrays (the shas in one string, the stat fields in an
+    array) instead of an object per entry.
+
+    Raises :class:`~.UnsupportedIndex` for split and sparse indexes, and for
+    anything else it can't parse. Use :meth:`~load` to fall back to git.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the index file
+
+    """
+
+    ENTRY = struct.Struct('>10I20sH')
+    # ctime, ctime_ns, mtime, mtime_ns, dev, ino, mode, uid, gid, size
+    STAT_FIELDS = 10
+    UNSUPPORTED_EXTENSIONS = (b'link', b'sdir')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.paths = []
+        self.modes = array.array('I')
+        self.stats = array.array('L')
+        self._shas = b''
+        st = os.stat(filename)
+        self.mtime = st.st_mtime
+        if st.st_size < 32:
+            raise UnsupportedIndex("%s is too short" % filename)
+        with open(filename, 'rb') as infile:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse(data)
+        except (struct.error, IndexError, ValueError) as e:
+            if isinstance(e, UnsupportedIndex):
+                raise
+            raise UnsupportedIndex("Could not parse %s: %s" % (filename, e))
+        finally:
+            data.close()
+
+    def _parse(self, data):
+        """ Parse the header, entries and extensions of the index """
+        signature, version, count = struct.unpack('>4sII', data[:12])
+        if signature != b'DIRC' or version not in (2, 3, 4):
+            raise UnsupportedIndex("Unsupported index version %d" % version)
+        entry_size = self.ENTRY.size
+        offset = 12
+        path = b''
+        shas = []
+        for _ in range(count):
+            entry_start = offset
+            fields = self.ENTRY.unpack_from(data, offset)
+            flags = fields[-1]
+            offset += entry_size
+            if version >= 3 and flags & 0x4000:
+                # Extended flags for skip-worktree and intent-to-add
+                offset += 2
+            if version == 4:
+                # The path is compressed against the previous one
+                strip, offset = self._varint(data, offset)
+                end = data.find(b'\0', offset)
+                path = path[:len(path) - strip] + data[offset:end]
+                offset = end + 1
+            else:
+                end = data.find(b'\0', offset)
+                path = data[offset:end]
+                # Entries are NUL padded to a multiple of 8 bytes
+                offset = entry_start + ((end - entry_start) // 8 + 1) * 8
+            if end < 0:
+                raise UnsupportedIndex("Truncated index entry")
+            # Skip unmerged entries
+            if (flags >> 12) & 0x3:
+                continue
+            self.paths.append(path.decode('utf-8', 'surrogateescape')
+                              if sys.version_info[0] >= 3 else path)
+            self.modes.append(fields[6])
+            self.stats.extend(fields[:self.STAT_FIELDS])
+            shas.append(fields[10])
+        self._shas = b''.join(shas)
+
+        # Extensions run up to the 20 byte checksum at the end of the file
+        end = len(data) - 20
+        while offset < end:
+            name, size = struct.unpack('>4sI', data[offset:offset + 8])
+            if name in self.UNSUPPORTED_EXTENSIONS:
+                raise UnsupportedIndex("Index has the %r extension" % name)
+            offset += 8 + size
+        if offset != end:
+            raise UnsupportedIndex("Unexpected data at the end of the index")
+
+    @staticmethod
+    def _varint(data, offset):
+        """ Decode the offset-encoded varint used by index v4 """
+        byte = ord(data[offset:offset + 1])
+        offset += 1
+        value = byte & 0x7f
+        while byte & 0x80:
+            byte = ord(data[offset:offset + 1])
+            offset += 1
+            value = ((value + 1) << 7) | (byte & 0x7f)
+        return value, offset
+
+    @classmethod
+    def for_repo(cls, directory=None):
+        """ Open the index of a repository, honoring GIT_INDEX_FILE """
+        filename = os.environ.get('GIT_INDEX_FILE')
+        if filename is None:
+            filename = os.path.join(git_dir(directory), 'index')
+        elif directory is not None:
+            filename = os.path.join(directory, filename)
+        return cls(filename)
+
+    @classmethod
+    def load(cls, directory=None):
+        """ Open the index of a repository, or return None if unsupported """
+        try:
+            return cls.for_repo(directory)
+        except (UnsupportedIndex, OSError, IOError):
+            return None
+
+    def _find(self, path):
+        """ Get the position of a path in the entry arrays, or -1 """
+        i = bisect.bisect_left(self.paths, path)
+        if i < len(self.paths) and self.paths[i] == path:
+            return i
+        return -1
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __contains__(self, path):
+        return self._find(path) >= 0
+
+    def __getitem__(self, path):
+        i = self._find(path)
+        if i < 0:
+            raise KeyError(path)
+        return (self.modes[i], self.sha(i),
+                tuple(self.stats[i * self.STAT_FIELDS:
+                                 (i + 1) * self.STAT_FIELDS]))
+
+    def get(self, path, default=None):
+        """ Get the (mode, sha, stat) of a path """
+        try:
+            return self[path]
+        except KeyError:
+            return default
+
+    def sha(self, i):
+        """ Get the hex sha of the entry at a position """
+        return binascii.hexlify(self._shas[i * 20:(i + 1) * 20]).decode(
+            'ascii')
+
+    def gitlinks(self):
+        """ Generate (path, sha) for each submodule in the index """
+        for i, mode in enumerate(self.modes):
+            if mode == 0o160000:
+                yield self.paths[i], self.sha(i)
+
+    def stat_matches(self, path, filename):
+        """
+        Check if a file in the working tree is unchanged from the index
+
+        Like git, this compares stat data instead of contents. Files modified
+        in the same second the index was written are "racily clean" and never
+        match.
+
+        Parameters
+        ----------
+        path : str
+            The path of the entry in the index
+        filename : str
+            The file in the working tree
+
+        """
+        i = self._find(path)
+        if i < 0:
+            return False
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        _, _, mtime, mtime_ns, _, ino, _, _, _, size = self.stats[
+            i * self.STAT_FIELDS:(i + 1) * self.STAT_FIELDS]
+        if int(st.st_mtime) >= int(self.mtime):
+            return False
+        file_ns = getattr(st, 'st_mtime_ns', None)
+        if file_ns is not None and mtime_ns and file_ns % 10 ** 9 != mtime_ns:
+            return False
+        return (int(st.st_mtime) == mtime and
+                st.st_size & 0xffffffff == size and
+                st.st_ino & 0xffffffff == ino)
+
+
+class ResultCache(object):
+
+    """
+    Results of ``hooks_modified`` checks, keyed by the content they ran on
+
+    A ``hooks_modified`` command is treated as a function of the file it is
+    passed, so its result is reused whenever the same command runs on the same
+    blob with the same conf file and virtualenv. Results are held in memory
+    and persisted to the ``results`` table of the hook database.
+
+    Parameters
+    ----------
+    filename : str, optional
+        Path to the sqlite database. If None, results are only kept in memory.
+
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.salt = ''
+        self.results = {}
+        self._new = {}
+
+    @classmethod
+    def for_repo(cls, directory=None):
+        """ Create a cache that persists to a repo's hook database """
+        return cls(os.path.join(git_dir(directory), HISTORY_FILE))
+
+    def key(self, command, sha, salt=None):
+        """ Build the cache key for running a command on a blob """
+        if salt is None:
+            salt = self.salt
+        data = json.dumps([salt, command, sha]).encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    def load(self, keys):
+        """ Fetch a batch of keys from the database into memory """
+        missing = [key for key in keys if key not in self.results]
+        if self.filename is None or not missing:
+            return
+        conn = connect_history(self.filename)
+        try:
+            # Stay under sqlite's limit on the number of query parameters
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                query = ("SELECT key, retcode, output FROM results WHERE key "
+                         "IN (%s)" % ', '.join('?' * len(chunk)))
+                for key, retcode, output in conn.execute(query, chunk):
+                    self.results[key] = (retcode, output)
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """ Get the (retcode, output) stored for a key, or None """
+        return self.results.get(key)
+
+    def put(self, key, retcode, output):
+        """ Store the result of a check """
+        self.results[key] = self._new[key] = (retcode, output)
+
+    def save(self):
+        """ Write new results to the database """
+        if self.filename is None or not self._new:
+            return
+        conn = connect_history(self.filename)
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO results (key, retcode, output) "
+                    "VALUES (?, ?, ?)",
+                    [(key,) + value for key, value in self._new.items()])
+            self._new.clear()
+        finally:
+            conn.close()
+
+
+def run_command(command, path, filename=None, capture=True, cwd=None):
+    """
+    Run a single check command
+
+    Parameters
+    ----------
+    command : list
+        The command to run
+    path : str
+        The PATH to run the command with
+    filename : str, optional
+        If provided, this will be appended to the command
+    capture : bool, optional
+        If False, let the command write directly to stdout (default True)
+    cwd : str, optional
+        Directory to run the command in (default current directory)
+
+    Returns
+    -------
+    result : :class:`~.CheckResult`
+
+    """
+    if command[0] == LINT_COMMAND and filename is not None:
+        # The built-in checker doesn't need to be installed
+        return run_lint([(command, filename)], cwd, 1)[0]
+    args = command if filename is None else command + [filename]
+    kwargs = {'env': {'PATH': path}}
+    if cwd is not None:
+        kwargs['cwd'] = cwd
+    start = time.time()
+    if capture:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, **kwargs)
+        output = proc.communicate()[0]
+        encoding = locale.getdefaultlocale()[1] or 'utf-8'
+        output = output.decode(encoding, 'replace')
+        retcode = proc.returncode
+    else:
+        output = None
+        retcode = subprocess.call(args, **kwargs)
+    return CheckResult(command, filename, retcode, output,
+                       time.time() - start, False, None, None)
+
+
+def is_sharded(command):
+    """ Check if a hooks_all command should be split into parallel shards """
+    return isinstance(command, dict) and 'shards' in command
+
+
+def find_test_modules(test_dir='tests', pattern='test*.py', cwd=None):
+    """ Find the test modules in a directory, relative to ``cwd`` """
+    root = os.path.join(cwd, test_dir) if cwd is not None else test_dir
+    modules = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if fnmatch.fnmatch(filename, pattern):
+                fullpath = os.path.join(dirpath, filename)
+                if cwd is not None:
+                    fullpath = os.path.relpath(fullpath, cwd)
+                modules.append(fullpath)
+    return sorted(modules)
+
+
+def estimate_durations(modules, durations):
+    """
+    Estimate how long each test module will take
+
+    Modules with no recorded duration are assumed to take the average time.
+
+    """
+    known = [durations[module] for module in modules if module in durations]
+    default = sum(known) / len(known) if known else 1.0
+    return dict((module, durations.get(module, default)) for module in
+                modules)
+
+
+def balance_shards(estimates, count):
+    """
+    Split test modules into shards with roughly equal total duration
+
+    Modules are assigned longest first to the shard with the least work.
+
+    Parameters
+    ----------
+    estimates : dict
+        Mapping of module to its estimated duration
+    count : int
+        The number of shards
+
+    Returns
+    -------
+    shards : list
+        List of (estimated duration, list of modules)
+
+    """
+    count = max(1, min(count, len(estimates)))
+    heap = [(0.0, i, []) for i in range(count)]
+    for module in sorted(estimates, key=lambda m: (-estimates[m], m)):
+        total, i, shard = heapq.heappop(heap)
+        shard.append(module)
+        heapq.heappush(heap, (total + estimates[module], i, shard))
+    heap.sort(key=lambda item: item[1])
+    return [(total, sorted(shard)) for total, _, shard in heap]
+
+
+def load_test_durations(filename, command):
+    """ Load the recorded duration of each test module for a command """
+    if filename is None:
+        return {}
+    conn = connect_history(filename)
+    try:
+        return dict(conn.execute("SELECT module, duration FROM "
+                                 "test_durations WHERE command = ?",
+                                 (command,)).fetchall())
+    finally:
+        conn.close()
+
+
+def save_test_durations(filename, command, durations):
+    """ Record the duration of each test module for a command """
+    if filename is None:
+        return
+    conn = connect_history(filename)
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO test_durations "
+                             "(command, module, duration) VALUES (?, ?, ?)",
+                             [(command, module, duration) for module, duration
+                              in durations.items()])
+    finally:
+        conn.close()
+
+
+def run_sharded(entry, path, cwd=None, db=None):
+    """
+    Run a hooks_all test command split into parallel shards
+
+    The test modules are discovered, split into balanced shards using the
+    durations from previous runs, and each shard is run as a separate process
+    with its modules appended to the command.
+
+    Parameters
+    ----------
+    entry : dict
+        The hooks_all entry. 'shards' is the number of shards (0 for the
+        number of cpus), 'tests' is the test directory (default 'tests'), and
+        'pattern' is the glob for test modules (default 'test*.py').
+    path : str
+        The PATH to run the command with
+    cwd : str, optional
+        The directory to run in (default current directory)
+    db : str, optional
+        Path to the hook database for loading and saving module durations
+
+    Returns
+    -------
+    result : :class:`~.CheckResult`
+
+    """
+    command = split_command(entry)
+    key = ' '.join(command)
+    modules = find_test_modules(entry.get('tests', 'tests'),
+                                entry.get('pattern', 'test*.py'), cwd)
+    if not modules:
+        return run_command(command, path, cwd=cwd)
+    count = int(entry['shards']) or cpu_count()
+    estimates = estimate_durations(modules, load_test_durations(db, key))
+    shards = balance_shards(estimates, count)
+
+    kwargs = {'env': {'PATH': path}}
+    if cwd is not None:
+        kwargs['cwd'] = cwd
+    start = time.time()
+    procs = []
+    for _, shard in shards:
+        procs.append(subprocess.Popen(command + shard, stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT, **kwargs))
+
+    # Read every shard's output concurrently so none of them block on a full
+    # pipe
+    outputs = [None] * len(procs)
+    finished = [None] * len(procs)
+
+    def wait(i):
+        """ Collect the output of one shard """
+        outputs[i] = procs[i].communicate()[0]
+        finished[i] = time.time()
+    threads = [threading.Thread(target=wait, args=(i,)) for i in
+               range(len(procs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    encoding = locale.getdefaultlocale()[1] or 'utf-8'
     retcode = 0
+    output = []
+    durations = {}
+    for i, ((estimate, shard), proc) in enumerate(zip(shards, procs)):
+        retcode |= proc.returncode
+        output.append('Shard %d/%d (%s): %s' % (
+            i + 1, len(shards), 'passed' if proc.returncode == 0 else
+            'failed', ' '.join(shard)))
+        output.append(outputs[i].decode(encoding, 'replace'))
+        # Divide the shard's time among its modules by their estimates
+        elapsed = finished[i] - start
+        for module in shard:
+            if estimate > 0:
+                share = estimates[module] / estimate
+            else:
+                share = 1.0 / len(shard)
+            durations[module] = elapsed * share
+    save_test_durations(db, key, durations)
+    return CheckResult(command, None, retcode, '\n'.join(output),
+                       time.time() - start, False, None, None)
+
+
+def venv_path(venv, root):
+    """ Get the PATH that activates a virtualenv relative to ``root`` """
+    binpath = os.path.abspath(os.path.join(root, venv, 'bin'))
+    return binpath + os.pathsep + os.environ['PATH']
+
+
+def run_matrix(entry, root, cwd=None, db=None):
+    """
+    Run a hooks_all command in several virtualenvs at once
+
+    All virtualenvs test the same code. The first one runs in ``cwd`` and
+    each of the others runs in its own copy of it, so that build artifacts
+    from different interpreters don't collide.
+
+    Parameters
+    ----------
+    entry : dict
+        The hooks_all entry. 'envs' is the list of virtualenv paths.
+    root : str
+        The directory the virtualenv paths are relative to
+    cwd : str, optional
+        The directory to run in (default current directory)
+    db : str, optional
+        Path to the hook database, for sharded commands
+
+    Returns
+    -------
+    results : list
+        A :class:`~.CheckResult` for each virtualenv
+
+    """
+    command = split_command(entry)
+    envs = entry['envs']
+    cwd = os.path.abspath(cwd or os.curdir)
+    copies = []
+    results = [None] * len(envs)
+    single = dict(entry)
+    del single['envs']
+    # Don't copy the virtualenvs or the git dir along with the code
+    excluded = set(os.path.abspath(os.path.join(root, venv)) for venv in envs)
+
+    def ignore(directory, names):
+        """ Filter for shutil.copytree """
+        return [name for name in names if name == '.git' or
+                os.path.abspath(os.path.join(directory, name)) in excluded]
+
+    def run(i):
+        """ Run the command in one virtualenv """
+        venv = envs[i]
+        start = time.time()
+        if workdirs[i] is None:
+            results[i] = CheckResult(command, None, 1, "virtualenv '%s' does "
+                                     "not exist" % venv, 0.0, False, None,
+                                     venv)
+            return
+        if is_sharded(single):
+            result = run_sharded(single, venv_path(venv, root), workdirs[i],
+                                 db)
+        else:
+            result = run_command(command, venv_path(venv, root),
+                                 cwd=workdirs[i])
+        results[i] = result._replace(env=venv, duration=time.time() - start)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in
+               range(len(envs))]
+    try:
+        # Make all the copies before anything runs, so they don't pick up
+        # files written by the command running in cwd
+        workdirs = []
+        for i, venv in enumerate(envs):
+            if not os.path.isdir(os.path.join(root, venv, 'bin')):
+                workdirs.append(None)
+            elif i == 0:
+                workdirs.append(cwd)
+            else:
+                copy = tempfile.mkdtemp()
+                copies.append(copy)
+                workdirs.append(os.path.join(copy, 'src'))
+                shutil.copytree(cwd, workdirs[-1], symlinks=True,
+                                ignore=ignore)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for copy in copies:
+            shutil.rmtree(copy)
+    return results
+
+
+def run_hook_all(entry, path, cwd=None, db=None, capture=True, root=None):
+    """
+    Run one hooks_all entry
+
+    Parameters
+    ----------
+    entry : str, list, or dict
+        The entry from the conf file
+    path : str
+        The PATH to run the command with
+    cwd : str, optional
+        The directory to run in (default current directory)
+    db : str, optional
+        Path to the hook database, for sharded commands
+    capture : bool, optional
+        If False, plain commands write directly to stdout (default True)
+    root : str, optional
+        The directory that the paths in 'envs' are relative to (default
+        ``cwd``)
+
+    Returns
+    -------
+    results : list
+        List of :class:`~.CheckResult`. There is one for each virtualenv if
+        the entry has 'envs', otherwise only one.
+
+    """
+    if isinstance(entry, dict) and entry.get('envs'):
+        return run_matrix(entry, root or cwd or os.curdir, cwd, db)
+    elif is_sharded(entry):
+        return [run_sharded(entry, path, cwd, db)]
+    return [run_command(split_command(entry), path, capture=capture,
+                        cwd=cwd)]
+
+
+def lint_check(func):
+    """
+    Register a function as a ``devbox-lint`` check
+
+    The function is called with a :class:`~.LintFile` and should generate
+    (line, column, code, message) for each problem it finds.
+
+    """
+    LINT_CHECKS.append(func)
+    return func
+
+
+class LintFile(object):
+
+    """
+    A python file, read, tokenized and parsed once for all the lint checks
+
+    Parameters
+    ----------
+    filename : str
+        The name to report problems with
+    data : bytes
+        The contents of the file
+    options : dict
+        The lint options from :meth:`~lint_options`
+
+    """
+
+    def __init__(self, filename, data, options):
+        self.filename = filename
+        self.options = options
+        self.source = data.decode('utf-8', 'replace')
+        self.lines = self.source.splitlines(True)
+        self.tokens = []
+        self.tree = None
+        self.error = None
+        try:
+            self.tokens = list(tokenize.generate_tokens(
+                io.StringIO(self.source).readline))
+            self.tree = ast.parse(data, filename)
+        except (SyntaxError, tokenize.TokenError) as e:
+            self.error = e
+
+    def noqa(self, lineno):
+        """ Check if a line has a '# noqa' comment """
+        return (0 < lineno <= len(self.lines) and
+                '# noqa' in self.lines[lineno - 1])
+
+
+def _constant(node):
+    """ Get (True, value) if a node is None, True or False, else (False,) """
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        if node.value is None or isinstance(node.value, bool):
+            return True, node.value
+    elif isinstance(node, ast.Name) and node.id in ('None', 'True',
+                                                    'False'):
+        return True, {'None': None, 'True': True, 'False': False}[node.id]
+    elif type(node).__name__ == 'NameConstant':
+        return True, node.value
+    return (False,)
+
+
+@lint_check
+def check_syntax(lint):
+    """ E999: the file must tokenize and parse """
+    if lint.error is not None:
+        lineno = getattr(lint.error, 'lineno', None)
+        if lineno is None and len(lint.error.args) > 1:
+            # TokenError has the position in its args
+            lineno = lint.error.args[1][0]
+        offset = getattr(lint.error, 'offset', None) or 1
+        message = lint.error.args[0] if lint.error.args else ''
+        yield (lineno or 1, offset, 'E999', '%s: %s' %
+               (type(lint.error).__name__, message))
+
+
+@lint_check
+def check_lines(lint):
+    """ Physical line checks from pep8: E501, W191, W291, W293, W292, W391 """
+    max_length = lint.options['max_line_length']
+    for lineno, line in enumerate(lint.lines, 1):
+        stripped = line.rstrip('\r\n')
+        if len(stripped) > max_length:
+            yield (lineno, max_length + 1, 'E501', 'line too long (%d > %d '
+                   'characters)' % (len(stripped), max_length))
+        indent = stripped[:len(stripped) - len(stripped.lstrip())]
+        if '\t' in indent:
+            yield lineno, 1, 'W191', 'indentation contains tabs'
+        if stripped != stripped.rstrip():
+            if stripped.strip():
+                yield (lineno, len(stripped.rstrip()) + 1, 'W291',
+                       'trailing whitespace')
+            else:
+                yield lineno, 1, 'W293', 'whitespace on blank line'
+    if lint.lines:
+        last = lint.lines[-1]
+        if not last.endswith('\n'):
+            yield (len(lint.lines), len(last) + 1, 'W292',
+                   'no newline at end of file')
+        elif not last.strip() and len(lint.lines) > 1:
+            yield len(lint.lines), 1, 'W391', 'blank line at end of file'
+
+
+@lint_check
+def check_tokens(lint):
+    """ Logical line checks from pep8: E231, E703 """
+    ignored = (tokenize.COMMENT, tokenize.NL)
+    tokens = [token for token in lint.tokens if token[0] not in ignored]
+    for i, token in enumerate(tokens[:-1]):
+        kind, text, start, end = token[:4]
+        if kind != tokenize.OP:
+            continue
+        following = tokens[i + 1]
+        if text == ';' and following[0] in (tokenize.NEWLINE,
+                                            tokenize.ENDMARKER):
+            yield (start[0], start[1] + 1, 'E703',
+                   'statement ends with a semicolon')
+        elif (text == ',' and following[2] == end and
+              following[1] not in (')', ']') and
+              following[0] not in (tokenize.NEWLINE, tokenize.ENDMARKER)):
+            yield start[0], start[1] + 1, 'E231', "missing whitespace after ','"
+
+
+@lint_check
+def check_comparisons(lint):
+    """ E711 and E712: comparisons to None, True and False """
+    if lint.tree is None:
+        return
+    for node in ast.walk(lint.tree):
+        if not isinstance(node, ast.Compare):
+            continue
+        # In a chained comparison, each right-hand side is the left-hand
+        # side of the next comparison
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.Eq, ast.NotEq)):
+                for side in (left, right):
+                    constant = _constant(side)
+                    if not constant[0]:
+                        continue
+                    if constant[1] is None:
+                        yield (node.lineno, node.col_offset + 1, 'E711',
+                               'comparison to None should be '
+                               "'if cond is None:'")
+                    else:
+                        yield (node.lineno, node.col_offset + 1, 'E712',
+                               'comparison to %s should be '
+                               "'if cond is %s:' or 'if cond:'" %
+                               (constant[1], constant[1]))
+                    break
+            left = right
+
+
+def _used_names(tree):
+    """ Collect every name that is read anywhere in a tree """
+    used = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Store):
+            used.add(node.id)
+        elif (isinstance(node, ast.Assign) and
+              any(isinstance(target, ast.Name) and target.id == '__all__'
+                  for target in node.targets) and
+              isinstance(node.value, (ast.List, ast.Tuple))):
+            for element in node.value.elts:
+                value = getattr(element, 's', getattr(element, 'value',
+                                                      None))
+                if isinstance(value, str):
+                    used.add(value)
+    return used
+
+
+@lint_check
+def check_imports(lint):
+    """ E401: multiple imports on one line, F401: unused imports """
+    if lint.tree is None:
+        return
+    used = _used_names(lint.tree)
+    # __init__ files import names to re-export them
+    check_unused = os.path.basename(lint.filename) != '__init__.py'
+    for node in ast.walk(lint.tree):
+        if isinstance(node, ast.Import):
+            if len(node.names) > 1:
+                yield (node.lineno, node.col_offset + 1, 'E401',
+                       'multiple imports on one line')
+        elif isinstance(node, ast.ImportFrom):
+            if node.module == '__future__':
+                continue
+        else:
+            continue
+        if not check_unused:
+            continue
+        for alias in node.names:
+            if alias.name == '*':
+                continue
+            name = alias.asname or alias.name.split('.')[0]
+            if name not in used:
+                yield (node.lineno, node.col_offset + 1, 'F401',
+                       "'%s' imported but unused" % alias.name)
+
+
+_FUNCTIONS = (ast.FunctionDef,
+              getattr(ast, 'AsyncFunctionDef', ast.FunctionDef))
+_SCOPES = _FUNCTIONS + (ast.ClassDef, ast.Lambda)
+
+
+def _scope_nodes(scope):
+    """
+    Walk the nodes of one scope, without entering nested scopes
+
+    Generates the nested function, class and lambda nodes themselves, but not
+    their children.
+
+    """
+    todo = list(ast.iter_child_nodes(scope))
+    while todo:
+        node = todo.pop()
+        yield node
+        if not isinstance(node, _SCOPES):
+            todo.extend(ast.iter_child_nodes(node))
+
+
+@lint_check
+def check_unused_locals(lint):
+    """ F841: local variables that are assigned but never used """
+    if lint.tree is None:
+        return
+    for func in ast.walk(lint.tree):
+        if not isinstance(func, _FUNCTIONS):
+            continue
+        assigned = {}
+        loaded = set()
+        skip = set()
+        for node in _scope_nodes(func):
+            if isinstance(node, _SCOPES):
+                # Nested scopes may read the function's variables
+                loaded.update(child.id for child in ast.walk(node) if
+                              isinstance(child, ast.Name) and
+                              not isinstance(child.ctx, ast.Store))
+            elif isinstance(node, ast.Assign):
+                for target in node.targets:
+                    if isinstance(target, ast.Name):
+                        assigned.setdefault(target.id, target)
+            elif isinstance(node, ast.Name):
+                if not isinstance(node.ctx, ast.Store):
+                    loaded.add(node.id)
+                if node.id == 'locals':
+                    skip.add(func)
+            elif isinstance(node, (ast.Global,
+                                   getattr(ast, 'Nonlocal', ast.Global))):
+                loaded.update(node.names)
+        if func in skip:
+            continue
+        for name, target in sorted(assigned.items()):
+            if name not in loaded and not name.startswith('_'):
+                yield (target.lineno, target.col_offset + 1, 'F841',
+                       "local variable '%s' is assigned to but never used" %
+                       name)
+
+
+def lint_options(command, cwd=None):
+    """
+    Parse the options of a ``devbox-lint`` command
+
+    Supports ``--config=FILE`` to read the [pep8] section of a pep8 conf
+    file, and ``--max-line-length``, ``--ignore`` and ``--select``.
+
+    Parameters
+    ----------
+    command : list
+        The command from the conf file
+    cwd : str, optional
+        The directory that the command runs in, which a relative config file
+        is relative to (default current directory)
+
+    """
+    options = {
+        'max_line_length': 79,
+        'ignore': [],
+        'select': [],
+    }
+
+    def parse(key, value):
+        """ Store one option """
+        key = key.replace('-', '_')
+        if key == 'max_line_length':
+            options[key] = int(value)
+        elif key in ('ignore', 'select'):
+            options[key] = [code.strip() for code in value.split(',') if
+                            code.strip()]
+
+    for arg in command[1:]:
+        if not arg.startswith('--') or '=' not in arg:
+            continue
+        key, value = arg[2:].split('=', 1)
+        if key == 'config':
+            if cwd is not None:
+                value = os.path.join(cwd, value)
+            parser = RawConfigParser()
+            parser.read(value)
+            if parser.has_section('pep8'):
+                for item in parser.items('pep8'):
+                    parse(*item)
+        else:
+            parse(key, value)
+    return options
+
+
+def lint_file(filename, data, options):
+    """
+    Run all the lint checks on a file
+
+    Returns
+    -------
+    problems : list
+        Sorted list of (line, column, code, message)
+
+    """
+    lint = LintFile(filename, data, options)
+    problems = []
+    for check in LINT_CHECKS:
+        for line, col, code, message in check(lint):
+            if options['select'] and not any(code.startswith(prefix) for
+                                             prefix in options['select']):
+                continue
+            if any(code.startswith(prefix) for prefix in options['ignore']):
+                continue
+            if lint.noqa(line):
+                continue
+            problems.append((line, col, code, message))
+    return sorted(problems)
+
+
+def _lint_job(job):
+    """ Lint one file for a process pool """
+    filename, fullpath, options = job
+    start = time.time()
+    with open(fullpath, 'rb') as infile:
+        data = infile.read()
+    return lint_file(filename, data, options), time.time() - start
+
+
+def run_lint(jobs, cwd=None, processes=None):
+    """
+    Run the built-in ``devbox-lint`` checker on many files
+
+    Files are linted in parallel on a process pool.
+
+    Parameters
+    ----------
+    jobs : list
+        List of (command, filename)
+    cwd : str, optional
+        The directory the filenames are relative to
+    processes : int, optional
+        Size of the process pool (default number of cpus)
+
+    Returns
+    -------
+    results : list
+        A :class:`~.CheckResult` for each job
+
+    """
+    work = []
+    for command, filename in jobs:
+        fullpath = filename if cwd is None else os.path.join(cwd, filename)
+        work.append((filename, fullpath, lint_options(command, cwd)))
+    if len(work) > 1 and processes != 1:
+        pool = Pool(processes)
+        try:
+            outputs = pool.map(_lint_job, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outputs = [_lint_job(job) for job in work]
+    results = []
+    for (command, filename), (problems, duration) in zip(jobs, outputs):
+        output = '\n'.join('%s:%d:%d: %s %s' % ((filename,) + problem) for
+                           problem in problems)
+        results.append(CheckResult(command, filename, 1 if problems else 0,
+                                   output, duration, False, None, None))
+    return results
+
+
+def lint_main(args=None):
+    """
+    Usage: devbox-lint [--config=FILE] [--max-line-length=N] [--ignore=CODES]
+                       [--select=CODES] FILE...
+
+    Run the built-in style checks on python files
+
+    """
+    if args is None:
+        args = sys.argv[1:]
+    filenames = [arg for arg in args if not arg.startswith('-')]
+    if '-h' in args or '--help' in args or not filenames:
+        print(lint_main.__doc__)
+        sys.exit(0 if filenames else 1)
+    command = [LINT_COMMAND] + [arg for arg in args if arg.startswith('-')]
+    retcode = 0
+    for result in run_lint([(command, filename) for filename in filenames]):
+        if result.output:
+            print(result.output)
+        retcode |= result.retcode
+    sys.exit(retcode)
+
+
+def iter_checks(hooks_all, hooks_modified, modified, path, cache=None,
+                capture=True, cwd=None, attributes=None, root=None,
+                shas=None):
+    """
+    Run selected checks and generate a :class:`~.CheckResult` for each
+
+    Parameters
+    ----------
+    hooks_all : list
+        Commands to run once
+    hooks_modified : list
+        List of (pattern, command) to run on each matching modified file
+    modified : list
+        The modified files
+    path : str
+        The PATH to run commands with
+    cache : :class:`~.ResultCache`, optional
+        If provided, reuse and store the results of the ``hooks_modified``
+        commands that may be cached (see :meth:`~is_cached`)
+    capture : bool, optional
+        If False, ``hooks_all`` commands write directly to stdout (default
+        True)
+    cwd : str, optional
+        Directory that contains the files to check (default current
+        directory)
+    attributes : dict, optional
+        The git attributes of the modified files, from
+        :meth:`~load_attributes`. Files that are generated, vendored, or
+        excluded with the 'devbox-check' attribute will be skipped.
+    root : str, optional
+        The repository root, which virtualenv paths are relative to (default
+        ``cwd``)
+    shas : dict, optional
+        Blob shas of files that are already known (e.g. from the index), so
+        they don't need to be hashed for the result cache
+
+    """
+    db = cache.filename if cache is not None else None
     for command in hooks_all:
-        if not isinstance(command, list):
-            # Hacking around a unicode bug with shlex in old versions of python
-            if sys.version_info[0] < 3:
-                command = command.encode('utf-8')
-            command = shlex.split(command)
-        retcode |= subprocess.call(command, env={'PATH': path})
-
-    for pattern, command in hooks_modified:
-        if not isinstance(command, list):
-            if sys.version_info[0] < 3:
-                command = command.encode('utf-8')
-            command = shlex.split(command)
+        for result in run_hook_all(command, path, cwd, db, capture, root):
+            yield result
+
+    jobs = []
+    skipped = []
+    for pattern, entry in hooks_modified:
+        command = split_command(entry)
         for filename in modified:
             if not fnmatch.fnmatch(filename, pattern):
                 continue
-            printed_filename = False
-            proc = subprocess.Popen(command + [filename],
-                                    env={'PATH': path},
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT)
-            output = proc.communicate()[0]
-            if proc.returncode != 0:
-                if not printed_filename:
-                    print(filename)
-                    print('=' * len(filename))
-                    printed_filename = True
-                print(command[0])
-                print('-' * len(command[0]))
-                print(output)
-                retcode |= proc.returncode
+            size = None
+            if isinstance(entry, dict) and 'max_size' in entry:
+                fullpath = filename
+                if cwd is not None:
+                    fullpath = os.path.join(cwd, filename)
+                size = os.path.getsize(fullpath)
+            file_attributes = {}
+            if attributes is not None:
+                file_attributes = attributes.get(filename, {})
+            reason = skip_reason(entry, file_attributes, size)
+            if reason is None:
+                jobs.append((command, filename, is_cached(entry)))
+            else:
+                skipped.append(CheckResult(command, filename, 0, None, 0.0,
+                                           False, reason, None))
+    for result in skipped:
+        yield result
+    if not jobs:
+        return
+
+    keys = [None] * len(jobs)
+    if cache is not None:
+        shas = dict(shas or {})
+        for i, (command, filename, cached) in enumerate(jobs):
+            if not cached:
+                continue
+            if filename not in shas:
+                fullpath = filename
+                if cwd is not None:
+                    fullpath = os.path.join(cwd, filename)
+                shas[filename] = blob_sha(fullpath)
+            keys[i] = cache.key(command, shas[filename])
+        cache.load([key for key in keys if key is not None])
 
+    try:
+        builtin = []
+        for (command, filename, _), key in zip(jobs, keys):
+            if key is not None and cache.get(key) is not None:
+                retcode, output = cache.get(key)
+                yield CheckResult(command, filename, retcode, output, 0.0,
+                                  True, None, None)
+                continue
+            if command[0] == LINT_COMMAND:
+                builtin.append((command, filename, key))
+                continue
+            result = run_command(command, path, filename, cwd=cwd)
+            if key is not None:
+                cache.put(key, result.retcode, result.output)
+            yield result
+        # The built-in checker runs in-process, on all of its files at once
+        results = run_lint([(command, filename) for command, filename, _ in
+                            builtin], cwd)
+        for (_, _, key), result in zip(builtin, results):
+            if key is not None:
+                cache.put(key, result.retcode, result.output)
+            yield result
+    finally:
+        if cache is not None:
+            cache.save()
+
+
+def run_checks(hooks_all, hooks_modified, modified, path, history=None,
+               cache=None, attributes=None, root=None, shas=None):
+    """ Run selected checks on the current git index """
+    retcode = 0
+    printed = set()
+    skipped = {}
+    for result in iter_checks(hooks_all, hooks_modified, modified, path,
+                              cache, capture=False, attributes=attributes,
+                              root=root, shas=shas):
+        if result.skipped is not None:
+            skipped.setdefault(result.skipped, set()).add(result.filename)
+            continue
+        if history is not None:
+            history.record_check(result.command, result.filename,
+                                 result.duration, result.retcode,
+                                 result.cached)
+        if result.retcode != 0 and result.filename is not None:
+            if result.filename not in printed:
+                print(result.filename)
+                print('=' * len(result.filename))
+                printed.add(result.filename)
+            print(result.command[0])
+            print('-' * len(result.command[0]))
+            print(result.output)
+        elif result.filename is None and result.output is not None:
+            if result.env is not None:
+                header = '%s (%s): %s' % (' '.join(result.command),
+                                          result.env, 'passed' if
+                                          result.retcode == 0 else 'failed')
+                print(header)
+                print('-' * len(header))
+            print(result.output)
+        retcode |= result.retcode
+
+    if skipped:
+        print("Skipped checks on %d file(s): %s" % (
+            len(set.union(*skipped.values())),
+            ', '.join('%d %s' % (len(filenames), reason) for reason, filenames
+                      in sorted(skipped.items()))))
     return retcode
 
 
-def load_conf():
+def load_conf(directory=os.curdir):
     """ Load configuration parameters from the conf file """
-    if os.path.exists(CONF_FILE):
-        with open(CONF_FILE, 'r') as infile:
+    filename = os.path.join(directory, CONF_FILE)
+    if os.path.exists(filename):
+        with open(filename, 'r') as infile:
             return json.load(infile)
     else:
         return {}
@@ -107,6 +1781,11 @@ def copy_index(tmpdir):
     subprocess.check_call(['git', 'checkout-index', '-a', '-f', '--prefix=%s/'
                            % tmpdir])
 
+    # Most repos have no submodules, which the index can tell us without git
+    index = GitIndex.load()
+    if index is not None and not any(index.gitlinks()):
+        return
+
     # Go to each recursive submodule and use a 'git archive' tarpipe to copy
     # the correct ref into the temporary directory
     output = check_output(['git', 'submodule', 'status', '--recursive',
@@ -115,47 +1794,159 @@ def copy_index(tmpdir):
         ref, path, _ = line.split()
         ref = ref.strip('+')
         with pushd(path):
-            archive = subprocess.Popen(['git', 'archive', '--format=tar', ref],
-                                       stdout=subprocess.PIPE)
-            untar_cmd = ['tar', '-x', '-C', '%s/%s/' % (tmpdir, path)]
-            untar = subprocess.Popen(untar_cmd, stdin=archive.stdout,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.STDOUT)
-            out = untar.communicate()[0]
-            if untar.returncode != 0:
-                raise subprocess.CalledProcessError(untar.returncode,
-                                                    untar_cmd, out)
-
-
-def run_checks_in_dir(tmpdir):
-    """ Run precommit checks on the code in a directory """
+            untar_ref(ref, '%s/%s/' % (tmpdir, path))
+
+
+def untar_ref(ref, dest):
+    """ Extract a tree-ish of the current repo with a 'git archive' tarpipe """
+    archive = subprocess.Popen(['git', 'archive', '--format=tar', ref],
+                               stdout=subprocess.PIPE)
+    untar_cmd = ['tar', '-x', '-C', dest]
+    untar = subprocess.Popen(untar_cmd, stdin=archive.stdout,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+    out = untar.communicate()[0]
+    if untar.returncode != 0:
+        raise subprocess.CalledProcessError(untar.returncode, untar_cmd, out)
+
+
+def copy_tree(tree, dest, submodules=True):
+    """ Copy a git tree and (optionally) its submodules into a directory """
+    untar_ref(tree, dest)
+    if not submodules:
+        return
+    output = check_output(['git', 'ls-tree', '-r', '-z', tree])
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        mode, _, sha = info.split()
+        # Submodules are stored as commit entries in the tree
+        if mode == '160000':
+            with pushd(path):
+                copy_tree(sha, os.path.join(dest, path))
+
+
+def env_path(conf, root):
+    """ Get the PATH that activates the conf file's virtualenv, if any """
+    path = os.environ['PATH']
+    if 'env' in conf:
+        binpath = os.path.abspath(os.path.join(root, conf['env']['path'],
+                                               'bin'))
+        if binpath not in path.split(os.pathsep):
+            path = binpath + os.pathsep + path
+    return path
+
+
+def config_files(conf, root=os.curdir):
+    """
+    Find the tool config files that the ``hooks_modified`` commands may read
+
+    These are the common config files in the repository root (e.g.
+    ``.pylintrc`` or ``setup.cfg``), and any file named in a command's
+    arguments (e.g. ``--rcfile=lint.ini``).
+
+    """
+    names = set(CONFIG_FILES)
+    for _, entry in conf.get('hooks_modified', []):
+        for arg in split_command(entry)[1:]:
+            if arg.startswith('-'):
+                if '=' not in arg:
+                    continue
+                arg = arg.split('=', 1)[1]
+            names.add(arg)
+    return sorted(name for name in names if name and
+                  os.path.isfile(os.path.join(root, name)))
+
+
+def conf_salt(conf, path, root=os.curdir):
+    """ Summarize everything besides file contents that affects a check """
+    sha = hashlib.sha1(json.dumps([conf, path], sort_keys=True)
+                       .encode('utf-8'))
+    for name in config_files(conf, root):
+        sha.update(name.encode('utf-8') + b'\0')
+        with open(os.path.join(root, name), 'rb') as infile:
+            sha.update(infile.read())
+    return sha.hexdigest()
+
+
+def is_cached(entry):
+    """
+    Check if the results of a ``hooks_modified`` command may be cached
+
+    A cached result is reused whenever the command runs on the same content,
+    which is only right for commands that look at nothing but the file they
+    are passed. Commands opt in with "cache": true. The built-in checker is
+    cached unless it opts out.
+
+    """
+    if isinstance(entry, dict) and 'cache' in entry:
+        return bool(entry['cache'])
+    return split_command(entry)[0] == LINT_COMMAND
+
+
+def is_deferred(command):
+    """ Check if a hooks_all command should run after the commit lands """
+    return isinstance(command, dict) and bool(command.get('deferred'))
+
+
+def run_checks_in_dir(tmpdir, history=None, cache=None):
+    """
+    Run precommit checks on the code in a directory
+
+    ``hooks_all`` commands that are marked as deferred are not run.
+
+    """
     modified = check_output(['git', 'diff', '--cached', '--name-only',
                              '--diff-filter=ACMRT'])
     modified = [name.strip() for name in modified.splitlines()]
-    path = os.environ['PATH']
+    attributes = load_attributes(modified, cached=True)
+    # The files in tmpdir came from the index, so it has their shas
+    shas = {}
+    index = GitIndex.load()
+    if index is not None:
+        for filename in modified:
+            entry = index.get(filename)
+            if entry is not None:
+                shas[filename] = entry[1]
     with pushd(tmpdir) as prevdir:
         conf = load_conf()
+        if history is not None:
+            history.set_conf(conf)
+            history.files = len(modified)
         # Activate the virtualenv before running checks
-        if 'env' in conf:
-            binpath = os.path.abspath(os.path.join(prevdir,
-                                                   conf['env']['path'],
-                                                   'bin'))
-            if binpath not in path.split(os.pathsep):
-                path = binpath + os.pathsep + path
-        return run_checks(conf.get('hooks_all', []),
+        path = env_path(conf, prevdir)
+        if cache is not None:
+            cache.salt = conf_salt(conf, path, os.curdir)
+        hooks_all = [command for command in conf.get('hooks_all', []) if
+                     not is_deferred(command)]
+        return run_checks(hooks_all,
                           conf.get('hooks_modified', []),
                           modified,
-                          path)
+                          path,
+                          history,
+                          cache,
+                          attributes,
+                          prevdir,
+                          shas)
 
 
 def precommit(exit=True):
     """ Run all the pre-commit checks """
     tmpdir = tempfile.mkdtemp()
+    history = History.for_repo()
 
     try:
-        copy_index(tmpdir)
+        with history.phase('checkout'):
+            copy_index(tmpdir)
 
-        retcode = run_checks_in_dir(tmpdir)
+        with history.phase('checks'):
+            retcode = run_checks_in_dir(tmpdir, history,
+                                        ResultCache.for_repo())
+        if retcode == 0:
+            with history.phase('defer'):
+                schedule_deferred(load_conf(tmpdir))
+        save_history(history, retcode)
         if exit:
             sys.exit(retcode)
         else:
@@ -164,11 +1955,682 @@ def precommit(exit=True):
         shutil.rmtree(tmpdir)
 
 
+def set_deferred(filename, tree, command, status, retcode=None, output=None,
+                 duration=None):
+    """ Record the status of a deferred command on a tree """
+    conn = connect_history(filename)
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO deferred (tree, command, "
+                         "status, retcode, output, updated, duration) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (tree, command, status, retcode, output, time.time(),
+                          duration))
+    finally:
+        conn.close()
+
+
+def get_deferred(filename, trees=None, limit=10):
+    """
+    Fetch the recorded results of deferred commands
+
+    Parameters
+    ----------
+    filename : str
+        Path to the hook database
+    trees : list, optional
+        Only fetch results for these trees. If None, fetch the most recently
+        updated trees.
+    limit : int, optional
+        The number of trees to fetch if ``trees`` is None (default 10)
+
+    Returns
+    -------
+    results : dict
+        Mapping of tree to a list of dicts with the keys 'command', 'status',
+        'retcode', 'output', 'updated', and 'duration'
+
+    """
+    conn = connect_history(filename)
+    try:
+        if trees is None:
+            trees = [row[0] for row in conn.execute(
+                "SELECT tree FROM deferred GROUP BY tree "
+                "ORDER BY MAX(updated) DESC LIMIT ?", (limit,))]
+        results = {}
+        for tree in trees:
+            rows = conn.execute(
+                "SELECT command, status, retcode, output, updated, duration "
+                "FROM deferred WHERE tree = ? ORDER BY command", (tree,))
+            keys = ('command', 'status', 'retcode', 'output', 'updated',
+                    'duration')
+            entries = [dict(zip(keys, row)) for row in rows]
+            if entries:
+                results[tree] = entries
+        return results
+    finally:
+        conn.close()
+
+
+def _detach():
+    """ Start a new session at low priority, for the deferred runner """
+    os.setsid()
+    os.nice(DEFERRED_NICENESS)
+
+
+def schedule_deferred(conf):
+    """
+    Start a background process that runs the deferred checks
+
+    The checks will run on the tree that is about to be committed. Each
+    command is recorded as 'pending' first, so ``hook.py status`` and the
+    pre-push hook know about it right away.
+
+    Returns
+    -------
+    tree : str or None
+        The tree that will be checked, or None if there was nothing to run
+
+    """
+    commands = [' '.join(split_command(command)) for command in
+                conf.get('hooks_all', []) if is_deferred(command)]
+    if not commands:
+        return None
+    tree = check_output(['git', 'write-tree']).strip()
+    filename = os.path.join(git_dir(), HISTORY_FILE)
+    known = get_deferred(filename, [tree]).get(tree, [])
+    known = set(entry['command'] for entry in known)
+    if all(command in known for command in commands):
+        # This tree was already checked (e.g. the commit was amended)
+        return tree
+    for command in commands:
+        set_deferred(filename, tree, command, 'pending')
+
+    env = dict(os.environ)
+    # The commit may be using a temporary index that will soon be deleted
+    env.pop('GIT_INDEX_FILE', None)
+    log = open(os.path.join(git_dir(), DEFERRED_LOG), 'a')
+    try:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                          'run-deferred', tree],
+                         stdin=open(os.devnull, 'r'), stdout=log,
+                         stderr=subprocess.STDOUT, env=env, close_fds=True,
+                         preexec_fn=_detach)
+    finally:
+        log.close()
+    return tree
+
+
+def run_deferred(tree):
+    """ Run the deferred hooks_all commands on a tree and record the results """
+    filename = os.path.join(git_dir(), HISTORY_FILE)
+    root = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    retcode = 0
+    try:
+        copy_tree(tree, tmpdir)
+        conf = load_conf(tmpdir)
+        path = env_path(conf, root)
+        for entry in conf.get('hooks_all', []):
+            if not is_deferred(entry):
+                continue
+            key = ' '.join(split_command(entry))
+            set_deferred(filename, tree, key, 'running')
+            results = run_hook_all(entry, path, tmpdir, filename, root=root)
+            output = []
+            for result in results:
+                if result.env is not None:
+                    output.append('%s: %s' % (result.env, 'passed' if
+                                              result.retcode == 0 else
+                                              'failed'))
+                output.append(result.output or '')
+            result_code = 0
+            for result in results:
+                result_code |= result.retcode
+            status = 'passed' if result_code == 0 else 'failed'
+            set_deferred(filename, tree, key, status, result_code,
+                         '\n'.join(output),
+                         max(result.duration for result in results))
+            retcode |= result_code
+    finally:
+        shutil.rmtree(tmpdir)
+    return retcode
+
+
+def format_status(results, verbose=False):
+    """ Render the output of :meth:`~get_deferred` as text """
+    lines = []
+    for tree, entries in sorted(results.items(),
+                                key=lambda item: -max(entry['updated'] for
+                                                      entry in item[1])):
+        updated = max(entry['updated'] for entry in entries)
+        lines.append('%s  %s' % (tree[:10], time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(updated))))
+        for entry in entries:
+            line = '    %-8s %s' % (entry['status'], entry['command'])
+            if entry['duration'] is not None:
+                line += ' (%.1fs)' % entry['duration']
+            lines.append(line)
+            if verbose and entry['status'] == 'failed' and entry['output']:
+                lines.append(entry['output'])
+    return '\n'.join(lines)
+
+
+def pushed_trees(local_sha, remote_sha):
+    """ List the trees of the commits being pushed, newest first """
+    cmd = ['git', 'log', '--format=%T', local_sha]
+    if remote_sha != ZERO_SHA:
+        try:
+            return check_output(cmd + ['^' + remote_sha]).split()
+        except subprocess.CalledProcessError:
+            # We don't have the remote commit locally
+            pass
+    return check_output(cmd + ['--not', '--remotes']).split()
+
+
+def prepush(lines, exit=True):
+    """
+    Block a push if the deferred checks failed on what is being pushed
+
+    For each ref, the newest pushed commit with finished deferred checks
+    decides: if any of them failed, the push is blocked. Checks that are
+    still running do not block.
+
+    Parameters
+    ----------
+    lines : list
+        The lines that git passes to the pre-push hook on stdin
+
+    """
+    filename = os.path.join(git_dir(), HISTORY_FILE)
+    retcode = 0
+    for line in lines:
+        parts = line.split()
+        if len(parts) != 4 or parts[1] == ZERO_SHA:
+            continue
+        local_ref, local_sha, _, remote_sha = parts
+        trees = pushed_trees(local_sha, remote_sha)
+        results = get_deferred(filename, trees)
+        for tree in trees:
+            entries = results.get(tree)
+            if not entries:
+                continue
+            pending = [entry for entry in entries if entry['status'] in
+                       ('pending', 'running')]
+            if pending:
+                print("Deferred checks for %s are still running on tree %s" %
+                      (local_ref, tree[:10]))
+                continue
+            failed = [entry for entry in entries if entry['status'] ==
+                      'failed']
+            if failed:
+                print("Deferred checks failed for %s on tree %s:" %
+                      (local_ref, tree[:10]))
+                for entry in failed:
+                    print('    ' + entry['command'])
+                print("Run 'hook.py status %s' for details" % tree[:10])
+                retcode = 1
+            break
+    if exit:
+        sys.exit(retcode)
+    return retcode
+
+
+@contextlib.contextmanager
+def file_lock(filename, blocking=True):
+    """
+    Hold an exclusive lock on a file inside a 'with' block
+
+    If ``blocking`` is False and the lock is held by someone else, raises
+    IOError.
+
+    """
+    ensure_dir(os.path.dirname(filename))
+    with open(filename, 'a') as lockfile:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        fcntl.flock(lockfile, flags)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def queue_slot(directory, slots):
+    """
+    Wait for one of a fixed number of slots inside a 'with' block
+
+    The slots are lock files, so the limit is shared by every process that
+    uses the same directory.
+
+    """
+    while True:
+        for i in range(slots):
+            try:
+                lock = file_lock(os.path.join(directory, 'slot-%d' % i),
+                                 False)
+                lock.__enter__()
+            except (IOError, OSError):
+                continue
+            try:
+                yield
+            finally:
+                lock.__exit__(None, None, None)
+            return
+        time.sleep(0.05)
+
+
+def changed_files(old, new):
+    """ List the files changed between two commits, or all files in new """
+    if old == ZERO_SHA:
+        # For a new ref, compare against the default branch if it exists
+        try:
+            head = check_output(['git', 'rev-parse', '-q', '--verify',
+                                 'HEAD^{commit}']).strip()
+            old = check_output(['git', 'merge-base', head, new]).strip()
+        except subprocess.CalledProcessError:
+            old = None
+    if old:
+        output = check_output(['git', 'diff-tree', '-r', '-z', '--name-only',
+                               '--diff-filter=ACMRT', old, new])
+    else:
+        output = check_output(['git', 'ls-tree', '-r', '-z', '--name-only',
+                               new])
+    return [name for name in output.split('\0') if name]
+
+
+def tree_blobs(tree, filenames):
+    """ Get a mapping of filename to blob sha for files in a tree """
+    blobs = {}
+    for i in range(0, len(filenames), 500):
+        output = check_output(['git', 'ls-tree', '-r', '-z', tree, '--'] +
+                              filenames[i:i + 500])
+        for entry in output.split('\0'):
+            if not entry:
+                continue
+            info, path = entry.split('\t', 1)
+            blobs[path] = info.split()[2]
+    return blobs
+
+
+def tree_attributes(tree, filenames):
+    """ Look up the check routing attributes of files in a tree """
+    handle, index_file = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        env = dict(os.environ)
+        env['GIT_INDEX_FILE'] = index_file
+        subprocess.check_call(['git', 'read-tree', tree], env=env)
+        return load_attributes(filenames, cached=True, env=env)
+    finally:
+        os.unlink(index_file)
+
+
+class ReceivedTree(object):
+
+    """
+    A pushed tree, checked out into a temporary directory
+
+    Parameters
+    ----------
+    tree : str
+        The sha of the tree
+    modified : list
+        The files in the tree that were changed by the push
+
+    """
+
+    def __init__(self, tree, modified):
+        self.tree = tree
+        self.modified = modified
+        self.refs = []
+        self.tmpdir = tempfile.mkdtemp()
+        copy_tree(tree, self.tmpdir, submodules=False)
+        self.conf = load_conf(self.tmpdir)
+        self.path = os.environ['PATH']
+        self.salt = conf_salt(self.conf, self.path, self.tmpdir)
+        self.blobs = tree_blobs(tree, modified)
+        self.attributes = tree_attributes(tree, modified)
+
+    def jobs(self):
+        """
+        Generate the checks to run on this tree
+
+        Each job is a tuple of (command, filename, content sha). ``hooks_all``
+        commands use the tree sha and cached ``hooks_modified`` commands (see
+        :meth:`~is_cached`) use the blob sha, so that identical content is
+        only checked once. Other ``hooks_modified`` commands use the tree sha
+        and the file name.
+
+        """
+        for command in self.conf.get('hooks_all', []):
+            yield split_command(command), None, self.tree
+        for pattern, entry in self.conf.get('hooks_modified', []):
+            command = split_command(entry)
+            for filename in self.modified:
+                if not fnmatch.fnmatch(filename, pattern):
+                    continue
+                size = None
+                if isinstance(entry, dict) and 'max_size' in entry:
+                    size = os.path.getsize(os.path.join(self.tmpdir,
+                                                        filename))
+                reason = skip_reason(entry, self.attributes.get(filename, {}),
+                                     size)
+                if reason is None:
+                    if is_cached(entry):
+                        yield command, filename, self.blobs[filename]
+                    else:
+                        yield command, filename, '%s:%s' % (self.tree,
+                                                            filename)
+
+    def cleanup(self):
+        """ Delete the temporary directory """
+        shutil.rmtree(self.tmpdir)
+
+
+def run_received_job(job, cache, lock, slots):
+    """
+    Run one pre-receive check, unless its content was already checked
+
+    Parameters
+    ----------
+    job : tuple
+        (received, command, filename, sha) where received is the
+        :class:`~.ReceivedTree`
+    cache : :class:`~.ResultCache`
+    lock : :class:`threading.Lock`
+        Guards the cache
+    slots : int
+        Number of checks that may run at once across all processes
+
+    """
+    received, command, filename, sha = job
+    queue_dir = os.path.join(git_dir(), QUEUE_DIR)
+    key = cache.key(command, sha, received.salt)
+    # Only one process may check a given piece of content at a time. The
+    # others wait, then find the result in the cache.
+    with file_lock(os.path.join(queue_dir, key + '.lock')):
+        with lock:
+            cache.results.pop(key, None)
+            cache.load([key])
+            cached = cache.get(key)
+        if cached is not None:
+            return CheckResult(command, filename, cached[0], cached[1], 0.0,
+                               True, None, None)
+        with queue_slot(queue_dir, slots):
+            result = run_command(command, received.path, filename,
+                                 cwd=received.tmpdir)
+        with lock:
+            cache.put(key, result.retcode, result.output)
+            cache.save()
+        return result
+
+
+def prereceive(lines, exit=True, jobs=None):
+    """
+    Run the checks on every tree pushed to a bare repository
+
+    Each pushed tree is extracted from the object store into a temporary
+    directory. The checks from all trees go through one bounded queue, which
+    is shared with any other pushes running at the same time. Results are
+    cached by tree and blob sha, so content that was already checked (e.g.
+    the same commit pushed to several branches) is not checked again.
+
+    Parameters
+    ----------
+    lines : list
+        The lines that git passes to the pre-receive hook on stdin
+    exit : bool, optional
+        If True, exit with the return code (default True)
+    jobs : int, optional
+        Maximum number of checks to run at once across all simultaneous
+        pushes. Defaults to the ``devbox.jobs`` git config, or the number of
+        cpus.
+
+    """
+    if fcntl is None:
+        raise RuntimeError("pre-receive requires fcntl")
+    if jobs is None:
+        try:
+            jobs = int(check_output(['git', 'config', 'devbox.jobs']))
+        except subprocess.CalledProcessError:
+            jobs = cpu_count()
+
+    updates = {}
+    order = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) != 3 or parts[1] == ZERO_SHA:
+            continue
+        old, new, ref = parts
+        tree = check_output(['git', 'rev-parse', new + '^{tree}']).strip()
+        if tree not in updates:
+            updates[tree] = (set(), [])
+            order.append(tree)
+        updates[tree][0].update(changed_files(old, new))
+        updates[tree][1].append(ref)
+
+    cache = ResultCache.for_repo()
+    lock = threading.Lock()
+    received = []
+    pool = ThreadPool(jobs)
+    retcode = 0
+    try:
+        work = []
+        for tree in order:
+            modified, refs = updates[tree]
+            tree_data = ReceivedTree(tree, sorted(modified))
+            tree_data.refs = refs
+            received.append(tree_data)
+            for command, filename, sha in tree_data.jobs():
+                work.append((tree_data, command, filename, sha))
+        results = pool.map(functools.partial(run_received_job, cache=cache,
+                                             lock=lock, slots=jobs), work)
+        for (tree_data, _, _, _), result in zip(work, results):
+            if result.retcode == 0:
+                continue
+            retcode |= result.retcode
+            print("%s: %s failed%s" % (
+                ', '.join(tree_data.refs), ' '.join(result.command),
+                '' if result.filename is None else ' on ' + result.filename))
+            if result.output:
+                print(result.output)
+    finally:
+        pool.close()
+        pool.join()
+        for tree_data in received:
+            tree_data.cleanup()
+    if exit:
+        sys.exit(retcode)
+    return retcode
+
+
+class HookRunner(object):
+
+    """
+    Run the checks of a repository in-process
+
+    This is the library interface to the hook engine, for editors and other
+    tools that want structured results instead of scraping the output of
+    ``hook.py run-checks``. A runner keeps the conf file and the result cache
+    warm between calls, and only reloads the conf file when it changes.
+    Calls from several threads (e.g. :meth:`~run_async`) run one at a time,
+    since they share the result cache.
+
+    Checks run against the working tree of the repository, not the index.
+
+    Parameters
+    ----------
+    repo : str, optional
+        Path to the repository (default current directory)
+
+    """
+
+    def __init__(self, repo=os.curdir):
+        self.repo = os.path.abspath(repo)
+        self.cache = ResultCache.for_repo(self.repo)
+        self._conf = None
+        self._conf_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def conf(self):
+        """ The conf file of the repository, reloaded if it has changed """
+        filename = os.path.join(self.repo, CONF_FILE)
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            mtime = None
+        if self._conf is None or mtime != self._conf_mtime:
+            self._conf = load_conf(self.repo)
+            self._conf_mtime = mtime
+        return self._conf
+
+    def modified(self):
+        """ List the files with staged or unstaged changes """
+        cmd = ['git', 'diff', '--name-only', '--diff-filter=ACMRT']
+        try:
+            output = check_output(cmd + ['HEAD'], cwd=self.repo)
+        except subprocess.CalledProcessError:
+            # No commits yet, so everything in the index is new
+            output = check_output(['git', 'ls-files'], cwd=self.repo)
+        return [name.strip() for name in output.splitlines()]
+
+    def _relpath(self, filename):
+        """ Convert a path to be relative to the repository """
+        if os.path.isabs(filename):
+            filename = os.path.relpath(filename, self.repo)
+        return os.path.normpath(filename)
+
+    def run(self, paths=None, hooks_all=None):
+        """
+        Run the checks and return the results
+
+        Parameters
+        ----------
+        paths : list, optional
+            Only run ``hooks_modified`` on these files. Relative paths are
+            relative to the repository. If None, use all files with staged or
+            unstaged changes.
+        hooks_all : bool, optional
+            Whether to also run the ``hooks_all`` commands. If None, they will
+            only run when ``paths`` is None.
+
+        Returns
+        -------
+        results : list
+            List of :class:`~.CheckResult`
+
+        """
+        with self._lock:
+            return self._run(paths, hooks_all)
+
+    def _run(self, paths, hooks_all):
+        """ Run the checks, with the runner locked """
+        conf = self.conf
+        if paths is None:
+            modified = self.modified()
+        else:
+            modified = [self._relpath(filename) for filename in paths]
+        modified = [filename for filename in modified if
+                    os.path.isfile(os.path.join(self.repo, filename))]
+        if hooks_all is None:
+            hooks_all = paths is None
+        path = env_path(conf, self.repo)
+        self.cache.salt = conf_salt(conf, path, self.repo)
+        attributes = load_attributes(modified, cwd=self.repo)
+        # Files that are unchanged since they were staged have their sha in
+        # the index, so they don't need to be hashed
+        shas = {}
+        index = GitIndex.load(self.repo)
+        if index is not None:
+            for filename in modified:
+                if index.stat_matches(filename,
+                                      os.path.join(self.repo, filename)):
+                    shas[filename] = index[filename][1]
+        return list(iter_checks(conf.get('hooks_all', []) if hooks_all else [],
+                                conf.get('hooks_modified', []),
+                                modified,
+                                path,
+                                self.cache,
+                                cwd=self.repo,
+                                attributes=attributes,
+                                root=self.repo,
+                                shas=shas))
+
+    def run_async(self, paths=None, hooks_all=None, loop=None):
+        """
+        Asyncio version of :meth:`~run`
+
+        Runs the checks in the loop's default executor and returns a future
+        that resolves to the list of results.
+
+        """
+        if asyncio is None:
+            raise RuntimeError("asyncio is not available")
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, functools.partial(self.run, paths,
+                                                            hooks_all))
+
+
+_RUNNERS = {}
+
+
+def get_runner(repo=os.curdir):
+    """ Get the shared :class:`~.HookRunner` for a repository """
+    repo = os.path.abspath(repo)
+    runner = _RUNNERS.get(repo)
+    if runner is None:
+        runner = _RUNNERS[repo] = HookRunner(repo)
+    return runner
+
+
+def check(repo=os.curdir, paths=None, hooks_all=None):
+    """
+    Run the checks of a repository in-process
+
+    See :meth:`.HookRunner.run` for the arguments. The runner for each
+    repository is reused across calls.
+
+    """
+    return get_runner(repo).run(paths, hooks_all)
+
+
+def check_async(repo=os.curdir, paths=None, hooks_all=None, loop=None):
+    """ Asyncio version of :meth:`~check` """
+    return get_runner(repo).run_async(paths, hooks_all, loop)
+
+
+def stats_main(args):
+    """ Report the check timings recorded in the hook history """
+    parser = argparse.ArgumentParser(prog='hook.py stats',
+                                     description=stats_main.__doc__)
+    parser.add_argument('--days', type=float, default=30,
+                        help="Only use the runs of the last DAYS days "
+                        "(default %(default)s)")
+    parser.add_argument('--openmetrics', action='store_true',
+                        help="Print the stats in OpenMetrics text format")
+    args = parser.parse_args(args)
+    stats = load_stats(os.path.join(git_dir(), HISTORY_FILE), args.days)
+    if args.openmetrics:
+        print(format_openmetrics(stats))
+    else:
+        print(format_stats(stats))
+
+
 def main(args=None):
     """
     Usage: ./hook.py all
        or: ./hook.py checkout-index [DEST]
        or: ./hook.py run-checks DEST
+       or: ./hook.py stats [--openmetrics] [--days DAYS]
+       or: ./hook.py status [TREE]
+       or: ./hook.py run-deferred TREE
+       or: ./hook.py pre-push
+       or: ./hook.py pre-receive
 
     all               Check out the git index and run all hooks defined in
                       .devbox.conf
@@ -177,6 +2639,21 @@ def main(args=None):
                       and write the location to stdout
     run-checks        Run the checks defined in .devbox.conf on the destination
                       directory
+    stats             Report the p50/p95 latency of each check, the daily
+                      trend of hook runs, and the slowest files, using the
+                      timings recorded in .git/devbox/hook.sqlite. Pass
+                      --openmetrics to print them in OpenMetrics text format.
+    status            Show the results of deferred hooks_all commands for the
+                      most recent trees, or the full output for one TREE (or
+                      commit)
+    run-deferred      Run the deferred hooks_all commands on a TREE. This is
+                      started in the background by 'all'.
+    pre-push          Read the pre-push hook input from stdin and fail if the
+                      deferred checks failed on the commits being pushed
+    pre-receive       Server mode for bare repositories. Read the pre-receive
+                      hook input from stdin and run the checks on every pushed
+                      tree. The number of checks that run at once across all
+                      pushes is limited by the 'devbox.jobs' git config.
 
     """
     if args is None:
@@ -203,11 +2680,35 @@ def main(args=None):
         if len(args) < 2:
             print(main.__doc__)
             sys.exit(1)
-        retcode = run_checks_in_dir(args[1])
+        history = History.for_repo()
+        with history.phase('checks'):
+            retcode = run_checks_in_dir(args[1], history,
+                                        ResultCache.for_repo())
+        save_history(history, retcode)
         sys.exit(retcode)
+    elif command == 'run-deferred':
+        if len(args) < 2:
+            print(main.__doc__)
+            sys.exit(1)
+        sys.exit(run_deferred(args[1]))
+    elif command == 'status':
+        filename = os.path.join(git_dir(), HISTORY_FILE)
+        if len(args) > 1:
+            trees = [check_output(['git', 'rev-parse',
+                                   args[1] + '^{tree}']).strip()]
+            print(format_status(get_deferred(filename, trees), True))
+        else:
+            print(format_status(get_deferred(filename)))
+    elif command == 'pre-push':
+        prepush(sys.stdin.read().splitlines())
+    elif command == 'pre-receive':
+        prereceive(sys.stdin.read().splitlines())
+    elif command == 'stats':
+        stats_main(args[1:])
     else:
         print(main.__doc__)
         sys.exit(1)
 
+
 if __name__ == '__main__':
     main()
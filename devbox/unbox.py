@@ -7,11 +7,19 @@ the ``devbox`` package. This allows it to be downloaded separately and run
 directly as a script to perform the "unbox" operation.
 
 """
+import base64
+import glob
+import hashlib
 import os
+import platform
 import re
 import stat
 import sys
+import time
+import uuid
 from distutils.spawn import find_executable  # pylint: disable=E0611,F0401
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 import argparse
 import contextlib
@@ -20,16 +28,47 @@ import logging
 import shlex
 import shutil
 import subprocess
+import tempfile
+import threading
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from ConfigParser import RawConfigParser  # pylint: disable=F0401
+except ImportError:
+    from configparser import RawConfigParser  # pylint: disable=F0401
 
 try:
-    from urllib import urlretrieve
+    from Queue import Queue  # pylint: disable=F0401
 except ImportError:
-    from urllib.request import urlretrieve  # pylint: disable=E0611,F0401
+    from queue import Queue  # pylint: disable=F0401
+
+try:
+    from urllib2 import urlopen, Request, HTTPError  # pylint: disable=F0401
+except ImportError:
+    # pylint: disable=E0611,F0401
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
 
 LOG = logging.getLogger(__name__)
+SNAPSHOT_MANIFEST = 'manifest.json'
+SNAPSHOT_VERSION = 1
 CONF_FILE = '.devbox.conf'
+LOCK_FILE = '.devbox.lock'
+STAMP_DIR = os.path.join('devbox', 'stamps')
+# Files that determine what a pip install of a local project does
+PROJECT_FILES = ('setup.py', 'setup.cfg', 'pyproject.toml')
 URL_SCRIPT = re.compile(r'^(http|https|ftp)://.+$')
+VENV_MANIFEST = 'devbox-venv.json'
+VENV_ID = 'devbox-venv-id'
 VENV_VERSION = '1.10.1'
 VENV_URL = ("https://pypi.python.org/packages/source/v/"
             "virtualenv/virtualenv-%s.tar.gz" % VENV_VERSION)
@@ -45,6 +84,105 @@ def load_conf(directory=os.curdir):
         return {}
 
 
+def load_lock(directory=os.curdir):
+    """ Load the pinned commits of a workspace from its lock file """
+    filename = os.path.join(directory, LOCK_FILE)
+    if os.path.exists(filename):
+        with open(filename, 'r') as infile:
+            repos = json.load(infile).get('repos', {})
+        # Older lock files were keyed by path, with the url in each entry
+        return dict((entry.pop('url', key), entry) for key, entry in
+                    repos.items())
+    else:
+        return {}
+
+
+def save_lock(repos, directory=os.curdir):
+    """
+    Write the pinned commits of a workspace to its lock file
+
+    Parameters
+    ----------
+    repos : dict
+        Mapping of the url of each repository (see :meth:`~lock_key`) to its
+        entry from :meth:`~update_repo`
+    directory : str, optional
+        The top repository (default current directory)
+
+    """
+    filename = os.path.join(directory, LOCK_FILE)
+    with open(filename, 'w') as outfile:
+        json.dump({'repos': repos}, outfile, indent=2, sort_keys=True)
+        outfile.write('\n')
+
+
+def lock_key(repo):
+    """
+    Get the key of a repository in the lock file
+
+    Repositories are keyed by url, so the lock doesn't depend on where the
+    workspace is. A path to a clone is keyed by the url of its origin.
+
+    """
+    if os.path.exists(repo):
+        # 'repo' is a file path, not a git url
+        try:
+            return check_output(['git', '-C', repo, 'config',
+                                 'remote.origin.url'])
+        except subprocess.CalledProcessError:
+            pass
+    return repo
+
+
+def cache_dir(*paths):
+    """
+    Get a path inside the per-user devbox cache
+
+    The cache is in ``$DEVBOX_CACHE``, or ``devbox`` under ``$XDG_CACHE_HOME``
+    (default ``~/.cache``).
+
+    """
+    root = os.environ.get('DEVBOX_CACHE')
+    if not root:
+        root = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.join('~', '.cache'), 'devbox')
+    return os.path.join(os.path.expanduser(root), *paths)
+
+
+def ensure_dir(directory):
+    """ Create a directory and its parents if they don't exist """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have made it first
+            if not os.path.isdir(directory):
+                raise
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """ Hold an exclusive lock on a file inside a 'with' block """
+    ensure_dir(os.path.dirname(filename))
+    with open(filename, 'a') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def check_output(cmd, **kwargs):
+    """ Run a command and return its stripped output as unicode """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kwargs)
+    output = proc.communicate()[0]
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+    return output.decode('utf-8').strip()
+
+
 @contextlib.contextmanager
 def pushd(path):
     """ Context manager for temporarily changing directories """
@@ -56,6 +194,99 @@ def pushd(path):
         os.chdir(tmp)
 
 
+# Trace events of the current process, or None when not tracing
+TRACE = None
+
+
+def start_trace():
+    """ Start recording trace events in this process """
+    global TRACE  # pylint: disable=W0603
+    TRACE = []
+
+
+def child_rusage():
+    """
+    Get the CPU seconds and peak memory used by finished subprocesses
+
+    These are totals for the whole process: CPU time adds up over every
+    subprocess that has finished, and the peak memory is that of the largest
+    one so far.
+
+    """
+    if resource is None:
+        return {}
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'children_user_cpu': usage.ru_utime,
+        'children_system_cpu': usage.ru_stime,
+        'children_peak_rss_kb': usage.ru_maxrss,
+    }
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """
+    Record a trace event for the duration of a 'with' block
+
+    The event is in the Chrome trace-event format, with the keyword
+    arguments and the CPU time of the subprocesses that finished during the
+    block as its args. Those are process-wide, so subprocesses of other
+    threads that finished meanwhile are counted too, and
+    'children_peak_rss_kb' is the largest peak of any subprocess of the
+    process so far, not only of this block.
+
+    """
+    if TRACE is None:
+        yield
+        return
+    start = time.time()
+    before = child_rusage()
+    try:
+        yield
+    finally:
+        end = time.time()
+        after = child_rusage()
+        for key in ('children_user_cpu', 'children_system_cpu'):
+            if key in after:
+                args[key] = round(after[key] - before[key], 6)
+        if 'children_peak_rss_kb' in after:
+            args['children_peak_rss_kb'] = after['children_peak_rss_kb']
+        TRACE.append({
+            'name': name,
+            'cat': 'unbox',
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+
+
+def stop_trace():
+    """ Stop recording trace events and return the recorded ones """
+    global TRACE  # pylint: disable=W0603
+    events, TRACE = TRACE, None
+    return events
+
+
+def run_traced(job):
+    """ Run a function in a worker process and return its trace events """
+    func, args = job
+    start_trace()
+    try:
+        result = func(args)
+    finally:
+        events = stop_trace()
+    return result, events
+
+
+def save_trace(filename, events):
+    """ Write trace events to a file that Perfetto can open """
+    with open(filename, 'w') as outfile:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, outfile)
+
+
 def repo_name_from_url(url):
     """ Parse the repository name out of a git repo url """
     name_pattern = re.compile(r'[A-Za-z0-9_\-]+')
@@ -66,178 +297,2237 @@ def repo_name_from_url(url):
     return all_words[-1]
 
 
-def run_commands(commands, venv=None):
+def download(url, sha256=None, offline=False):
+    """
+    Download a file into the persistent download cache
+
+    A cached file is revalidated with its ETag and Last-Modified headers, so
+    it is only downloaded again when it changes. If the expected checksum is
+    known and the cached file matches it, the server is not contacted at all.
+
+    Parameters
+    ----------
+    url : str
+        The url to download
+    sha256 : str, optional
+        The expected sha256 hex digest of the file
+    offline : bool, optional
+        If True, only use the cache (default False)
+
+    Returns
+    -------
+    path : str
+        The path to the cached file. It must not be modified.
+
+    Raises
+    ------
+    exc : :class:`ValueError`
+        If the file doesn't match the checksum
+    exc : :class:`IOError`
+        If offline and the file isn't cached
+
+    """
+    path = cache_dir('downloads', hashlib.sha1(url.encode('utf-8'))
+                     .hexdigest())
+    meta_file = path + '.json'
+    with file_lock(path + '.lock'):
+        meta = {}
+        if os.path.exists(meta_file) and os.path.exists(path):
+            with open(meta_file, 'r') as infile:
+                meta = json.load(infile)
+        if meta and sha256 is not None and meta['sha256'] != sha256:
+            LOG.warning("Cached %s doesn't match its checksum", url)
+            meta = {}
+        if meta and (offline or sha256 is not None):
+            return path
+        if offline:
+            raise IOError("%s is not in the download cache" % url)
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = urlopen(Request(url, headers=headers))
+        except HTTPError as e:
+            if e.code == 304 and meta:
+                LOG.debug("Cached %s is up to date", url)
+                return path
+            raise
+        LOG.info("Downloading %s", url)
+        digest = hashlib.sha256()
+        tmp_path = path + '.part'
+        try:
+            with open(tmp_path, 'wb') as outfile:
+                while True:
+                    chunk = response.read(64 * 1024)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    outfile.write(chunk)
+        finally:
+            response.close()
+        if sha256 is not None and digest.hexdigest() != sha256:
+            os.unlink(tmp_path)
+            raise ValueError("Checksum mismatch for %s: expected %s, got %s" %
+                             (url, sha256, digest.hexdigest()))
+        os.rename(tmp_path, path)
+        info = response.info()
+        meta = {
+            'url': url,
+            'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+            'sha256': digest.hexdigest(),
+        }
+        with open(meta_file, 'w') as outfile:
+            json.dump(meta, outfile)
+    return path
+
+
+def download_conf(url, options=None):
+    """ Download a file with the checksum and offline mode from the options """
+    options = options or {}
+    return download(url, options.get('checksums', {}).get(url),
+                    options.get('offline', False))
+
+
+# pip install options that take a value
+PIP_VALUE_OPTIONS = ('-i', '--index-url', '--extra-index-url', '-f',
+                     '--find-links', '-c', '--constraint', '-t', '--target',
+                     '--prefix', '--root', '--src')
+
+
+def pip_targets(command):
+    """
+    Get what a ``pip install`` command installs
+
+    Returns
+    -------
+    targets : list or None
+        The requirement arguments (``-r`` files and ``-e`` targets, each
+        after its flag, and requirement specifiers), or None if it's not a
+        pip install command
+
+    """
+    if (len(command) < 2 or os.path.basename(command[0]) != 'pip' or
+            command[1] != 'install'):
+        return None
+    targets = []
+    args = iter(command[2:])
+    for arg in args:
+        if arg in ('-r', '--requirement'):
+            targets.extend([arg, next(args, '')])
+        elif arg in ('-e', '--editable'):
+            targets.extend(['-e', next(args, '')])
+        elif arg in PIP_VALUE_OPTIONS:
+            next(args, None)
+        elif not arg.startswith('-'):
+            targets.append(arg)
+    return targets
+
+
+def is_local(target):
+    """ Check if a pip target is a local project instead of a requirement """
+    return (os.path.exists(target) or
+            target.startswith(('.', os.sep, '~', 'file:')))
+
+
+def split_targets(targets):
+    """
+    Split pip targets into requirements and local projects
+
+    Requirement files are read for both.
+
+    Returns
+    -------
+    requirements : list
+        The requirement specifiers
+    local : list
+        The editable and local targets
+
+    """
+    requirements = []
+    local = []
+    args = iter(targets)
+    for arg in args:
+        if arg == '-e':
+            local.append(next(args, ''))
+        elif arg not in ('-r', '--requirement'):
+            if is_local(arg):
+                local.append(arg)
+            else:
+                requirements.append(arg)
+            continue
+        filename = next(args, '')
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'r') as infile:
+            for line in infile:
+                line = line.split(' #', 1)[0].strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith(('-e', '--editable')):
+                    local.append(line.split(None, 1)[-1].lstrip('='))
+                elif is_local(line):
+                    local.append(line)
+                elif not line.startswith('-'):
+                    requirements.append(line)
+    return requirements, local
+
+
+def wheel_jobs(targets):
+    """
+    Split pip targets into requirements that can be built separately
+
+    Editable and local targets, including those in requirement files, are
+    left out. pip installs those from their source.
+
+    """
+    jobs, local = split_targets(targets)
+    if local:
+        # Isolated builds of local projects need these from the wheelhouse
+        # to build without the index
+        jobs.extend(req for req in ('setuptools', 'wheel') if req not in jobs)
+    return jobs
+
+
+def installs_local(commands):
+    """ Check if any of a list of setup commands pip installs a local project """
+    for entry in commands:
+        targets = pip_targets(split(entry))
+        if targets and split_targets(targets)[1]:
+            return True
+    return False
+
+
+def use_wheelhouse(command, wheelhouse, jobs=None, **kwargs):
+    """
+    Build the wheels for a pip install command and install from them
+
+    Wheels that are missing from the wheelhouse are built in parallel. Each
+    build writes into its own temporary directory, and its wheels are then
+    renamed into the wheelhouse, so pip never reads a half-written wheel from
+    a concurrent build. If everything the command needs is then in the
+    wheelhouse, it installs with ``--no-index``. Editable and local targets
+    are not built into wheels; pip installs them from their source.
+
+    Parameters
+    ----------
+    command : list
+        The pip install command
+    wheelhouse : str
+        Directory of wheels
+    jobs : int, optional
+        Number of wheels to build at once (default number of cpus)
+    **kwargs :
+        Arguments for subprocess (e.g. the env of the virtualenv)
+
+    Returns
+    -------
+    command : list
+        The command to run instead
+
+    """
+    requirements = wheel_jobs(pip_targets(command))
+    pip = command[:1]
+
+    def build(args, **call_kwargs):
+        """ Run pip wheel and move the wheels it made into the wheelhouse """
+        # In the wheelhouse, so the wheels are renamed within one filesystem
+        tmpdir = tempfile.mkdtemp(prefix='.build-', dir=wheelhouse)
+        try:
+            call_kwargs.update(kwargs)
+            retcode = subprocess.call(pip + ['wheel', '-q', '--find-links',
+                                             wheelhouse, '--wheel-dir',
+                                             tmpdir] + args, **call_kwargs)
+            for name in os.listdir(tmpdir):
+                os.rename(os.path.join(tmpdir, name),
+                          os.path.join(wheelhouse, name))
+        finally:
+            shutil.rmtree(tmpdir)
+        return retcode
+
+    def available():
+        """ Check if the wheelhouse has everything without the index """
+        if not requirements:
+            return True
+        with open(os.devnull, 'w') as devnull:
+            return build(['--no-index'] + requirements, stdout=devnull,
+                         stderr=devnull) == 0
+
+    ensure_dir(wheelhouse)
+    offline = available()
+    if not offline:
+        LOG.info("Building %d wheel(s) in %s", len(requirements), wheelhouse)
+        pool = ThreadPool(jobs)
+        try:
+            retcodes = pool.map(lambda req: build([req]), requirements)
+        finally:
+            pool.close()
+            pool.join()
+        for requirement, retcode in zip(requirements, retcodes):
+            if retcode != 0:
+                LOG.warning("Could not build a wheel for %s", requirement)
+        offline = available()
+    extra = ['--find-links', wheelhouse]
+    if offline:
+        extra.append('--no-index')
+    return command[:2] + extra + command[2:]
+
+
+def git_dir():
+    """ Get the git directory of the current directory, or None """
+    # Fast path that doesn't need git
+    if os.path.isdir('.git'):
+        return os.path.abspath('.git')
+    with open(os.devnull, 'w') as devnull:
+        try:
+            return os.path.abspath(check_output(
+                ['git', 'rev-parse', '--git-dir'], stderr=devnull))
+        except subprocess.CalledProcessError:
+            return None
+
+
+def command_inputs(command):
+    """
+    Get the files that a setup command depends on
+
+    These are the 'inputs' of a command in dict form. Otherwise, pip install
+    commands depend on their requirement files and the setup files of the
+    local projects they install.
+
+    """
+    if isinstance(command, dict) and 'inputs' in command:
+        return command['inputs']
+    inputs = []
+    targets = pip_targets(split(command)) or []
+    args = iter(targets)
+    for arg in args:
+        if arg in ('-r', '--requirement'):
+            inputs.append(next(args, ''))
+            continue
+        if arg == '-e':
+            arg = next(args, '')
+        if os.path.isdir(arg):
+            inputs.extend(os.path.join(arg, name) for name in PROJECT_FILES)
+    return inputs
+
+
+def venv_id(path):
+    """
+    Identify one build of a virtualenv
+
+    devbox writes a random id into each virtualenv it creates, so the id is
+    kept when the virtualenv is moved along with its repo, and changes when
+    it is rebuilt. Other virtualenvs are identified by the inode of their
+    python.
+
+    """
+    filename = os.path.join(path, VENV_ID)
+    if os.path.exists(filename):
+        with open(filename, 'r') as infile:
+            return infile.read().strip()
+    try:
+        st = os.lstat(os.path.join(path, 'bin', 'python'))
+    except OSError:
+        return None
+    return '%d:%d' % (st.st_ino, int(st.st_mtime))
+
+
+def stamp_key(command, inputs, venv=None):
+    """ Hash a setup command with its input files and virtualenv """
+    data = [command, None, None]
+    if venv is not None:
+        # Relative to the repo, so the stamps move with the workspace
+        data[1:] = [os.path.relpath(os.path.abspath(venv['path'])),
+                    venv_id(venv['path'])]
+    for filename in inputs:
+        digest = None
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as infile:
+                digest = hashlib.sha1(infile.read()).hexdigest()
+        data.append([filename, digest])
+    return hashlib.sha1(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+def has_stamp(key):
+    """ Check if a setup step with this key has already run """
+    directory = git_dir()
+    return (directory is not None and
+            os.path.exists(os.path.join(directory, STAMP_DIR, key)))
+
+
+def save_stamp(key, command):
+    """ Record that a setup step ran successfully """
+    if git_dir() is None:
+        return
+    directory = os.path.join(git_dir(), STAMP_DIR)
+    ensure_dir(directory)
+    with open(os.path.join(directory, key), 'w') as outfile:
+        json.dump({'command': command, 'time': time.time()}, outfile)
+
+
+def prepare_command(entry, venv=None, options=None):
+    """
+    Get a setup command ready to run
+
+    The script of a url command is downloaded, and the command is checked
+    against its stamp. Only commands with inputs have stamps (see
+    :meth:`~command_inputs`). Others always run, unless they declare that
+    they have none with "inputs": [].
+
+    Returns
+    -------
+    step : tuple or None
+        (command, key, kwargs) where command is the list of arguments, key
+        is the stamp key to save once it succeeds (or None) and kwargs are
+        the arguments for :class:`subprocess.Popen`. None if the command is
+        up to date. Pip commands still need :meth:`~pip_command`.
+
+    """
+    options = options or {}
+    command = split(entry)
+    description = ' '.join(command)
+    inputs = command_inputs(entry)
+    stamped = bool(inputs) or (isinstance(entry, dict) and 'inputs' in entry)
+    kwargs = {}
+    # add the venv to the path
+    if venv is not None:
+        kwargs['env'] = {
+            'PATH': os.path.join(os.path.curdir, venv['path'], 'bin') +
+            os.pathsep + os.environ['PATH']
+        }
+    # If the command is a url, download that script and run it
+    if URL_SCRIPT.match(command[0]):
+        with span('download', url=command[0]):
+            path = download_conf(command[0], options)
+        st = os.stat(path)
+        os.chmod(path, st.st_mode | stat.S_IEXEC)
+        inputs = list(inputs) + [path]
+        command = [path] + command[1:]
+    key = None
+    if stamped:
+        key = stamp_key(command, inputs, venv)
+        if not options.get('force') and has_stamp(key):
+            LOG.debug("Skipping up-to-date command: %s", description)
+            return None
+    LOG.debug("Running command: %s", description)
+    return command, key, kwargs
+
+
+def pip_command(command, options, **kwargs):
+    """ Build the wheels for a pip install command if using a wheelhouse """
+    if options.get('wheelhouse') and pip_targets(command):
+        return use_wheelhouse(command, options['wheelhouse'],
+                              options.get('jobs'), **kwargs)
+    return command
+
+
+def run_commands(commands, venv=None, options=None):
     """
     Run a list of setup commands
 
     Parameters
     ----------
     commands : list
-        List of strings or lists that will be run
+        List of strings or lists that will be run. If any of them is a dict
+        with a 'name' or 'after', the list is a graph of steps instead (see
+        :meth:`~run_steps`).
     venv : dict, optional
         The venv dict from the devbox config. If present, will run all commands
         inside that virtualenv.
+    options : dict, optional
+        The unbox options. 'checksums' and 'offline' are used for the
+        downloads of url commands. If 'wheelhouse' is set, pip install
+        commands build and install wheels from that directory. Commands
+        whose stamp matches are skipped, unless 'force' is set.
 
     """
-    for command in commands:
-        if not isinstance(command, list):
-            # Hacking around a unicode bug with shlex in old versions of python
-            if sys.version_info[0] < 3:
-                command = command.encode('utf-8')
-            command = shlex.split(command)
-        LOG.debug("Running command: %s", ' '.join(command))
-        kwargs = {}
-        # add the venv to the path
-        if venv is not None:
-            kwargs['env'] = {
-                'PATH': os.path.join(os.path.curdir, venv['path'], 'bin') +
-                os.pathsep + os.environ['PATH']
-            }
-        path = None
-        # If the command is a url, download that script and run it
-        if URL_SCRIPT.match(command[0]):
-            path = urlretrieve(command[0])[0]
-            st = os.stat(path)
-            os.chmod(path, st.st_mode | stat.S_IEXEC)
-            command = [path] + command[1:]
-
-        subprocess.check_call(command, **kwargs)
-
-        # If we downloaded a script, clean it up
-        if path is not None:
-            os.unlink(path)
+    options = options or {}
+    if is_step_graph(commands):
+        run_steps(commands, venv, options)
+        return
+    for entry in commands:
+        step = prepare_command(entry, venv, options)
+        if step is None:
+            continue
+        command, key, kwargs = step
+        with span('run_commands', repo=os.getcwd(),
+                  command=' '.join(split(entry))):
+            command = pip_command(command, options, **kwargs)
+            subprocess.check_call(command, **kwargs)
+        if key is not None:
+            save_stamp(key, command)
+
+
+def is_step_graph(commands):
+    """ Check if a list of setup commands uses named steps """
+    return any(isinstance(entry, dict) and ('name' in entry or
+                                            'after' in entry)
+               for entry in commands)
+
+
+def step_graph(commands):
+    """
+    Get the named steps of a list of setup commands
+
+    Steps without a 'name' are named after their command.
+
+    Returns
+    -------
+    names : list
+        The step names, in the order of the list
+    steps : dict
+        Mapping of each name to its entry
+    after : dict
+        Mapping of each name to the set of names it runs after
+
+    Raises
+    ------
+    exc : ValueError
+        If names are repeated, 'after' names an unknown step, or the steps
+        depend on each other in a cycle
+
+    """
+    names = []
+    steps = {}
+    after = {}
+    for entry in commands:
+        name = ' '.join(split(entry))
+        if isinstance(entry, dict):
+            name = entry.get('name', name)
+        if name in steps:
+            raise ValueError("Setup step '%s' is defined twice" % name)
+        names.append(name)
+        steps[name] = entry
+        after[name] = set(entry.get('after', []) if isinstance(entry, dict)
+                          else [])
+    for name in names:
+        for dep in after[name]:
+            if dep not in steps:
+                raise ValueError("Setup step '%s' runs after unknown step "
+                                 "'%s'" % (name, dep))
+    # Check for cycles by peeling off the steps that are ready
+    remaining = set(names)
+    while remaining:
+        ready = [name for name in remaining if not after[name] & remaining]
+        if not ready:
+            raise ValueError("Setup steps depend on each other: %s" %
+                             ', '.join(sorted(remaining)))
+        remaining.difference_update(ready)
+    return names, steps, after
+
+
+def run_steps(commands, venv=None, options=None):
+    """
+    Run a graph of setup steps, independent steps at the same time
+
+    Each step runs once all the steps in its 'after' list succeeded. Up to
+    'jobs' steps run at once, each with its own output buffer, which is
+    logged when it finishes. When a step fails, the running steps are
+    terminated and no more are started.
+
+    Parameters
+    ----------
+    commands : list
+        The setup commands. See :meth:`~step_graph`.
+    venv : dict, optional
+        The venv dict from the devbox config
+    options : dict, optional
+        The unbox options, as for :meth:`~run_commands`
+
+    Raises
+    ------
+    exc : :class:`subprocess.CalledProcessError`
+        If a step fails
+
+    """
+    options = options or {}
+    names, steps, after = step_graph(commands)
+    jobs = options.get('jobs') or cpu_count()
+    results = Queue()
+    procs = {}
+    lock = threading.Lock()
+    cancelled = []
+
+    def run(name, command, kwargs):
+        """ Run one step and put its result on the queue """
+        try:
+            with span('run_commands', repo=os.getcwd(),
+                      command=' '.join(split(steps[name])), step=name):
+                command = pip_command(command, options, **kwargs)
+                with lock:
+                    if cancelled:
+                        results.put((name, command, None, ''))
+                        return
+                    proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            **kwargs)
+                    procs[name] = proc
+                output = proc.communicate()[0]
+            results.put((name, command, proc.returncode,
+                         output.decode('utf-8', 'replace')))
+        except Exception as e:  # pylint: disable=W0703
+            results.put((name, command, 1, '%s: %s' % (type(e).__name__, e)))
+
+    def cancel():
+        """ Start no more steps and terminate the running ones """
+        with lock:
+            cancelled.append(True)
+            for other, proc in procs.items():
+                if other in running and proc.poll() is None:
+                    proc.terminate()
+
+    def start_ready():
+        """
+        Start the steps whose dependencies are done, up to 'jobs'
+
+        Returns the error of a step that could not be prepared, if any
+
+        """
+        started = True
+        while started:
+            started = False
+            for name in list(pending):
+                if len(running) >= jobs:
+                    return
+                if not after[name] <= done:
+                    continue
+                pending.remove(name)
+                started = True
+                try:
+                    step = prepare_command(steps[name], venv, options)
+                except Exception as e:  # pylint: disable=W0703
+                    output = '%s: %s' % (type(e).__name__, e)
+                    LOG.error("Setup step %s failed:\n%s", name, output)
+                    return subprocess.CalledProcessError(1, steps[name],
+                                                         output)
+                if step is None:
+                    # Up to date, which may make more steps ready
+                    done.add(name)
+                    continue
+                command, key, kwargs = step
+                LOG.info("Starting setup step %s", name)
+                thread = threading.Thread(target=run,
+                                          args=(name, command, kwargs))
+                thread.daemon = True
+                running[name] = (key, thread)
+                thread.start()
+
+    pending = list(names)
+    running = {}
+    done = set()
+    failure = None
+    while True:
+        if failure is None:
+            failure = start_ready()
+            if failure is not None:
+                cancel()
+        if not running:
+            break
+        name, command, retcode, output = results.get()
+        key, thread = running.pop(name)
+        thread.join()
+        if retcode is None or (failure is not None and retcode != 0):
+            LOG.info("Cancelled setup step %s", name)
+        elif retcode != 0:
+            LOG.error("Setup step %s failed:\n%s", name, output.rstrip())
+            failure = subprocess.CalledProcessError(retcode, command, output)
+            cancel()
+        else:
+            if output.strip():
+                LOG.info("Setup step %s:\n%s", name, output.rstrip())
+            if key is not None:
+                save_stamp(key, command)
+            done.add(name)
+    if failure is not None:
+        raise failure
 
 
 def setup_git_hooks():
     """ Set up a symlink to the git hooks directory """
-    # Symlink to git hooks
-    if os.path.exists('git_hooks') and not os.path.islink('.git/hooks'):
+    # Symlink to git hooks. Worktrees share the hooks of the main checkout.
+    if (os.path.exists('git_hooks') and os.path.exists('.git/hooks') and
+            not os.path.islink('.git/hooks')):
         LOG.info("Installing git hooks")
         shutil.rmtree('.git/hooks')
         os.symlink('../git_hooks', '.git/hooks')
 
 
-def update_repo(repo):
-    """ Safely update repo and submodules (doesn't overwrite changes) """
-    LOG.info("Updating %s", repo)
-    # Update the repo safely (don't discard changes)
-    subprocess.call(['git', 'pull', '--ff-only'])
-    # Update any submodules
-    subprocess.call(['git', 'submodule', 'update', '--init',
-                    '--recursive'])
+def mirror_path(url):
+    """ Get the path of the mirror of a remote in the cache """
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return cache_dir('mirrors', '%s-%s.git' % (repo_name_from_url(url),
+                                               digest))
 
 
-def create_virtualenv(env):
+def update_mirror(url, run_id):
     """
-    Create a virtualenv, or link to the correct virtualenv
+    Create or refresh the local bare mirror of a remote
+
+    A mirror is fetched at most once per unbox run, no matter how many repos
+    or processes ask for it.
 
     Parameters
     ----------
-    env : dict
-        The 'env' key from the config file. Contains 'path' and 'args'.
+    url : str
+        The url of the remote
+    run_id : str
+        Unique id of the current unbox run
 
     Returns
     -------
-    virtualenv : str
-        The absolute path to the created virtualenv
+    mirror : str
+        The path to the mirror
 
     """
-    if not os.path.exists(env['path']):
-        LOG.info("Creating virtualenv %s", env['path'])
-        # If virtualenv command exists, use that
-        if find_executable('virtualenv') is not None:
-            cmd = ['virtualenv'] + env['args'] + [env['path']]
-            subprocess.check_call(cmd)
+    mirror = mirror_path(url)
+    with file_lock(mirror + '.lock'):
+        stamp = os.path.join(mirror, 'devbox-run')
+        if not os.path.exists(mirror):
+            LOG.info("Mirroring %s", url)
+            subprocess.check_call(['git', 'clone', '-q', '--mirror', url,
+                                   mirror])
         else:
-            # Otherwise, download virtualenv from pypi
-            path = urlretrieve(VENV_URL)[0]
-            subprocess.check_call(['tar', 'xzf', path])
-            subprocess.check_call(
-                [sys.executable, "virtualenv-%s/virtualenv.py" % VENV_VERSION]
-                + env['args'] + [env['path']])
-            os.unlink(path)
-            shutil.rmtree("virtualenv-%s" % VENV_VERSION)
-
-    return os.path.abspath(env['path'])
+            if os.path.exists(stamp):
+                with open(stamp, 'r') as infile:
+                    if infile.read() == run_id:
+                        return mirror
+            LOG.info("Fetching mirror of %s", url)
+            subprocess.check_call(['git', '--git-dir', mirror, 'fetch', '-q',
+                                   '--prune', 'origin'])
+        with open(stamp, 'w') as outfile:
+            outfile.write(run_id)
+    return mirror
 
 
-def unbox(repo, dest=None, no_deps=False, *parents):
+def clone_repo(repo, dest, options=None):
     """
-    Set up a repository for development
+    Clone a repository
 
     Parameters
     ----------
     repo : str
-        The url of the git repository, or a path to the already cloned repo
-    dest : str or None
-        The directory to clone into, or None to use the default
-    no_deps : bool
-        If True, don't clone and set up dependency repos
-    *parents : list
-        Peer repositories to install into
+        The url of the repository
+    dest : str
+        The directory to clone into
+    options : dict, optional
+        The unbox options. If 'mirror' is set, objects are borrowed from a
+        local mirror of the remote (or copied, if 'dissociate' is also set).
 
     """
-    parents = list(parents)
-    if os.path.exists(repo) and dest is None:
-        # 'repo' is a file path, not a git url
-        dest = repo
-    else:
-        if not dest:
-            dest = repo_name_from_url(repo)
+    options = options or {}
+    LOG.info("Cloning %s", repo)
+    cmd = ['git', 'clone']
+    if options.get('mirror'):
+        mirror = update_mirror(repo, options['run_id'])
+        cmd.extend(['--reference', mirror])
+        if options.get('dissociate'):
+            cmd.append('--dissociate')
+    subprocess.check_call(cmd + [repo, dest])
 
-    if not os.path.exists(dest):
-        LOG.info("Cloning %s", repo)
-        subprocess.check_call(['git', 'clone', repo, dest])
 
-    with pushd(dest):
-        update_repo(repo)
-        conf = load_conf()
-        run_commands(conf.get('pre_setup', []))
-        setup_git_hooks()
+def submodule_commits():
+    """ Get the checked out commit of every submodule, recursively """
+    commits = {}
+    output = check_output(['git', 'submodule', 'status', '--recursive'])
+    for line in output.splitlines():
+        fields = line[1:].split()
+        if len(fields) >= 2:
+            commits[fields[1]] = fields[0]
+    return commits
 
-        # If python, set up a virtualenv
-        if conf.get('env'):
-            create_virtualenv(conf['env'])
-
-        if 'parent' in conf:
-            parents.append(conf['parent'])
-
-    # Install other devbox repos, if any
-    if not no_deps:
-        for dep in conf.get('dependencies', []):
-            LOG.info("Setting up dependency %s", dep)
-            unbox(dep, None, no_deps, dest, *parents)
-
-    # Install self into any parent virtualenvs
-    for install_dir in [dest] + parents:
-        LOG.info("Installing into %s", install_dir)
-        dest_conf = load_conf(install_dir)
-        venv = dest_conf.get('env')
-        if venv is not None:
-            venv['path'] = os.path.join(os.path.abspath(install_dir),
-                                        venv['path'])
-        with pushd(dest):
-            run_commands(conf.get('post_setup', []), venv)
 
-LEVEL_MAP = {
-    'debug': logging.DEBUG,
-    'info': logging.INFO,
-    'warn': logging.WARN,
-    'error': logging.ERROR,
-    'critical': logging.CRITICAL,
-}
+def submodule_urls(directory):
+    """
+    Get the initialized submodules of a repository
+
+    Returns
+    -------
+    submodules : list
+        List of (path, url) for each submodule that has been initialized with
+        ``git submodule init``
+
+    """
+    if not os.path.exists(os.path.join(directory, '.gitmodules')):
+        return []
+    try:
+        paths = check_output(['git', 'config', '-f', '.gitmodules',
+                              '--get-regexp', r'^submodule\..*\.path$'],
+                             cwd=directory)
+        urls = check_output(['git', 'config', '--get-regexp',
+                             r'^submodule\..*\.url$'], cwd=directory)
+    except subprocess.CalledProcessError:
+        return []
+    names = {}
+    for line in urls.splitlines():
+        key, url = line.split(None, 1)
+        names[key[len('submodule.'):-len('.url')]] = url
+    submodules = []
+    for line in paths.splitlines():
+        key, path = line.split(None, 1)
+        name = key[len('submodule.'):-len('.path')]
+        if name in names:
+            submodules.append((path, names[name]))
+    return submodules
+
+
+def update_submodule(job):
+    """
+    Check out one submodule, fetching it if needed
+
+    Parameters
+    ----------
+    job : tuple
+        (directory, path, url, options) where directory is the repository
+        that contains the submodule, path is the submodule path in it, url is
+        the submodule remote and options are the unbox options
+
+    Returns
+    -------
+    retcode : int
+        The exit code of git
+    output : str
+        The output of git
+
+    """
+    directory, path, url, options = job
+    cmd = ['git', 'submodule', 'update', '--init']
+    if options.get('mirror'):
+        try:
+            mirror = update_mirror(url, options['run_id'])
+        except subprocess.CalledProcessError as e:
+            return e.returncode, "Could not mirror %s: %s" % (url, e)
+        cmd.extend(['--reference', mirror])
+        if options.get('dissociate'):
+            cmd.append('--dissociate')
+    with span('update_submodule', repo=url, path=os.path.join(directory,
+                                                              path)):
+        proc = subprocess.Popen(cmd + ['--', path], cwd=directory,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+    return proc.returncode, output.decode('utf-8', 'replace')
+
+
+def update_submodules(options=None):
+    """
+    Initialize and check out the submodules of the current repo
+
+    The submodules are found once per level of nesting, and all the
+    submodules on a level are fetched and checked out at the same time. A
+    submodule that fails is reported and its own submodules are skipped, but
+    the others are still updated.
+
+    Parameters
+    ----------
+    options : dict, optional
+        The unbox options. 'jobs' is the number of submodules to update at
+        once (default number of cpus). If 'mirror' is set, objects are
+        borrowed from the mirror of each submodule's remote.
+
+    Returns
+    -------
+    failed : list
+        The paths of the submodules that could not be updated
+
+    """
+    options = options or {}
+    failed = []
+    level = [os.curdir]
+    while level:
+        jobs = []
+        for directory in level:
+            subprocess.call(['git', 'submodule', 'init', '-q'],
+                            cwd=directory)
+            for path, url in submodule_urls(directory):
+                jobs.append((directory, path, url, options))
+        if not jobs:
+            break
+        pool = ThreadPool(min(len(jobs), options.get('jobs') or
+                              cpu_count()))
+        try:
+            results = pool.map(update_submodule, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        level = []
+        for (directory, path, _, _), (retcode, output) in zip(jobs, results):
+            path = os.path.normpath(os.path.join(directory, path))
+            if retcode == 0:
+                level.append(path)
+            else:
+                LOG.error("Failed to update submodule %s:\n%s", path,
+                          output.rstrip())
+                failed.append(path)
+    return failed
+
+
+def update_repo(repo, pin=None, cloned=False, options=None):
+    """
+    Safely update repo and submodules (doesn't overwrite changes)
+
+    Parameters
+    ----------
+    repo : str
+        The url of the repository, for logging
+    pin : dict, optional
+        The entry for this repo from the lock file. If present, the repo is
+        moved to the pinned commit instead of pulled. If it is already there,
+        the fetch and the submodule update are skipped.
+    cloned : bool, optional
+        True if the repo was just cloned (default False)
+    options : dict, optional
+        The unbox options for :meth:`~update_submodules`
+
+    Returns
+    -------
+    entry : dict
+        The lock file entry for the repo's resolved commits
+
+    """
+    if pin is not None and not cloned:
+        if check_output(['git', 'rev-parse', 'HEAD']) == pin['commit']:
+            LOG.info("%s is at its pinned commit", repo)
+            return pin
+    LOG.info("Updating %s", repo)
+    if pin is None:
+        # Update the repo safely (don't discard changes)
+        subprocess.call(['git', 'pull', '--ff-only'])
+    else:
+        commit = pin['commit'] + '^{commit}'
+        if subprocess.call(['git', 'cat-file', '-e', commit]) != 0:
+            subprocess.call(['git', 'fetch'])
+        if cloned:
+            # There are no local changes to lose in a fresh clone
+            cmd = ['git', 'reset', '-q', '--hard', pin['commit']]
+        else:
+            cmd = ['git', 'merge', '--ff-only', pin['commit']]
+        retcode = subprocess.call(cmd)
+        if retcode != 0:
+            # Don't let the next rev-parse pin whatever commit we are on
+            LOG.error("Could not move %s to its pinned commit %s. Merge or "
+                      "rebase its local commits, or run with --update-lock.",
+                      repo, pin['commit'])
+            raise subprocess.CalledProcessError(retcode, cmd)
+    update_submodules(options)
+    return {
+        'commit': check_output(['git', 'rev-parse', 'HEAD']),
+        'submodules': submodule_commits(),
+    }
+
+
+def split(command):
+    """ Split a command from the conf file into a list of arguments """
+    if isinstance(command, dict):
+        command = command['command']
+    if isinstance(command, list):
+        return command
+    # Hacking around a unicode bug with shlex in old versions of python
+    if sys.version_info[0] < 3:
+        command = command.encode('utf-8')
+    return shlex.split(command)
+
+
+def requirement_files(commands):
+    """ Find the requirement files that pip commands install from """
+    filenames = []
+    for command in commands:
+        args = split(command)
+        if not args or os.path.basename(args[0]) != 'pip':
+            continue
+        for i, arg in enumerate(args[:-1]):
+            if arg in ('-r', '--requirement'):
+                filenames.append(args[i + 1])
+        filenames.extend(arg.split('=', 1)[1] for arg in args if
+                         arg.startswith('--requirement='))
+    return filenames
+
+
+def venv_key(env, commands):
+    """
+    Hash everything that determines what a virtualenv will contain
+
+    That is the interpreter, the virtualenv arguments, the contents of the
+    requirement files that the setup commands install, and the repository
+    that owns the virtualenv (the current directory). The repository is
+    identified by its url (see :meth:`~lock_key`) and its project files,
+    because its own install and those of its dependencies end up in the
+    virtualenv too.
+
+    """
+    data = [sys.version, env.get('args', []),
+            lock_key(os.path.abspath(os.curdir))]
+    for filename in requirement_files(commands) + list(PROJECT_FILES):
+        if os.path.exists(filename):
+            with open(filename, 'rb') as infile:
+                data.append([filename, hashlib.sha1(infile.read())
+                             .hexdigest()])
+    return hashlib.sha1(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+def clone_tree(source, dest):
+    """ Copy a directory, sharing blocks copy-on-write where supported """
+    cmd = None
+    if sys.platform.startswith('linux'):
+        cmd = ['cp', '-a', '--reflink=auto', source, dest]
+    elif sys.platform == 'darwin':
+        cmd = ['cp', '-Rpc', source, dest]
+    if cmd is None or subprocess.call(cmd) != 0:
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        shutil.copytree(source, dest, symlinks=True)
+
+
+def relocate_venv(path, prefix, moves=()):
+    """
+    Fix up the paths in a virtualenv that was copied from somewhere else
+
+    Parameters
+    ----------
+    path : str
+        The virtualenv
+    prefix : str
+        The absolute path it was copied from
+    moves : list, optional
+        Other (old, new) absolute paths to replace, such as the workspace of
+        the repos installed into it in editable mode
+
+    """
+    path = os.path.abspath(path)
+    # Longest first, so a virtualenv inside a moved workspace gets its own
+    # new path
+    moves = sorted([(prefix, path)] + [move for move in moves if
+                                       move[0] != move[1]],
+                   key=lambda move: len(move[0]), reverse=True)
+    replacements = dict((old.encode('utf-8'), new.encode('utf-8')) for
+                        old, new in moves)
+    pattern = re.compile(b'|'.join(re.escape(old.encode('utf-8')) for
+                                   old, _ in moves))
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            filename = os.path.join(dirpath, name)
+            if os.path.islink(filename):
+                target = os.readlink(filename)
+                for old, new in moves:
+                    if target.startswith(old):
+                        os.unlink(filename)
+                        os.symlink(new + target[len(old):], filename)
+                        break
+                continue
+            if name in dirnames:
+                continue
+            in_bin = os.path.basename(dirpath) in ('bin', 'Scripts')
+            editable = (name.startswith('__editable__') or
+                        name == 'direct_url.json')
+            if not in_bin and not editable and not name.endswith(
+                    ('.pth', '.egg-link', '.cfg')):
+                continue
+            with open(filename, 'rb') as infile:
+                data = infile.read()
+            # Skip binaries
+            if b'\0' in data[:1024] or not pattern.search(data):
+                continue
+            with open(filename, 'wb') as outfile:
+                outfile.write(pattern.sub(
+                    lambda match: replacements[match.group(0)], data))
+
+
+def restore_venv(path, key):
+    """
+    Copy the snapshot of a virtualenv from the cache, if there is one
+
+    Returns
+    -------
+    restored : bool
+
+    """
+    snapshot = cache_dir('venvs', key)
+    manifest = os.path.join(snapshot, VENV_MANIFEST)
+    if not os.path.exists(manifest):
+        return False
+    LOG.info("Restoring virtualenv %s from the cache", path)
+    with open(manifest, 'r') as infile:
+        prefix = json.load(infile)['prefix']
+    clone_tree(snapshot, path)
+    os.unlink(os.path.join(path, VENV_MANIFEST))
+    relocate_venv(path, prefix)
+    return True
+
+
+def save_venv(path, key):
+    """ Store a snapshot of a fully installed virtualenv in the cache """
+    snapshot = cache_dir('venvs', key)
+    if not os.path.exists(path) or os.path.exists(snapshot):
+        return
+    with file_lock(snapshot + '.lock'):
+        if os.path.exists(snapshot):
+            return
+        LOG.info("Saving a snapshot of virtualenv %s", path)
+        tmp_path = snapshot + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        clone_tree(path, tmp_path)
+        with open(os.path.join(tmp_path, VENV_MANIFEST), 'w') as outfile:
+            json.dump({'prefix': os.path.abspath(path)}, outfile)
+        os.rename(tmp_path, snapshot)
+
+
+def site_packages(venv):
+    """ Find the site-packages directories of a virtualenv """
+    return sorted(glob.glob(os.path.join(venv, 'lib', 'python*',
+                                         'site-packages')))
+
+
+def canonical_name(name):
+    """ Normalize a distribution name for comparisons """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def pinned_requirements(filenames):
+    """ Find the name==version requirements in requirement files """
+    pins = {}
+    for filename in filenames:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'r') as infile:
+            for line in infile:
+                line = line.split('#', 1)[0].split(';', 1)[0].strip()
+                match = re.match(r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*==\s*'
+                                 r'([^\s,]+)$', line)
+                if match:
+                    pins[canonical_name(match.group(1))] = match.group(2)
+    return pins
+
+
+def store_key(dist_info, site_dir):
+    """ Key of an installed distribution in the package store """
+    python = os.path.basename(os.path.dirname(site_dir))
+    name = os.path.basename(dist_info)[:-len('.dist-info')]
+    return '%s-%s-%s-%s' % (name, python, sys.platform, platform.machine())
+
+
+# Files that describe one particular installation
+STORE_SKIP = ('RECORD', 'INSTALLER', 'REQUESTED', 'direct_url.json')
+SCRIPT_TEMPLATE = """#!%(python)s
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from %(module)s import %(name)s
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw|\\.exe)?$', '', sys.argv[0])
+    sys.exit(%(func)s())
+"""
+
+
+def file_hash(filename):
+    """ Hash a file the way wheel RECORD files do """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(65536), b''):
+            sha.update(chunk)
+    digest = base64.urlsafe_b64encode(sha.digest()).rstrip(b'=')
+    return 'sha256=' + digest.decode('ascii')
+
+
+def read_record(record):
+    """ Generate the (path, hash) of each file in a RECORD file """
+    with open(record, 'r') as infile:
+        for line in infile:
+            path, digest = (line.rsplit(',', 2) + ['', ''])[:2]
+            if path:
+                yield path, digest
+
+
+def entry_points(dist_info):
+    """ Get the console and gui scripts of an installed distribution """
+    filename = os.path.join(dist_info, 'entry_points.txt')
+    scripts = {}
+    if os.path.exists(filename):
+        parser = RawConfigParser()
+        parser.optionxform = str
+        parser.read(filename)
+        for section in ('console_scripts', 'gui_scripts'):
+            if parser.has_section(section):
+                scripts.update(parser.items(section))
+    return scripts
+
+
+def write_scripts(venv, dist_info):
+    """
+    Generate the entry point scripts of a distribution in a virtualenv
+
+    These are the scripts that pip writes to ``bin`` when it installs the
+    distribution, with the virtualenv's python in their shebang.
+
+    """
+    python = os.path.join(os.path.abspath(venv), 'bin', 'python')
+    for script, spec in entry_points(dist_info).items():
+        module, _, func = spec.split('[', 1)[0].strip().partition(':')
+        func = func.strip() or 'main'
+        filename = os.path.join(venv, 'bin', script)
+        with open(filename, 'w') as outfile:
+            outfile.write(SCRIPT_TEMPLATE % {
+                'python': python,
+                'module': module.strip(),
+                'name': func.split('.', 1)[0],
+                'func': func,
+            })
+        os.chmod(filename, 0o755)
+
+
+def dist_files(dist_info):
+    """
+    List the files of an installed distribution that can be shared
+
+    Files outside of site-packages and compiled bytecode are not shared.
+    Scripts have the path of the virtualenv in them, so only distributions
+    whose scripts can be generated from their entry points (see
+    :meth:`~write_scripts`) are shared.
+
+    Returns
+    -------
+    files : dict or None
+        Mapping of the path of each file, relative to site-packages, to its
+        hash from RECORD. None if the distribution can't be shared, like
+        editable installs.
+
+    """
+    if os.path.exists(os.path.join(dist_info, 'direct_url.json')):
+        with open(os.path.join(dist_info, 'direct_url.json'), 'r') as infile:
+            if json.load(infile).get('dir_info', {}).get('editable'):
+                return None
+    record = os.path.join(dist_info, 'RECORD')
+    if not os.path.exists(record):
+        return None
+    scripts = entry_points(dist_info)
+    files = {}
+    for path, digest in read_record(record):
+        if os.path.isabs(path):
+            continue
+        if path.startswith('..'):
+            if os.path.basename(path) not in scripts:
+                return None
+            continue
+        if path.endswith('.pyc') or os.path.basename(path) in STORE_SKIP:
+            continue
+        files[os.path.normpath(path)] = digest
+    return files
+
+
+def link_file(source, dest):
+    """ Replace dest with a hardlink to source """
+    tmp_path = dest + '.devbox-link'
+    os.link(source, tmp_path)
+    os.rename(tmp_path, dest)
+
+
+def store_packages(venv):
+    """
+    Share the installed distributions of a virtualenv with the package store
+
+    Distributions that are already in the store are replaced with hardlinks
+    to it. New ones are added to the store by hardlinking them in. Files in
+    the store are made read-only, so they can't be changed in place through
+    one of the virtualenvs. Only files that match the hash in their RECORD
+    are shared, so files that were changed after the install stay as they
+    are, and aren't put in the store.
+
+    """
+    for site_dir in site_packages(venv):
+        for dist_info in glob.glob(os.path.join(site_dir, '*.dist-info')):
+            files = dist_files(dist_info)
+            if not files:
+                continue
+            store = cache_dir('store', store_key(dist_info, site_dir))
+            with file_lock(store + '.lock'):
+                complete = os.path.exists(os.path.join(store, 'RECORD'))
+                stored_files = {}
+                if complete:
+                    stored_files = dict(
+                        (os.path.normpath(path), digest) for path, digest in
+                        read_record(os.path.join(store, 'RECORD')))
+                matches = True
+                try:
+                    for path, digest in sorted(files.items()):
+                        source = os.path.join(site_dir, path)
+                        stored = os.path.join(store, path)
+                        if not os.path.isfile(source):
+                            continue
+                        if not digest or file_hash(source) != digest:
+                            matches = False
+                            continue
+                        if not complete:
+                            if not os.path.isdir(os.path.dirname(stored)):
+                                os.makedirs(os.path.dirname(stored))
+                            if not os.path.exists(stored):
+                                os.link(source, stored)
+                                mode = os.stat(stored).st_mode
+                                os.chmod(stored, mode & ~0o222)
+                        elif (stored_files.get(path) == digest and
+                              os.path.exists(stored) and
+                              not os.path.samefile(source, stored)):
+                            link_file(stored, source)
+                except OSError as e:
+                    # Probably on a different filesystem than the cache
+                    LOG.warning("Could not link %s into the package store: "
+                                "%s", dist_info, e)
+                    continue
+                if not complete and matches:
+                    shutil.copy(os.path.join(dist_info, 'RECORD'),
+                                os.path.join(store, 'RECORD'))
+
+
+def link_from_store(venv, requirements):
+    """
+    Install pinned requirements into a virtualenv from the package store
+
+    Each ``name==version`` requirement that is in the store and not in the
+    virtualenv is hardlinked into site-packages and its scripts are
+    generated in ``bin``, so pip finds it already installed.
+
+    Parameters
+    ----------
+    venv : str
+        Path to the virtualenv
+    requirements : list
+        The requirement files that will be installed into it
+
+    """
+    pins = pinned_requirements(requirements)
+    for site_dir in site_packages(venv):
+        installed = set(canonical_name(os.path.basename(path).split('-')[0])
+                        for path in glob.glob(os.path.join(site_dir,
+                                                           '*.dist-info')))
+        tag = '-%s-%s-%s' % (os.path.basename(os.path.dirname(site_dir)),
+                             sys.platform, platform.machine())
+        for store in glob.glob(cache_dir('store', '*' + tag)):
+            record = os.path.join(store, 'RECORD')
+            name, version = os.path.basename(store)[:-len(tag)].split('-', 1)
+            name = canonical_name(name)
+            if (pins.get(name) != version or name in installed or
+                    not os.path.exists(record)):
+                continue
+            LOG.debug("Linking %s %s from the package store", name, version)
+            dist_info = None
+            for path, _ in read_record(record):
+                path = os.path.normpath(path)
+                stored = os.path.join(store, path)
+                if path.startswith('..') or not os.path.isfile(stored):
+                    continue
+                dest = os.path.join(site_dir, path)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                os.link(stored, dest)
+                if path.endswith('.dist-info' + os.sep + 'METADATA'):
+                    dist_info = os.path.dirname(dest)
+            if dist_info is not None:
+                shutil.copy(record, os.path.join(dist_info, 'RECORD'))
+                with open(os.path.join(dist_info, 'INSTALLER'),
+                          'w') as outfile:
+                    outfile.write('devbox\n')
+                write_scripts(venv, dist_info)
+
+
+def create_virtualenv(env, options=None):
+    """
+    Create a virtualenv, or link to the correct virtualenv
+
+    Parameters
+    ----------
+    env : dict
+        The 'env' key from the config file. Contains 'path' and 'args'.
+    options : dict, optional
+        The unbox options, for downloading virtualenv. If it has a
+        'venv_key', the virtualenv is copied from the snapshot with that key
+        when there is one.
+
+    Returns
+    -------
+    virtualenv : str
+        The absolute path to the created virtualenv. A new one is given a
+        new id (see :meth:`~venv_id`).
+
+    """
+    options = options or {}
+    if os.path.exists(env['path']):
+        return os.path.abspath(env['path'])
+    if not (options.get('venv_key') and
+            restore_venv(env['path'], options['venv_key'])):
+        LOG.info("Creating virtualenv %s", env['path'])
+        # If virtualenv command exists, use that
+        if find_executable('virtualenv') is not None:
+            cmd = ['virtualenv'] + env['args'] + [env['path']]
+            subprocess.check_call(cmd)
+        else:
+            # Otherwise, download virtualenv from pypi
+            path = download_conf(VENV_URL, options)
+            source = cache_dir('virtualenv-%s' % VENV_VERSION)
+            with file_lock(source + '.lock'):
+                if not os.path.exists(source):
+                    subprocess.check_call(['tar', 'xzf', path, '-C',
+                                           os.path.dirname(source)])
+            subprocess.check_call(
+                [sys.executable, os.path.join(source, 'virtualenv.py')]
+                + env['args'] + [env['path']])
+    if os.path.exists(env['path']):
+        # Stamps from an earlier virtualenv at this path must not match
+        with open(os.path.join(env['path'], VENV_ID), 'w') as outfile:
+            outfile.write(uuid.uuid4().hex + '\n')
+    return os.path.abspath(env['path'])
+
+
+def map_jobs(func, jobs, processes=None):
+    """ Map a function over jobs on a process pool when there is enough work """
+    if len(jobs) <= 1 or processes == 1:
+        return [func(job) for job in jobs]
+    pool = Pool(processes)
+    try:
+        if TRACE is None:
+            return pool.map(func, jobs)
+        # Each worker records its own events and sends them back
+        results = []
+        for result, events in pool.map(run_traced, [(func, job) for job in
+                                                    jobs]):
+            TRACE.extend(events)
+            results.append(result)
+        return results
+    finally:
+        pool.close()
+        pool.join()
+
+
+def default_dest(repo, dest=None):
+    """ Get the directory a repository will be unboxed into """
+    if os.path.exists(repo) and dest is None:
+        # 'repo' is a file path, not a git url
+        return repo
+    return dest or repo_name_from_url(repo)
+
+
+def conf_options(conf, options=None):
+    """ Add the settings from a repo's conf file to the unbox options """
+    options = dict(options or {})
+    options['checksums'] = conf.get('checksums', {})
+    if conf.get('env') and options.get('venv_cache'):
+        options['venv_key'] = venv_key(conf['env'],
+                                       conf.get('post_setup', []))
+    return options
+
+
+def prepare_repo(job):
+    """
+    Clone, update, and run the setup of a repository that only affects itself
+
+    This clones the repo if needed, updates it, runs the pre_setup commands,
+    installs the git hooks and creates the virtualenv. It does not touch any
+    other repository, so it can run in parallel with other repos.
+
+    Parameters
+    ----------
+    job : tuple
+        (repo, dest, pin, options) where repo is the git url or path, dest is
+        the directory to clone into, pin is the repo's entry in the lock file
+        (or None), and options is the dict of unbox options
+
+    Returns
+    -------
+    conf : dict
+        The devbox conf of the repository
+    entry : dict
+        The lock file entry for the repository
+
+    """
+    repo, dest, pin, options = job
+    cloned = False
+    if not os.path.exists(dest):
+        with span('clone_repo', repo=repo, dest=dest):
+            clone_repo(repo, dest, options)
+        cloned = True
+
+    with pushd(dest):
+        with span('update_repo', repo=repo, dest=dest):
+            entry = update_repo(repo, pin, cloned, options)
+        conf = load_conf()
+        options = conf_options(conf, options)
+        run_commands(conf.get('pre_setup', []), options=options)
+        with span('setup_git_hooks', repo=repo):
+            setup_git_hooks()
+
+        # If python, set up a virtualenv
+        if conf.get('env'):
+            with span('create_virtualenv', repo=repo,
+                      venv=conf['env']['path']):
+                create_virtualenv(conf['env'], options)
+    return conf, entry
+
+
+def resolve_dependencies(repo, dest=None, no_deps=False, jobs=None,
+                         lock=None, options=None):
+    """
+    Prepare a repository and find all of its dependencies
+
+    The dependency graph is walked breadth-first. Each level is prepared in
+    parallel with :meth:`~prepare_repo`, which provides the conf files that
+    list the next level. A repository that is reachable by several paths is
+    only prepared once.
+
+    Parameters
+    ----------
+    repo : str
+        The url of the git repository, or a path to the already cloned repo
+    dest : str or None
+        The directory to clone into, or None to use the default
+    no_deps : bool
+        If True, don't clone and set up dependency repos
+    jobs : int, optional
+        The number of repositories to prepare at once (default number of
+        cpus)
+    lock : dict, optional
+        The pinned commits, keyed by url (see :meth:`~lock_key`). The
+        resolved commits of every repo are added to it. If None, they are
+        read from the lock file of the repository, once it is cloned.
+    options : dict, optional
+        The unbox options that are passed to :meth:`~prepare_repo`
+
+    Returns
+    -------
+    root : str
+        The directory of the repository
+    graph : dict
+        Mapping of each directory to a dict with the 'url', 'conf', and
+        'dependencies' (the list of directories it depends on)
+
+    """
+    root = os.path.normpath(default_dest(repo, dest))
+    read_lock = lock is None
+    if read_lock:
+        lock = load_lock(root)
+    graph = {}
+    level = [(repo, root)]
+    depth = 0
+    while level:
+        with span('resolve_dependencies', depth=depth,
+                  repos=[path for _, path in level]):
+            keys = [lock_key(url) for url, _ in level]
+            results = map_jobs(prepare_repo, [(url, path, lock.get(key),
+                                               options) for (url, path), key
+                                              in zip(level, keys)], jobs)
+        if read_lock and depth == 0 and not lock:
+            # A fresh clone of the repository has only just brought its lock
+            # file
+            lock.update(load_lock(root))
+        depth += 1
+        next_level = []
+        confs = []
+        for (url, path), key, (conf, entry) in zip(level, keys, results):
+            graph[path] = {'url': url, 'conf': conf, 'dependencies': []}
+            lock[key] = entry
+            confs.append(conf)
+        for (url, path), conf in zip(level, confs):
+            if no_deps:
+                continue
+            for dep in conf.get('dependencies', []):
+                dep_path = os.path.normpath(default_dest(dep))
+                graph[path]['dependencies'].append(dep_path)
+                if dep_path not in graph and dep_path not in [
+                        job[1] for job in next_level]:
+                    LOG.info("Setting up dependency %s", dep)
+                    next_level.append((dep, dep_path))
+        level = next_level
+    return root, graph
+
+
+def install_order(root, graph):
+    """
+    Sort the dependency graph so that each repo comes after its dependencies
+
+    Raises
+    ------
+    exc : :class:`ValueError`
+        If the dependencies have a cycle
+
+    """
+    order = []
+    visiting = []
+
+    def visit(path):
+        """ Depth-first post-order traversal """
+        if path in order:
+            return
+        if path in visiting:
+            cycle = visiting[visiting.index(path):] + [path]
+            raise ValueError("Dependency cycle: %s" % ' -> '.join(cycle))
+        visiting.append(path)
+        for dep in graph[path]['dependencies']:
+            visit(dep)
+        visiting.pop()
+        order.append(path)
+    visit(root)
+    return order
+
+
+def install_dirs(path, graph):
+    """
+    Find the repos whose virtualenvs a repo should be installed into
+
+    That is the repo itself, every repo that depends on it (directly or not),
+    and the 'parent' of each of those.
+
+    """
+    dependents = set()
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        for other, node in graph.items():
+            if current in node['dependencies'] and other not in dependents:
+                dependents.add(other)
+                stack.append(other)
+    dirs = []
+    for repo in [path] + sorted(dependents - set([path])):
+        for install_dir in (repo, graph[repo]['conf'].get('parent')):
+            if install_dir is not None and install_dir not in dirs:
+                dirs.append(install_dir)
+    return dirs
+
+
+def install_queues(root, graph):
+    """
+    Group the installs by the virtualenv they go into
+
+    Returns
+    -------
+    queues : list
+        List of (install_dir, paths) where paths are the repos to install
+        into the virtualenv of install_dir, dependencies first
+
+    """
+    queues = []
+    indexes = {}
+    for path in install_order(root, graph):
+        for install_dir in install_dirs(path, graph):
+            if install_dir not in indexes:
+                indexes[install_dir] = len(queues)
+                queues.append((install_dir, []))
+            queues[indexes[install_dir]][1].append(path)
+    return queues
+
+
+def install_lock(path):
+    """
+    Lock a virtualenv or repo so only one process installs into it at a time
+    """
+    key = hashlib.sha1(os.path.realpath(path).encode('utf-8')).hexdigest()
+    return file_lock(cache_dir('locks', key + '.lock'))
+
+
+def install_into(job):
+    """
+    Run the post_setup commands of several repos for one virtualenv
+
+    Parameters
+    ----------
+    job : tuple
+        (install_dir, paths, confs, options) where install_dir is the repo
+        that owns the virtualenv, paths are the repos to install in order,
+        confs maps each path to its devbox conf and options are the unbox
+        options
+
+    """
+    install_dir, paths, confs, options = job
+    venv = load_conf(install_dir).get('env')
+    if venv is not None:
+        venv['path'] = os.path.join(os.path.abspath(install_dir),
+                                    venv['path'])
+    for path in paths:
+        LOG.info("Installing %s into %s", path, install_dir)
+        with span('install', repo=path, venv=install_dir):
+            install_repo(path, confs[path], venv, install_dir == path,
+                         options)
+
+
+def install_repo(path, conf, venv, own, options):
+    """ Run the post_setup commands of a repo for one virtualenv """
+    commands = conf.get('post_setup', [])
+    with pushd(path):
+        repo_options = conf_options(conf, options)
+        if venv is None:
+            run_commands(commands, venv, repo_options)
+            return
+        # The lock is on the real path, so a virtualenv shared through
+        # 'parent' or by concurrent unboxes is still only written to by one
+        # pip at a time. A local install also builds in the repo (e.g. its
+        # .egg-info), so the repo is locked as well, always before the
+        # virtualenv.
+        if installs_local(commands):
+            with install_lock(os.curdir):
+                install_commands(commands, venv, own, repo_options, options)
+        else:
+            install_commands(commands, venv, own, repo_options, options)
+
+
+def install_commands(commands, venv, own, repo_options, options):
+    """ Run the post_setup commands of a repo with its virtualenv locked """
+    with install_lock(venv['path']):
+        if options.get('link_packages'):
+            link_from_store(venv['path'], requirement_files(commands))
+        run_commands(commands, venv, repo_options)
+        if options.get('link_packages'):
+            store_packages(venv['path'])
+        # Once a repo is installed into its own virtualenv, the virtualenv is
+        # complete
+        if own and repo_options.get('venv_key'):
+            save_venv(venv['path'], repo_options['venv_key'])
+
+
+def has_branch(path, branch):
+    """ Check if a repo has a local or remote-tracking branch """
+    with open(os.devnull, 'w') as devnull:
+        for ref in ('refs/heads/' + branch, 'refs/remotes/origin/' + branch):
+            if subprocess.call(['git', 'rev-parse', '--verify', '--quiet',
+                                ref], cwd=path, stdout=devnull) == 0:
+                return True
+    return False
+
+
+def add_worktree(job):
+    """
+    Add a worktree of a repo
+
+    Parameters
+    ----------
+    job : tuple
+        (path, dest, branch) where path is the repo, dest is the directory of
+        the new worktree, and branch is the branch to check out in it, or None
+        to check out the current commit of the repo
+
+    """
+    path, dest, branch = job
+    if os.path.exists(dest):
+        LOG.info("%s already exists", dest)
+        return
+    LOG.info("Adding worktree %s of %s", dest, path)
+    cmd = ['git', 'worktree', 'add', '-q']
+    if branch is None:
+        cmd.extend(['--detach', dest, 'HEAD'])
+    else:
+        cmd.extend([dest, branch])
+    subprocess.check_call(cmd, cwd=path)
+
+
+def seed_venv(source, dest):
+    """
+    Copy the virtualenv of a repo into a worktree of it
+
+    The virtualenv is only copied if the worktree would build the same one,
+    according to :meth:`~venv_key`.
+
+    """
+    conf = load_conf(dest)
+    source_conf = load_conf(source)
+    env, source_env = conf.get('env'), source_conf.get('env')
+    if not env or not source_env:
+        return
+    venv = os.path.join(dest, env['path'])
+    source_venv = os.path.join(source, source_env['path'])
+    if os.path.exists(venv) or not os.path.isdir(source_venv):
+        return
+    with pushd(source):
+        source_key = venv_key(source_env, source_conf.get('post_setup', []))
+    with pushd(dest):
+        key = venv_key(env, conf.get('post_setup', []))
+    if key != source_key:
+        LOG.info("Requirements of %s have changed, not copying its "
+                 "virtualenv", dest)
+        return
+    LOG.info("Copying virtualenv %s to %s", source_venv, venv)
+    with install_lock(source_venv):
+        clone_tree(source_venv, venv)
+    relocate_venv(venv, os.path.abspath(source_venv))
+
+
+def add_worktrees(repo, branch, workspace=None, jobs=None):
+    """
+    Add worktrees of an unboxed repo and its dependencies in a new workspace
+
+    The repo gets a worktree with the branch checked out. Each of its
+    dependencies gets one with the same branch if it has it, and its current
+    commit otherwise. Worktrees share the object store of their repo, and
+    their virtualenvs are copied when the requirements are the same.
+
+    Parameters
+    ----------
+    repo : str
+        The path of the unboxed repo. Its dependencies are found in the
+        workspace (the current directory).
+    branch : str
+        The branch to check out
+    workspace : str, optional
+        The directory of the new workspace (default is the current directory
+        with '@branch' appended)
+    jobs : int, optional
+        The number of worktrees to add at once (default number of cpus)
+
+    Returns
+    -------
+    workspace : str
+        The absolute path of the new workspace
+
+    """
+    if not os.path.isdir(repo):
+        raise ValueError("--worktree needs the path of an unboxed repo, not "
+                         "%r" % repo)
+    repo = os.path.relpath(repo)
+    if not has_branch(repo, branch):
+        raise ValueError("%s has no branch %r" % (repo, branch))
+    if workspace is None:
+        workspace = os.path.abspath(os.curdir) + '@' + re.sub(
+            r'[^A-Za-z0-9_.\-]', '-', branch)
+    workspace = os.path.abspath(workspace)
+    paths = workspace_repos(repo)
+    ensure_dir(workspace)
+    # Worktrees are named after their repo, so they stay in the new
+    # workspace even if the repo is outside the current directory
+    dests = [os.path.join(workspace, os.path.basename(os.path.abspath(path)))
+             for path in paths]
+    jobs_list = []
+    for path, dest in zip(paths, dests):
+        path_branch = branch if has_branch(path, branch) else None
+        jobs_list.append((path, dest, path_branch))
+    map_jobs(add_worktree, jobs_list, jobs)
+    for path, dest in zip(paths, dests):
+        seed_venv(path, dest)
+    return workspace
+
+
+def unbox(repo, dest=None, no_deps=False, jobs=None, update_lock=False,
+          mirror=False, dissociate=False, offline=False, venv_cache=True,
+          link_packages=False, wheelhouse=False, force=False, trace=None,
+          worktree=None):
+    """
+    Set up a repository for development
+
+    Parameters
+    ----------
+    repo : str
+        The url of the git repository, or a path to the already cloned repo
+    dest : str or None
+        The directory to clone into, or None to use the default. With
+        'worktree', the directory of the new workspace.
+    no_deps : bool
+        If True, don't clone and set up dependency repos
+    jobs : int, optional
+        The number of repositories to clone and set up at once (default
+        number of cpus)
+    update_lock : bool, optional
+        If True, pull every repo instead of checking out the commits pinned
+        in the lock file, and write the new commits to the lock file. The
+        lock file is only written with this option. (default False)
+    mirror : bool, optional
+        If True, clone using a per-user mirror of each remote to avoid
+        downloading the same objects again (default False)
+    dissociate : bool, optional
+        If True, copy the objects from the mirror instead of borrowing them
+        (default False)
+    offline : bool, optional
+        If True, setup scripts and virtualenv are only taken from the
+        download cache (default False)
+    venv_cache : bool, optional
+        If True, copy virtualenvs from the snapshots of previously installed
+        virtualenvs with the same interpreter and requirements (default True)
+    link_packages : bool, optional
+        If True, share installed packages between virtualenvs by hardlinking
+        them from a package store in the user cache (default False)
+    wheelhouse : bool, optional
+        If True, pip install commands build any missing wheels into a
+        wheelhouse in the user cache and install from it (default False)
+    force : bool, optional
+        If True, run every setup command even if its inputs haven't changed
+        since it last ran (default False)
+    trace : str, optional
+        If given, record how long each step takes and write it to this file
+        in the Chrome trace-event format
+    worktree : str, optional
+        If given, 'repo' is the path of an unboxed repo. A new workspace is
+        made with worktrees of it and its dependencies on this branch (see
+        :meth:`~add_worktrees`), and unboxed.
+
+    """
+    options = {
+        'run_id': uuid.uuid4().hex,
+        'mirror': mirror,
+        'dissociate': dissociate,
+        'offline': offline,
+        'venv_cache': venv_cache,
+        'link_packages': link_packages,
+        'wheelhouse': cache_dir('wheels') if wheelhouse else None,
+        'jobs': jobs,
+        'force': force,
+    }
+    if trace is not None:
+        start_trace()
+    try:
+        workspace = os.curdir
+        if worktree is not None:
+            with span('add_worktrees', repo=repo, branch=worktree):
+                workspace = add_worktrees(repo, worktree, dest, jobs)
+            repo, dest = os.path.basename(os.path.abspath(repo)), None
+        with pushd(workspace):
+            with span('unbox', repo=repo):
+                _unbox(repo, dest, no_deps, jobs, update_lock, options)
+    finally:
+        if trace is not None:
+            save_trace(trace, stop_trace())
+
+
+def _unbox(repo, dest, no_deps, jobs, update_lock, options):
+    """ Resolve, prepare and install the repositories for :meth:`~unbox` """
+    lock = {} if update_lock else None
+    root, graph = resolve_dependencies(repo, dest, no_deps, jobs, lock,
+                                       options)
+    if update_lock:
+        save_lock(lock, root)
+
+    # Install each repo into its own virtualenv and those of the repos that
+    # depend on it, dependencies first. Each virtualenv is filled in order,
+    # but different virtualenvs are filled at the same time.
+    queues = install_queues(root, graph)
+    confs = dict((path, node['conf']) for path, node in graph.items())
+    map_jobs(install_into, [(install_dir, paths, confs, options) for
+                            install_dir, paths in queues], jobs)
+
+
+def workspace_repos(repo):
+    """
+    Find a repo and the unboxed repos it depends on
+
+    The dependencies are found through the conf files, and the ones that
+    haven't been cloned into the workspace (the current directory) are left
+    out.
+
+    Returns
+    -------
+    paths : list
+        The path of ``repo``, followed by the sorted paths of its
+        dependencies
+
+    """
+    paths = [repo]
+    for path in paths:
+        for dep in load_conf(path).get('dependencies', []):
+            dep_path = os.path.normpath(default_dest(dep))
+            if dep_path not in paths and os.path.isdir(dep_path):
+                paths.append(dep_path)
+    return [repo] + sorted(paths[1:])
+
+
+def workspace_venvs(paths):
+    """ Find the virtualenvs of the repos in a workspace """
+    venvs = []
+    for path in paths:
+        env = load_conf(path).get('env')
+        if env:
+            venv = os.path.normpath(os.path.join(path, env['path']))
+            if venv not in venvs and os.path.isdir(venv):
+                venvs.append(venv)
+    return venvs
+
+
+@contextlib.contextmanager
+def dissociate_objects(paths):
+    """
+    Copy borrowed objects into repos and their submodules for a 'with' block
+
+    Each git directory that borrows objects is repacked with them, and its
+    alternates file is only set aside during the block, so the repos keep
+    borrowing from the mirror afterwards.
+
+    """
+    alternates = []
+    try:
+        for path in paths:
+            git_root = os.path.join(path, '.git')
+            for dirpath, _, filenames in os.walk(git_root):
+                if ('alternates' not in filenames or
+                        os.path.basename(dirpath) != 'info'):
+                    continue
+                git_path = os.path.dirname(os.path.dirname(dirpath))
+                LOG.info("Copying borrowed objects into %s", git_path)
+                subprocess.check_call(['git', '--git-dir', git_path, 'repack',
+                                       '-a', '-d', '-q'])
+                filename = os.path.join(dirpath, 'alternates')
+                with open(filename, 'r') as infile:
+                    alternates.append((filename, infile.read()))
+                os.unlink(filename)
+        yield
+    finally:
+        for filename, data in alternates:
+            with open(filename, 'w') as outfile:
+                outfile.write(data)
+
+
+def pack_dir(job):
+    """
+    Pack a directory of the workspace into a compressed tar file
+
+    Parameters
+    ----------
+    job : tuple
+        (path, archive, excluded) where path is relative to the current
+        directory and excluded is a list of paths inside it to leave out
+
+    """
+    path, archive, excluded = job
+    with span('pack', path=path):
+        cmd = ['tar', 'czf', archive]
+        for exclude in excluded:
+            cmd.append('--exclude=' + exclude)
+        subprocess.check_call(cmd + [path])
+
+
+def unpack_dir(job):
+    """
+    Unpack a directory packed by :meth:`~pack_dir`
+
+    Parameters
+    ----------
+    job : tuple
+        (archive, dest, path, prefix, workspace) where dest is the workspace
+        to unpack into, path is the directory in the archive, prefix is the
+        absolute path of a virtualenv when it was packed (None for repos)
+        and workspace is the absolute path of the workspace it was packed
+        from (or None)
+
+    """
+    archive, dest, path, prefix, workspace = job
+    with span('unpack', path=path):
+        subprocess.check_call(['tar', 'xzf', archive, '-C', dest])
+        if prefix is not None:
+            # Editable installs point into the repos of the old workspace
+            moves = [(workspace, dest)] if workspace else []
+            relocate_venv(os.path.join(dest, path), prefix, moves)
+
+
+def snapshot(repo, archive, jobs=None):
+    """
+    Pack an unboxed workspace into an archive
+
+    The archive is a tar file with a compressed tar of each repo and each
+    virtualenv, so they can be unpacked in parallel, and a manifest. Repos are
+    packed with their git directories, local changes and setup stamps.
+    Objects that a repo borrows from the mirror cache are copied into it
+    first, but it keeps borrowing from the mirror.
+
+    Parameters
+    ----------
+    repo : str
+        The path of the top repository, relative to the workspace (the
+        current directory)
+    archive : str
+        The file to write
+    jobs : int, optional
+        The number of directories to pack at once (default number of cpus)
+
+    """
+    repo = os.path.normpath(repo)
+    paths = workspace_repos(repo)
+    venvs = workspace_venvs(paths)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'root': repo,
+            'workspace': os.path.abspath(os.curdir),
+            'repos': [],
+            'venvs': [],
+        }
+        jobs_list = []
+        for i, path in enumerate(paths):
+            member = os.path.join('repos', '%d.tar.gz' % i)
+            # Compared as absolute paths, so a repo of '.' still leaves out
+            # the virtualenvs inside it
+            excluded = [os.path.join(path, os.path.relpath(venv, path)) for
+                        venv in venvs if os.path.abspath(venv).startswith(
+                            os.path.abspath(path) + os.sep)]
+            jobs_list.append((path, os.path.join(tmpdir, member), excluded))
+            manifest['repos'].append({'path': path, 'archive': member})
+        for i, venv in enumerate(venvs):
+            member = os.path.join('venvs', '%d.tar.gz' % i)
+            jobs_list.append((venv, os.path.join(tmpdir, member), []))
+            manifest['venvs'].append({'path': venv, 'archive': member,
+                                      'prefix': os.path.abspath(venv)})
+        os.makedirs(os.path.join(tmpdir, 'repos'))
+        os.makedirs(os.path.join(tmpdir, 'venvs'))
+        LOG.info("Packing %d repos and %d virtualenvs", len(paths),
+                 len(venvs))
+        with dissociate_objects(paths):
+            map_jobs(pack_dir, jobs_list, jobs)
+        with open(os.path.join(tmpdir, SNAPSHOT_MANIFEST), 'w') as outfile:
+            json.dump(manifest, outfile, indent=2, sort_keys=True)
+        subprocess.check_call(['tar', 'cf', os.path.abspath(archive), '-C',
+                               tmpdir, SNAPSHOT_MANIFEST, 'repos', 'venvs'])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def restore(archive, dest=None, jobs=None, update=True, **kwargs):
+    """
+    Unpack a workspace archived by :meth:`~snapshot`
+
+    Repos and virtualenvs that already exist are left alone. The
+    virtualenvs are fixed up for their new location, including the paths of
+    the repos installed into them in editable mode, and then the workspace
+    is unboxed again, which only runs the steps that are out of date.
+
+    Parameters
+    ----------
+    archive : str
+        The archive file
+    dest : str, optional
+        The workspace directory to unpack into (default current directory)
+    jobs : int, optional
+        The number of directories to unpack at once (default number of cpus)
+    update : bool, optional
+        If False, don't unbox after unpacking (default True)
+    **kwargs :
+        Options for :meth:`~unbox`
+
+    """
+    dest = os.path.abspath(dest or os.curdir)
+    ensure_dir(dest)
+    tmpdir = tempfile.mkdtemp(dir=dest)
+    try:
+        subprocess.check_call(['tar', 'xf', os.path.abspath(archive), '-C',
+                               tmpdir])
+        with open(os.path.join(tmpdir, SNAPSHOT_MANIFEST), 'r') as infile:
+            manifest = json.load(infile)
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version %r" %
+                             manifest.get('version'))
+        # Virtualenvs may be inside repos, so unpack those first
+        for kind in ('repos', 'venvs'):
+            jobs_list = []
+            for item in manifest[kind]:
+                if os.path.exists(os.path.join(dest, item['path'])):
+                    LOG.warning("Not restoring %s, it already exists",
+                                item['path'])
+                    continue
+                jobs_list.append((os.path.join(tmpdir, item['archive']), dest,
+                                  item['path'], item.get('prefix'),
+                                  manifest.get('workspace')))
+            LOG.info("Unpacking %d %s", len(jobs_list), kind)
+            map_jobs(unpack_dir, jobs_list, jobs)
+    finally:
+        shutil.rmtree(tmpdir)
+    if update:
+        with pushd(dest):
+            unbox(manifest['root'], jobs=jobs, **kwargs)
+
+
+LEVEL_MAP = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warn': logging.WARN,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+
+def snapshot_main(args):
+    """ Pack an unboxed workspace into an archive """
+    parser = argparse.ArgumentParser(prog='dunbox snapshot',
+                                     description=snapshot_main.__doc__)
+    parser.add_argument('repo', help="Path of the top repository, relative "
+                        "to the workspace (the current directory)")
+    parser.add_argument('archive', help="File to write")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of directories to pack at once "
+                        "(default number of cpus)")
+    parser.add_argument('-l', '--level', default='info',
+                        choices=LEVEL_MAP.keys(), help="Logging level")
+    args = vars(parser.parse_args(args))
+    LOG.setLevel(LEVEL_MAP[args.pop('level')])
+    logging.basicConfig()
+    snapshot(**args)
+
+
+def restore_main(args):
+    """ Unpack a workspace archive and bring it up to date """
+    parser = argparse.ArgumentParser(prog='dunbox restore',
+                                     description=restore_main.__doc__)
+    parser.add_argument('archive', help="Archive made by 'dunbox snapshot'")
+    parser.add_argument('dest', nargs='?', help="Workspace directory to "
+                        "unpack into (default current directory)")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of directories to unpack at once "
+                        "(default number of cpus)")
+    parser.add_argument('--no-update', action='store_false', dest='update',
+                        help="Don't unbox the workspace after unpacking")
+    parser.add_argument('--offline', action='store_true',
+                        help="Don't download setup scripts or virtualenv, "
+                        "only use the download cache")
+    parser.add_argument('-l', '--level', default='info',
+                        choices=LEVEL_MAP.keys(), help="Logging level")
+    args = vars(parser.parse_args(args))
+    LOG.setLevel(LEVEL_MAP[args.pop('level')])
+    logging.basicConfig()
+    restore(**args)
 
 
 def main(args=None):
     """ Clone and set up a developer repository """
     if args is None:
         args = sys.argv[1:]
-    parser = argparse.ArgumentParser(description=main.__doc__)
+    if args and args[0] == 'snapshot':
+        return snapshot_main(args[1:])
+    elif args and args[0] == 'restore':
+        return restore_main(args[1:])
+    parser = argparse.ArgumentParser(
+        description=main.__doc__, epilog="'dunbox snapshot' and 'dunbox "
+        "restore' pack and unpack a whole workspace (see their --help)")
     parser.add_argument('repo', help="Git url or file path of the repository "
                         "to unbox")
     parser.add_argument('dest', nargs='?', help="Directory to clone into")
     parser.add_argument('--no-deps', action='store_true',
                         help="Do not clone and set up the dependencies")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of repositories to clone and set up at "
+                        "once (default number of cpus)")
+    parser.add_argument('--update-lock', action='store_true',
+                        help="Pull the latest commits instead of the ones "
+                        "pinned in %s, and write the new pins" % LOCK_FILE)
+    parser.add_argument('--mirror', action='store_true',
+                        help="Clone with objects from a local mirror of each "
+                        "remote, kept in the user cache directory")
+    parser.add_argument('--dissociate', action='store_true',
+                        help="With --mirror, copy the objects instead of "
+                        "sharing them with the mirror")
+    parser.add_argument('--offline', action='store_true',
+                        help="Don't download setup scripts or virtualenv, "
+                        "only use the download cache")
+    parser.add_argument('--no-venv-cache', action='store_false',
+                        dest='venv_cache', help="Always build virtualenvs "
+                        "from scratch instead of copying a cached snapshot")
+    parser.add_argument('--link-packages', action='store_true',
+                        help="Share installed packages between virtualenvs "
+                        "with hardlinks to a package store in the user cache")
+    parser.add_argument('--wheelhouse', action='store_true',
+                        help="Build wheels for pip install commands into a "
+                        "wheelhouse in the user cache and install from it")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Run all setup commands, even the ones that "
+                        "ran before with the same inputs")
+    parser.add_argument('--worktree', metavar='BRANCH',
+                        help="Make a new workspace (dest, default is the "
+                        "current directory with @BRANCH appended) with git "
+                        "worktrees of the unboxed repo and its dependencies "
+                        "on BRANCH, and unbox it")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Write a timeline of every step to FILE, in the "
+                        "Chrome trace-event format (open with Perfetto)")
     parser.add_argument('-l', '--level', default='info',
                         choices=LEVEL_MAP.keys(), help="Logging level")
 
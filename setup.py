@@ -50,6 +50,8 @@ if __name__ == "__main__":
             'console_scripts': [
                 'dcreate = devbox.create:main',
                 'dunbox = devbox.unbox:main',
+                'dformat = devbox.autoformat:main',
+                'devbox-lint = devbox.hook:lint_main',
             ],
             'devbox.templates': [
                 'simple = devbox.create:SimpleTemplate',
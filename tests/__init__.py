@@ -1,9 +1,25 @@
 """ Test the unboxing process """
+import glob
+import hashlib
+import io
+import json
 import os
 
 import shutil
 import subprocess
-from mock import patch, call, MagicMock
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from mock import patch, call, ANY, MagicMock
+
+try:
+    # pylint: disable=F0401
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    # pylint: disable=F0401
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from devbox import unbox
 
@@ -36,9 +52,13 @@ class FakeFSTest(unittest.TestCase):
         patch.object(subprocess, 'check_call').start()
         patch.object(subprocess, 'call').start()
         patch.object(subprocess, 'Popen').start()
-        patch.object(unbox, 'urlretrieve').start()
+        patch.object(unbox, 'download').start()
+        patch.object(unbox, 'stamp_key').start()
+        patch.object(unbox, 'has_stamp', return_value=False).start()
+        patch.object(unbox, 'save_stamp').start()
+        patch.object(unbox, 'install_lock').start()
         patch.object(unbox, 'find_executable').start()
-        unbox.urlretrieve.return_value = (MagicMock(), MagicMock())
+        unbox.download.return_value = MagicMock()
         proc = subprocess.Popen.return_value = MagicMock()
         proc.communicate.return_value = (MagicMock(), MagicMock())
 
@@ -89,6 +109,10 @@ class UnboxTest(FakeFSTest):
         patch.object(unbox, 'load_conf').start()
         self.configs = {}
         unbox.load_conf.side_effect = self._getconf
+        patch.object(unbox, 'save_lock').start()
+        proc = subprocess.Popen.return_value
+        proc.returncode = 0
+        proc.communicate.return_value = (b'', b'')
 
     def _getconf(self, directory=None):
         """ Get the devbox config for a directory """
@@ -113,6 +137,7 @@ class UnboxTest(FakeFSTest):
         """ Unbox should set up git hooks if present """
         repo = 'git@github.com:user/repository'
         self._add_path(os.path.join('repository', 'git_hooks'))
+        self._add_path(os.path.join('repository', '.git', 'hooks'))
         os.path.islink.return_value = False
         unbox.main([repo])
         self.assertTrue(call('.git/hooks') in shutil.rmtree.call_args_list)
@@ -180,10 +205,77 @@ class UnboxTest(FakeFSTest):
         command = ['http://my.host.com/path/to/script.py', '--flag']
         commands = [command]
         unbox.run_commands(commands)
-        unbox.urlretrieve.assert_called_with(command[0])
-        command[0] = unbox.urlretrieve()[0]
+        unbox.download.assert_called_with(command[0], None, False)
+        command[0] = unbox.download()
         subprocess.check_call.assert_called_with(command)
 
+    def _build_dir(self):
+        """ Build wheels in /wheels/.build, which has foo.whl in it """
+        patch.object(tempfile, 'mkdtemp', return_value='/wheels/.build').start()
+        patch.object(os, 'listdir', return_value=['foo.whl']).start()
+        patch.object(os, 'rename').start()
+
+    def test_wheelhouse_build(self):
+        """ Missing wheels are built and pip installs from the wheelhouse """
+        patch.object(os.path, 'isdir').start()
+        self._build_dir()
+        self._add_path('requirements.txt')
+        with patch.object(unbox, 'open', create=True) as mock_open:
+            requirements = mock_open.return_value.__enter__.return_value
+            requirements.__iter__.return_value = iter(['foo==1.0\n', '# x\n',
+                                                       'bar\n'])
+            unbox.run_commands(['pip install -r requirements.txt'],
+                               options={'wheelhouse': '/wheels'})
+        wheel = ['pip', 'wheel', '-q', '--find-links', '/wheels',
+                 '--wheel-dir', '/wheels/.build']
+        calls = subprocess.call.call_args_list
+        self.assertTrue(call(wheel + ['foo==1.0']) in calls)
+        self.assertTrue(call(wheel + ['bar']) in calls)
+        # The finished wheels are moved into the wheelhouse
+        os.rename.assert_called_with('/wheels/.build/foo.whl',
+                                     '/wheels/foo.whl')
+        subprocess.check_call.assert_called_with(
+            ['pip', 'install', '--find-links', '/wheels', '-r',
+             'requirements.txt'])
+
+    def test_wheelhouse_no_index(self):
+        """ If the wheelhouse has everything, pip doesn't use the index """
+        patch.object(os.path, 'isdir').start()
+        self._build_dir()
+        subprocess.call.return_value = 0
+        unbox.run_commands(['pip install -e .', 'echo pip install'],
+                           options={'wheelhouse': '/wheels'})
+        self.assertEqual(subprocess.call.call_count, 1)
+        # The local project is left to pip, but needs its build requirements
+        self.assertEqual(subprocess.call.call_args[0][0][-3:],
+                         ['--no-index', 'setuptools', 'wheel'])
+        self.assertTrue(call(['pip', 'install', '--find-links', '/wheels',
+                              '--no-index', '-e', '.']) in
+                        subprocess.check_call.call_args_list)
+        subprocess.check_call.assert_called_with(['echo', 'pip', 'install'])
+
+    def test_wheelhouse_local_requirements(self):
+        """ Local and editable requirements are not built into wheels """
+        patch.object(os.path, 'isdir').start()
+        self._build_dir()
+        self._add_path('requirements.txt')
+        with patch.object(unbox, 'open', create=True) as mock_open:
+            requirements = mock_open.return_value.__enter__.return_value
+            requirements.__iter__.return_value = iter(['foo==1.0\n',
+                                                       '-e .\n',
+                                                       './libs/bar\n'])
+            unbox.run_commands(['pip install -r requirements.txt'],
+                               options={'wheelhouse': '/wheels'})
+        wheel = ['pip', 'wheel', '-q', '--find-links', '/wheels',
+                 '--wheel-dir', '/wheels/.build']
+        calls = subprocess.call.call_args_list
+        self.assertEqual(calls[0], call(wheel + ['--no-index', 'foo==1.0',
+                                                 'setuptools', 'wheel'],
+                                        stdout=ANY, stderr=ANY))
+        self.assertTrue(call(wheel + ['foo==1.0']) in calls)
+        self.assertFalse(call(wheel + ['.']) in calls)
+        self.assertFalse(call(wheel + ['./libs/bar']) in calls)
+
     def test_run_post_setup_venv(self):
         """ Unboxing runs the post_setup commands with virtualenv path """
         repo = 'git@github.com:user/repository.git'
@@ -236,3 +328,1074 @@ class UnboxTest(FakeFSTest):
         unbox.main([repo, '--no-deps'])
         self.assertTrue(call(['git', 'clone', nextrepo, 'nextrepo']) not in
                         subprocess.check_call.call_args_list)
+
+    def test_diamond_dependencies(self):
+        """ A dependency reachable by several paths is set up once """
+        repo = 'git@github.com:user/repository.git'
+        self._setconf('repository', {
+            'dependencies': ['git@github.com:user/left',
+                             'git@github.com:user/right'],
+        })
+        self._setconf('left', {'dependencies': ['git@github.com:user/base']})
+        self._setconf('right', {'dependencies': ['git@github.com:user/base']})
+        self._setconf('base', {'post_setup': ['install base']})
+        unbox.main([repo, '-j', '1'])
+        clones = [args for args in subprocess.check_call.call_args_list if
+                  args[0][0][:2] == ['git', 'clone']]
+        self.assertEqual(len(clones), 4)
+        # Installed once into each virtualenv it reaches
+        installs = [args for args in subprocess.check_call.call_args_list if
+                    args[0][0] == ['install', 'base']]
+        self.assertEqual(len(installs), 4)
+
+    def test_dependency_order(self):
+        """ Dependencies are installed before the repos that need them """
+        repo = 'git@github.com:user/repository.git'
+        self._setconf('repository', {
+            'dependencies': ['git@github.com:user/nextrepo'],
+            'post_setup': ['install repository'],
+        })
+        self._setconf('nextrepo', {'post_setup': ['install nextrepo']})
+        unbox.main([repo, '-j', '1'])
+        commands = [args[0][0] for args in
+                    subprocess.check_call.call_args_list]
+        self.assertTrue(commands.index(['install', 'nextrepo']) <
+                        commands.index(['install', 'repository']))
+
+    def test_install_queues(self):
+        """ Installs are grouped per virtualenv, dependencies first """
+        graph = {
+            'app': {'conf': {'parent': 'parent'}, 'dependencies': ['lib']},
+            'lib': {'conf': {}, 'dependencies': []},
+        }
+        self.assertEqual(unbox.install_queues('app', graph), [
+            ('lib', ['lib']),
+            ('app', ['lib', 'app']),
+            ('parent', ['lib', 'app']),
+        ])
+
+    def test_install_lock_per_venv(self):
+        """ Installs into a virtualenv hold the lock for that virtualenv """
+        repo = 'git@github.com:user/repository.git'
+        self._setconf('repository', {
+            'post_setup': ['command one'],
+            'env': {'path': '/virtualenv', 'args': []},
+        })
+        unbox.main([repo])
+        unbox.install_lock.assert_called_once_with('/virtualenv')
+
+    def test_install_lock_local_repo(self):
+        """ Local installs also hold the lock for the repo they build in """
+        repo = 'git@github.com:user/repository.git'
+        self._setconf('repository', {
+            'post_setup': ['pip install -e .'],
+            'env': {'path': '/virtualenv', 'args': []},
+        })
+        patch.object(unbox, 'command_inputs', return_value=[]).start()
+        unbox.main([repo])
+        self.assertEqual(unbox.install_lock.call_args_list,
+                         [call(os.curdir), call('/virtualenv')])
+
+    def test_dependency_cycle(self):
+        """ Cyclic dependencies are detected instead of recursing forever """
+        repo = 'git@github.com:user/repository.git'
+        self._setconf('repository', {
+            'dependencies': ['git@github.com:user/nextrepo'],
+        })
+        self._setconf('nextrepo', {
+            'dependencies': ['git@github.com:user/repository'],
+        })
+        self.assertRaises(ValueError, unbox.main, [repo])
+
+    def test_skip_pinned_update(self):
+        """ Repos already at their pinned commit are not fetched """
+        self._add_path('repository')
+        pin = {'commit': 'abc123', 'submodules': {}}
+        patch.object(unbox, 'load_lock').start()
+        unbox.load_lock.return_value = {
+            'git@github.com:user/repository.git': pin}
+        subprocess.Popen.return_value.communicate.return_value = (b'abc123\n',
+                                                                  b'')
+        unbox.main(['git@github.com:user/repository.git'])
+        self.assertEqual(subprocess.call.call_args_list, [])
+        self.assertFalse(unbox.save_lock.called)
+
+    def test_move_to_pinned_commit(self):
+        """ Repos that are not at their pinned commit are fast-forwarded """
+        self._add_path('repository')
+        pin = {'commit': 'abc123', 'submodules': {}}
+        patch.object(unbox, 'load_lock').start()
+        unbox.load_lock.return_value = {
+            'git@github.com:user/repository.git': pin}
+        subprocess.call.return_value = 0
+        unbox.main(['git@github.com:user/repository.git'])
+        calls = subprocess.call.call_args_list
+        self.assertTrue(call(['git', 'merge', '--ff-only', 'abc123']) in calls)
+        self.assertTrue(call(['git', 'pull', '--ff-only']) not in calls)
+        self.assertFalse(unbox.save_lock.called)
+
+    def test_pinned_merge_fails(self):
+        """ A repo that can't be fast-forwarded to its pin stops the unbox """
+        self._add_path('repository')
+        pin = {'commit': 'abc123', 'submodules': {}}
+        patch.object(unbox, 'load_lock').start()
+        unbox.load_lock.return_value = {
+            'git@github.com:user/repository.git': pin}
+        subprocess.call.return_value = 1
+        with self.assertRaises(subprocess.CalledProcessError):
+            unbox.main(['git@github.com:user/repository.git'])
+        self.assertFalse(unbox.save_lock.called)
+
+    def test_update_lock(self):
+        """ --update-lock pulls and pins the new commits """
+        self._add_path('repository')
+        patch.object(unbox, 'load_lock').start()
+        unbox.main(['git@github.com:user/repository.git', '--update-lock'])
+        self.assertFalse(unbox.load_lock.called)
+        self.assertTrue(call(['git', 'pull', '--ff-only']) in
+                        subprocess.call.call_args_list)
+        lock = unbox.save_lock.call_args[0][0]
+        self.assertEqual(list(lock), ['git@github.com:user/repository.git'])
+
+    def test_no_lock_written(self):
+        """ The lock file is only written with --update-lock """
+        unbox.main(['git@github.com:user/repository.git'])
+        self.assertFalse(unbox.save_lock.called)
+
+
+class GitWorkspaceTest(unittest.TestCase):
+
+    """ Base test case that unboxes real repos from local bare remotes """
+
+    def setUp(self):
+        super(GitWorkspaceTest, self).setUp()
+        self.startdir = os.getcwd()
+        self.tempdir = os.path.realpath(tempfile.mkdtemp())
+        self.workspace = os.path.join(self.tempdir, 'workspace')
+        os.makedirs(self.workspace)
+        patch.dict(os.environ, {
+            'DEVBOX_CACHE': os.path.join(self.tempdir, 'cache'),
+            'GIT_AUTHOR_NAME': 'Test',
+            'GIT_AUTHOR_EMAIL': 'test@test',
+            'GIT_COMMITTER_NAME': 'Test',
+            'GIT_COMMITTER_EMAIL': 'test@test',
+        }).start()
+        os.chdir(self.workspace)
+
+    def tearDown(self):
+        super(GitWorkspaceTest, self).tearDown()
+        patch.stopall()
+        os.chdir(self.startdir)
+        shutil.rmtree(self.tempdir)
+
+    def make_remote(self, name, conf=None, files=None):
+        """ Create a bare repo with a devbox conf and return its url """
+        source = os.path.join(self.tempdir, 'src', name)
+        os.makedirs(source)
+        files = dict(files or {})
+        files[unbox.CONF_FILE] = json.dumps(conf or {})
+        for filename, contents in files.items():
+            with open(os.path.join(source, filename), 'w') as outfile:
+                outfile.write(contents)
+        self.git(source, 'init', '-q')
+        self.git(source, 'add', '.')
+        self.git(source, 'commit', '-qm', 'init')
+        bare = os.path.join(self.tempdir, 'remotes', name + '.git')
+        self.git(source, 'clone', '-q', '--bare', source, bare)
+        return 'file://' + bare
+
+    def git(self, cwd, *args):
+        """ Run a git command and return its output """
+        return unbox.check_output(['git', '-C', cwd] + list(args))
+
+
+class LockTest(GitWorkspaceTest):
+
+    """ Tests for pinning the commits of a workspace """
+
+    def setUp(self):
+        super(LockTest, self).setUp()
+        self.lib = self.make_remote('lib')
+        self.url = self.make_remote('app', {'dependencies': [self.lib]})
+
+    def _commit(self, name):
+        """ Add a commit to a remote and return its sha """
+        source = os.path.join(self.tempdir, 'src', name)
+        self.git(source, 'commit', '-q', '--allow-empty', '-m', 'change')
+        self.git(source, 'push', '-q',
+                 os.path.join(self.tempdir, 'remotes', name + '.git'), 'HEAD')
+        return self.git(source, 'rev-parse', 'HEAD')
+
+    def test_pinned_by_url(self):
+        """ Repos are pinned by url, wherever the workspace puts them """
+        unbox.main([self.url, '--update-lock'])
+        lock = unbox.load_lock('app')
+        self.assertEqual(sorted(lock), sorted([self.url, self.lib]))
+        pinned = self.git('lib', 'rev-parse', 'HEAD')
+        self._commit('lib')
+        shutil.rmtree('lib')
+        # Unboxing the clone by path still finds its pins
+        unbox.main(['app'])
+        self.assertEqual(self.git('lib', 'rev-parse', 'HEAD'), pinned)
+
+    def test_committed_lock(self):
+        """ A fresh unbox checks out the pins of the committed lock file """
+        unbox.main([self.url, '--update-lock'])
+        pinned = self.git('lib', 'rev-parse', 'HEAD')
+        self.git('app', 'add', unbox.LOCK_FILE)
+        self.git('app', 'commit', '-qm', 'lock')
+        self.git('app', 'push', '-q', 'origin', 'HEAD')
+        self._commit('lib')
+        shutil.rmtree('app')
+        shutil.rmtree('lib')
+        unbox.main([self.url])
+        self.assertEqual(self.git('lib', 'rev-parse', 'HEAD'), pinned)
+
+    def test_old_lock_file(self):
+        """ Lock files keyed by path are read by url """
+        with open(unbox.LOCK_FILE, 'w') as outfile:
+            json.dump({'repos': {'lib': {'commit': 'abc123', 'submodules': {},
+                                         'url': self.lib}}}, outfile)
+        self.assertEqual(unbox.load_lock(),
+                         {self.lib: {'commit': 'abc123', 'submodules': {}}})
+
+    def test_diverged_pin(self):
+        """ A repo that can't be fast-forwarded to its pin is an error """
+        unbox.main([self.url, '--update-lock'])
+        self.git('lib', 'commit', '-q', '--allow-empty', '-m', 'local')
+        local = self.git('lib', 'rev-parse', 'HEAD')
+        lock = unbox.load_lock('app')
+        lock[self.lib]['commit'] = self._commit('lib')
+        unbox.save_lock(lock, 'app')
+        with self.assertRaises(subprocess.CalledProcessError):
+            unbox.main(['app'])
+        self.assertEqual(self.git('lib', 'rev-parse', 'HEAD'), local)
+        self.assertEqual(unbox.load_lock('app'), lock)
+
+
+class MirrorTest(GitWorkspaceTest):
+
+    """ Tests for cloning from the mirror cache """
+
+    def test_clone_with_mirror(self):
+        """ Clones borrow objects from the mirror of their remote """
+        url = self.make_remote('repo')
+        unbox.unbox(url, mirror=True)
+        mirror = unbox.mirror_path(url)
+        self.assertTrue(os.path.isdir(mirror))
+        alternates = os.path.join('repo', '.git', 'objects', 'info',
+                                  'alternates')
+        with open(alternates, 'r') as infile:
+            self.assertEqual(infile.read().strip(),
+                             os.path.join(mirror, 'objects'))
+
+    def test_dissociate(self):
+        """ --dissociate copies the objects out of the mirror """
+        url = self.make_remote('repo')
+        unbox.main([url, '--mirror', '--dissociate'])
+        self.assertTrue(os.path.isdir(unbox.mirror_path(url)))
+        self.assertFalse(os.path.exists(os.path.join(
+            'repo', '.git', 'objects', 'info', 'alternates')))
+        self.assertEqual(self.git('repo', 'status', '--porcelain'), '')
+
+    def test_fetch_once_per_run(self):
+        """ Each mirror is fetched once per run """
+        url = self.make_remote('repo')
+        unbox.update_mirror(url, 'run1')
+        with patch.object(subprocess, 'check_call') as check_call:
+            unbox.update_mirror(url, 'run1')
+            self.assertFalse(check_call.called)
+            unbox.update_mirror(url, 'run2')
+            self.assertEqual(check_call.call_count, 1)
+
+
+class SubmoduleTest(GitWorkspaceTest):
+
+    """ Tests for updating submodules in parallel """
+
+    def setUp(self):
+        super(SubmoduleTest, self).setUp()
+        # Allow submodules with local urls
+        patch.dict(os.environ, {
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+            'GIT_CONFIG_VALUE_0': 'always',
+        }).start()
+
+    def add_submodules(self, url, submodules):
+        """ Add submodules to a remote made by make_remote """
+        name = url.rsplit('/', 1)[1][:-len('.git')]
+        source = os.path.join(self.tempdir, 'src', name)
+        for path, sub_url in submodules:
+            self.git(source, 'submodule', 'add', '-q', sub_url, path)
+        self.git(source, 'commit', '-qm', 'submodules')
+        self.git(source, 'push', '-q', url[len('file://'):], 'HEAD')
+        return url
+
+    def test_nested_submodules(self):
+        """ Nested submodules are checked out level by level """
+        leaf = self.make_remote('leaf', files={'leaf.txt': 'leaf'})
+        middle = self.add_submodules(self.make_remote('middle'),
+                                     [('leaf', leaf)])
+        other = self.make_remote('other', files={'other.txt': 'other'})
+        url = self.add_submodules(self.make_remote('repo'),
+                                  [('middle', middle), ('other', other)])
+        unbox.main([url, '-j', '2', '--mirror'])
+        self.assertTrue(os.path.exists(os.path.join('repo', 'other',
+                                                    'other.txt')))
+        self.assertTrue(os.path.exists(os.path.join('repo', 'middle', 'leaf',
+                                                    'leaf.txt')))
+        for sub_url in (leaf, middle, other):
+            self.assertTrue(os.path.isdir(unbox.mirror_path(sub_url)))
+
+    def test_failed_submodule(self):
+        """ A submodule that fails is reported and the others still update """
+        broken = self.make_remote('broken')
+        other = self.make_remote('other', files={'other.txt': 'other'})
+        url = self.add_submodules(self.make_remote('repo'),
+                                  [('broken', broken), ('other', other)])
+        shutil.rmtree(broken[len('file://'):])
+        self.git(self.workspace, 'clone', '-q', url, 'repo')
+        with unbox.pushd('repo'):
+            self.assertEqual(unbox.update_submodules({'jobs': 2}),
+                             ['broken'])
+        self.assertTrue(os.path.exists(os.path.join('repo', 'other',
+                                                    'other.txt')))
+
+    def test_failed_submodule_mirror(self):
+        """ A submodule that cannot be mirrored is reported like a failure """
+        broken = self.make_remote('broken')
+        other = self.make_remote('other', files={'other.txt': 'other'})
+        url = self.add_submodules(self.make_remote('repo'),
+                                  [('broken', broken), ('other', other)])
+        shutil.rmtree(broken[len('file://'):])
+        self.git(self.workspace, 'clone', '-q', url, 'repo')
+        options = {'jobs': 2, 'mirror': True, 'run_id': 'run'}
+        with unbox.pushd('repo'):
+            self.assertEqual(unbox.update_submodules(options), ['broken'])
+        self.assertTrue(os.path.exists(os.path.join('repo', 'other',
+                                                    'other.txt')))
+        self.assertTrue(os.path.isdir(unbox.mirror_path(other)))
+
+
+def wait_for(filename):
+    """ Shell command that waits up to 5 seconds for a file to exist """
+    return ('i=0; while [ ! -e %s ]; do sleep 0.05; i=$((i+1)); '
+            '[ $i -gt 100 ] && exit 1; done; true' % filename)
+
+
+class StepGraphTest(unittest.TestCase):
+
+    """ Tests for setup steps with dependencies """
+
+    def setUp(self):
+        super(StepGraphTest, self).setUp()
+        self.startdir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+
+    def tearDown(self):
+        super(StepGraphTest, self).tearDown()
+        os.chdir(self.startdir)
+        shutil.rmtree(self.tempdir)
+
+    def test_independent_steps(self):
+        """ Steps without dependencies between them run at the same time """
+        unbox.run_commands([
+            {'name': 'a', 'command': ['sh', '-c', 'touch a; ' +
+                                      wait_for('b')]},
+            {'name': 'b', 'command': ['sh', '-c', 'touch b; ' +
+                                      wait_for('a')]},
+            {'name': 'c', 'after': ['a', 'b'], 'command': 'touch c'},
+        ], options={'jobs': 2})
+        self.assertTrue(os.path.exists('c'))
+
+    def test_after(self):
+        """ A step only starts after the steps it depends on """
+        unbox.run_commands([
+            {'name': 'second', 'after': ['first'],
+             'command': ['sh', '-c', 'test -e first && touch second']},
+            {'name': 'first',
+             'command': ['sh', '-c', 'sleep 0.2; touch first']},
+        ], options={'jobs': 2})
+        self.assertTrue(os.path.exists('second'))
+
+    def test_fail_fast(self):
+        """ A failing step stops the running steps and the later ones """
+        start = time.time()
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            unbox.run_commands([
+                {'name': 'bad', 'command': ['sh', '-c', 'echo boom; exit 3']},
+                {'name': 'slow', 'command': 'sleep 10'},
+                {'name': 'later', 'after': ['bad'], 'command': 'touch later'},
+            ], options={'jobs': 2})
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertTrue('boom' in context.exception.output)
+        self.assertTrue(time.time() - start < 5)
+        self.assertFalse(os.path.exists('later'))
+
+    def test_prepare_fails(self):
+        """ A step that cannot be prepared fails like one that ran """
+        prepare_command = unbox.prepare_command
+
+        def prepare(entry, *args):
+            """ Fail to prepare the bad step """
+            if entry['name'] == 'bad':
+                raise IOError('cannot download')
+            return prepare_command(entry, *args)
+
+        start = time.time()
+        with patch.object(unbox, 'prepare_command', prepare):
+            with self.assertRaises(subprocess.CalledProcessError) as context:
+                unbox.run_commands([
+                    {'name': 'slow', 'command': 'sleep 10'},
+                    {'name': 'bad', 'command': 'bad'},
+                    {'name': 'later', 'after': ['slow'],
+                     'command': 'touch later'},
+                ], options={'jobs': 2})
+        self.assertTrue('cannot download' in context.exception.output)
+        self.assertTrue(time.time() - start < 5)
+        self.assertFalse(os.path.exists('later'))
+
+    def test_bad_graph(self):
+        """ Unknown and cyclic dependencies are errors """
+        self.assertRaises(ValueError, unbox.step_graph, [
+            {'name': 'a', 'after': ['missing'], 'command': 'true'}])
+        self.assertRaises(ValueError, unbox.step_graph, [
+            {'name': 'a', 'after': ['b'], 'command': 'true'},
+            {'name': 'b', 'after': ['a'], 'command': 'true'}])
+
+
+class FileHandler(BaseHTTPRequestHandler):
+
+    """ Serve the files in ``server.files`` with an ETag """
+
+    def do_GET(self):  # pylint: disable=C0103
+        """ Serve a file, or 304 if the client has the same ETag """
+        self.server.requests.append(self.path)
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%d"' % hash(data)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *_):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+
+    """ Tests for the download cache """
+
+    def setUp(self):
+        super(DownloadTest, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        patch.dict(os.environ, {'DEVBOX_CACHE': self.tempdir}).start()
+        self.server = HTTPServer(('127.0.0.1', 0), FileHandler)
+        self.server.files = {'/script.sh': b'#!/bin/sh\ntouch ran\n'}
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/script.sh' % self.server.server_port
+
+    def tearDown(self):
+        super(DownloadTest, self).tearDown()
+        patch.stopall()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def _read(self, path):
+        """ Read a downloaded file """
+        with open(path, 'rb') as infile:
+            return infile.read()
+
+    def test_revalidate(self):
+        """ Cached files are revalidated instead of downloaded again """
+        path = unbox.download(self.url)
+        self.assertEqual(self._read(path), self.server.files['/script.sh'])
+        with patch.object(unbox, 'LOG') as log:
+            self.assertEqual(unbox.download(self.url), path)
+            self.assertFalse(log.info.called)
+        self.assertEqual(len(self.server.requests), 2)
+        self.server.files['/script.sh'] = b'new'
+        self.assertEqual(self._read(unbox.download(self.url)), b'new')
+
+    def test_checksum(self):
+        """ Files matching their pinned checksum are not requested again """
+        digest = hashlib.sha256(self.server.files['/script.sh']).hexdigest()
+        unbox.download(self.url, digest)
+        unbox.download(self.url, digest)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertRaises(ValueError, unbox.download, self.url, 'bad')
+
+    def test_offline(self):
+        """ Offline mode only uses the cache """
+        self.assertRaises(IOError, unbox.download, self.url, None, True)
+        path = unbox.download(self.url)
+        self.assertEqual(unbox.download(self.url, None, True), path)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_run_url_script(self):
+        """ Url commands run the cached script """
+        with unbox.pushd(self.tempdir):
+            unbox.run_commands([self.url])
+            unbox.run_commands([self.url])
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'ran')))
+
+
+FAKE_VIRTUALENV = """#!/bin/sh
+for last; do :; done
+mkdir -p "$last/bin"
+echo "VIRTUAL_ENV=$(cd "$last" && pwd)" > "$last/bin/activate"
+echo "$last" >> "$VIRTUALENV_LOG"
+"""
+
+# Only does editable installs, into the virtualenv first on the PATH, and
+# logs them to pip.log next to its bin directory
+FAKE_EDITABLE_PIP = """#!/bin/sh
+for last; do :; done
+site="$(dirname "${PATH%%:*}")/lib/site-packages"
+mkdir -p "$site"
+project="$(cd "$last" && pwd)"
+echo "$project" > "$site/__editable__.$(basename "$project").pth"
+echo "$project" >> "$(dirname "$0")/../pip.log"
+"""
+
+
+class ConcurrentInstallTest(GitWorkspaceTest):
+
+    """ Tests for installing into several virtualenvs at once """
+
+    def test_install_all_queues(self):
+        """ Every repo is installed into every virtualenv it reaches """
+        command = ['sh', '-c', 'basename "$PWD" >> ../installed']
+        lib = self.make_remote('lib', {'post_setup': [command]})
+        app = self.make_remote('app', {'dependencies': [lib],
+                                       'post_setup': [command]})
+        unbox.main([app, '-j', '2'])
+        with open('installed', 'r') as infile:
+            installed = infile.read().split()
+        self.assertEqual(sorted(installed), ['app', 'lib', 'lib'])
+
+
+class TraceTest(GitWorkspaceTest):
+
+    """ Tests for the trace-event timeline """
+
+    def test_trace_steps(self):
+        """ --trace writes a span for every step, from every process """
+        lib = self.make_remote('lib', {'post_setup': ['true']})
+        app = self.make_remote('app', {'dependencies': [lib],
+                                       'post_setup': ['true']})
+        filename = os.path.join(self.tempdir, 'trace.json')
+        unbox.main([app, '-j', '2', '--trace', filename])
+        with open(filename, 'r') as infile:
+            events = json.load(infile)['traceEvents']
+        names = [event['name'] for event in events]
+        for name in ('unbox', 'resolve_dependencies', 'clone_repo',
+                     'update_repo', 'setup_git_hooks', 'install'):
+            self.assertTrue(name in names, name)
+        commands = [event['args'] for event in events if
+                    event['name'] == 'run_commands']
+        self.assertEqual(len(commands), 3)
+        self.assertEqual(commands[0]['command'], 'true')
+        self.assertTrue('children_user_cpu' in commands[0])
+        # The installs into the two virtualenvs ran in worker processes
+        self.assertTrue(len(set(event['pid'] for event in events)) > 1)
+        self.assertTrue(unbox.TRACE is None)
+
+
+class VenvCacheTest(GitWorkspaceTest):
+
+    """ Tests for the virtualenv snapshot cache """
+
+    def setUp(self):
+        super(VenvCacheTest, self).setUp()
+        bindir = os.path.join(self.tempdir, 'bin')
+        os.makedirs(bindir)
+        for name, script in (('virtualenv', FAKE_VIRTUALENV),
+                             ('pip', '#!/bin/sh\n')):
+            filename = os.path.join(bindir, name)
+            with open(filename, 'w') as outfile:
+                outfile.write(script)
+            os.chmod(filename, 0o755)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['VIRTUALENV_LOG'] = os.path.join(self.tempdir,
+                                                    'virtualenv.log')
+        self.url = self.make_remote('repo', {
+            'env': {'path': 'venv', 'args': []},
+            'post_setup': ['pip install -r requirements.txt'],
+        }, {'requirements.txt': 'jinja2\n'})
+
+    def _created(self):
+        """ Get the virtualenvs that were built from scratch """
+        filename = os.path.join(self.tempdir, 'virtualenv.log')
+        if not os.path.exists(filename):
+            return []
+        with open(filename, 'r') as infile:
+            return infile.read().split()
+
+    def test_restore_snapshot(self):
+        """ A virtualenv with the same requirements is copied and fixed up """
+        unbox.unbox(self.url)
+        self.assertEqual(self._created(), ['venv'])
+        os.makedirs('other')
+        os.chdir('other')
+        unbox.unbox(self.url)
+        self.assertEqual(self._created(), ['venv'])
+        venv = os.path.join(self.workspace, 'other', 'repo', 'venv')
+        with open(os.path.join(venv, 'bin', 'activate'), 'r') as infile:
+            self.assertEqual(infile.read().strip(), 'VIRTUAL_ENV=' + venv)
+        self.assertFalse(os.path.exists(os.path.join(venv,
+                                                     unbox.VENV_MANIFEST)))
+
+    def test_other_project(self):
+        """ Projects with the same requirements don't share a snapshot """
+        other = self.make_remote('other', {
+            'env': {'path': 'venv', 'args': []},
+            'post_setup': ['pip install -r requirements.txt'],
+        }, {'requirements.txt': 'jinja2\n'})
+        unbox.unbox(self.url)
+        unbox.unbox(other)
+        self.assertEqual(self._created(), ['venv', 'venv'])
+
+    def test_project_files_change_key(self):
+        """ A change to setup.py doesn't use the snapshot """
+        unbox.unbox(self.url)
+        with open(os.path.join('repo', 'setup.py'), 'w') as outfile:
+            outfile.write('from setuptools import setup\nsetup()\n')
+        shutil.rmtree(os.path.join('repo', 'venv'))
+        unbox.unbox('repo')
+        self.assertEqual(self._created(), ['venv', 'venv'])
+
+    def test_requirements_change_key(self):
+        """ Different requirements don't use the snapshot """
+        unbox.unbox(self.url)
+        with open(os.path.join('repo', 'requirements.txt'), 'w') as outfile:
+            outfile.write('mock\n')
+        shutil.rmtree(os.path.join('repo', 'venv'))
+        unbox.unbox('repo')
+        self.assertEqual(self._created(), ['venv', 'venv'])
+
+    def test_no_venv_cache(self):
+        """ --no-venv-cache builds every virtualenv """
+        unbox.main([self.url, '--no-venv-cache'])
+        shutil.rmtree(os.path.join('repo', 'venv'))
+        unbox.main(['repo', '--no-venv-cache'])
+        self.assertEqual(self._created(), ['venv', 'venv'])
+        self.assertFalse(os.path.exists(unbox.cache_dir('venvs')))
+
+
+class SnapshotTest(GitWorkspaceTest):
+
+    """ Tests for packing and restoring workspaces """
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        bindir = os.path.join(self.tempdir, 'bin')
+        os.makedirs(bindir)
+        filename = os.path.join(bindir, 'virtualenv')
+        with open(filename, 'w') as outfile:
+            outfile.write(FAKE_VIRTUALENV)
+        os.chmod(filename, 0o755)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['VIRTUALENV_LOG'] = os.path.join(self.tempdir,
+                                                    'virtualenv.log')
+        self.installed = os.path.join(self.tempdir, 'installed')
+        command = {'command': ['sh', '-c', 'echo "$PWD" >> %s' %
+                               self.installed], 'inputs': []}
+        lib = self.make_remote('lib', {'post_setup': [command]})
+        self.url = self.make_remote('app', {
+            'dependencies': [lib],
+            'env': {'path': 'venv', 'args': []},
+            'post_setup': [command],
+        })
+
+    def _installed(self):
+        """ Get the directories post_setup ran in """
+        with open(self.installed, 'r') as infile:
+            return infile.read().split()
+
+    def test_snapshot_restore(self):
+        """ A restored workspace is relocated and doesn't run setup again """
+        unbox.main([self.url, '-j', '1', '--update-lock'])
+        self.assertEqual(len(self._installed()), 3)
+        archive = os.path.join(self.tempdir, 'workspace.tar')
+        unbox.main(['snapshot', 'app', archive])
+        other = os.path.join(self.tempdir, 'other')
+        unbox.main(['restore', archive, other, '-j', '2'])
+        self.assertEqual(len(self._installed()), 3)
+        venv = os.path.join(other, 'app', 'venv')
+        with open(os.path.join(venv, 'bin', 'activate'), 'r') as infile:
+            self.assertEqual(infile.read().strip(), 'VIRTUAL_ENV=' + venv)
+        self.assertEqual(self.git(os.path.join(other, 'lib'), 'rev-parse',
+                                  'HEAD'),
+                         self.git(os.path.join(self.workspace, 'lib'),
+                                  'rev-parse', 'HEAD'))
+        self.assertTrue(os.path.exists(os.path.join(other, 'app',
+                                                    unbox.LOCK_FILE)))
+
+    def test_snapshot_current_repo(self):
+        """ Virtualenvs inside a repo given as '.' are only packed once """
+        unbox.main([self.url, '-j', '1'])
+        archive = os.path.join(self.tempdir, 'workspace.tar')
+        with unbox.pushd('app'):
+            unbox.snapshot('.', archive)
+        with tarfile.open(archive) as outer:
+            repo = outer.extractfile(os.path.join('repos', '0.tar.gz'))
+            with tarfile.open(fileobj=io.BytesIO(repo.read())) as inner:
+                names = inner.getnames()
+        self.assertTrue(os.path.join('.', unbox.CONF_FILE) in names)
+        self.assertFalse([name for name in names if 'venv' in name])
+
+    def test_restore_editable(self):
+        """ Editable installs point to the restored repos """
+        filename = os.path.join(self.tempdir, 'bin', 'pip')
+        with open(filename, 'w') as outfile:
+            outfile.write(FAKE_EDITABLE_PIP)
+        os.chmod(filename, 0o755)
+        mod = self.make_remote('mod', {}, {'setup.py': '',
+                                           'mod.py': 'VALUE = 1\n'})
+        top = self.make_remote('top', {
+            'dependencies': [mod],
+            'env': {'path': 'venv', 'args': []},
+            'post_setup': ['pip install -e ../mod'],
+        })
+        unbox.main([top, '-j', '1'])
+        archive = os.path.join(self.tempdir, 'workspace.tar')
+        unbox.snapshot('top', archive)
+        os.chdir(self.tempdir)
+        shutil.rmtree(self.workspace)
+        other = os.path.join(self.tempdir, 'other')
+        unbox.restore(archive, other, jobs=1)
+        # Up to date, so only the install of the first unbox ran
+        with open(os.path.join(self.tempdir, 'pip.log'), 'r') as infile:
+            self.assertEqual(len(infile.read().split()), 1)
+        site = os.path.join(other, 'top', 'venv', 'lib', 'site-packages')
+        output = unbox.check_output([
+            sys.executable, '-c', 'import site; site.addsitedir(%r); '
+            'import mod; print(mod.__file__)' % site])
+        self.assertEqual(output, os.path.join(other, 'mod', 'mod.py'))
+
+    def test_snapshot_dissociates(self):
+        """ Repos that borrow objects from a mirror are packed whole """
+        unbox.main([self.url, '--mirror', '-j', '1'])
+        archive = os.path.join(self.tempdir, 'workspace.tar')
+        alternates = os.path.join('app', '.git', 'objects', 'info',
+                                  'alternates')
+        with open(alternates, 'r') as infile:
+            before = infile.read()
+        unbox.snapshot('app', archive)
+        # The source still borrows from the mirror
+        with open(alternates, 'r') as infile:
+            self.assertEqual(infile.read(), before)
+        shutil.rmtree(unbox.cache_dir('mirrors'))
+        other = os.path.join(self.tempdir, 'other')
+        unbox.restore(archive, other, update=False)
+        self.git(os.path.join(other, 'app'), 'fsck')
+
+
+class WorktreeTest(GitWorkspaceTest):
+
+    """ Tests for unboxing a branch into git worktrees """
+
+    def setUp(self):
+        super(WorktreeTest, self).setUp()
+        bindir = os.path.join(self.tempdir, 'bin')
+        os.makedirs(bindir)
+        for name, script in (('virtualenv', FAKE_VIRTUALENV),
+                             ('pip', '#!/bin/sh\n')):
+            filename = os.path.join(bindir, name)
+            with open(filename, 'w') as outfile:
+                outfile.write(script)
+            os.chmod(filename, 0o755)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['VIRTUALENV_LOG'] = os.path.join(self.tempdir,
+                                                    'virtualenv.log')
+        self.lib = self.make_remote('lib', {'post_setup': ['true']})
+        self.url = self.make_remote('app', {
+            'dependencies': [self.lib],
+            'env': {'path': 'venv', 'args': []},
+            'post_setup': ['pip install -r requirements.txt'],
+        }, {'requirements.txt': 'jinja2\n'})
+
+    def add_branch(self, name, branch, filename, contents):
+        """ Push a branch with one changed file to a remote """
+        source = os.path.join(self.tempdir, 'src', name)
+        self.git(source, 'checkout', '-qb', branch)
+        with open(os.path.join(source, filename), 'w') as outfile:
+            outfile.write(contents)
+        self.git(source, 'add', filename)
+        self.git(source, 'commit', '-qm', branch)
+        self.git(source, 'push', '-q', 'origin', branch)
+        self.git(source, 'checkout', '-q', '-')
+
+    def _created(self):
+        """ Get the virtualenvs that were built from scratch """
+        with open(os.path.join(self.tempdir, 'virtualenv.log'), 'r') as infile:
+            return infile.read().split()
+
+    def test_worktree(self):
+        """ Worktrees of the repo and its deps share objects and virtualenv """
+        self.git(os.path.join(self.tempdir, 'src', 'app'), 'remote', 'add',
+                 'origin', self.url)
+        self.add_branch('app', 'feature', 'feature.txt', 'new')
+        unbox.main([self.url, '-j', '1', '--no-venv-cache'])
+        unbox.main(['app', '--worktree', 'feature', '-j', '1',
+                    '--no-venv-cache'])
+        workspace = self.workspace + '@feature'
+        app = os.path.join(workspace, 'app')
+        self.assertEqual(self.git(app, 'rev-parse', '--abbrev-ref', 'HEAD'),
+                         'feature')
+        self.assertTrue(os.path.exists(os.path.join(app, 'feature.txt')))
+        # Both repos are worktrees of the original clones
+        for name in ('app', 'lib'):
+            self.assertTrue(os.path.isfile(os.path.join(workspace, name,
+                                                        '.git')))
+        self.assertEqual(self.git(os.path.join(workspace, 'lib'), 'rev-parse',
+                                  'HEAD'),
+                         self.git('lib', 'rev-parse', 'HEAD'))
+        # The virtualenv was copied and relocated instead of built
+        self.assertEqual(self._created(), ['venv'])
+        venv = os.path.join(app, 'venv')
+        with open(os.path.join(venv, 'bin', 'activate'), 'r') as infile:
+            self.assertEqual(infile.read().strip(), 'VIRTUAL_ENV=' + venv)
+
+    def test_repo_outside_workspace(self):
+        """ A repo outside the current directory gets a worktree in it """
+        self.git(os.path.join(self.tempdir, 'src', 'app'), 'remote', 'add',
+                 'origin', self.url)
+        self.add_branch('app', 'feature', 'feature.txt', 'new')
+        unbox.main([self.url, '-j', '1', '--no-venv-cache'])
+        elsewhere = os.path.join(self.tempdir, 'elsewhere')
+        os.makedirs(elsewhere)
+        os.chdir(elsewhere)
+        unbox.main([os.path.join(self.workspace, 'app'), '--worktree',
+                    'feature', '-j', '1', '--no-venv-cache'])
+        app = os.path.join(elsewhere + '@feature', 'app')
+        self.assertEqual(self.git(app, 'rev-parse', '--abbrev-ref', 'HEAD'),
+                         'feature')
+        # The original clone is left alone
+        self.assertNotEqual(self.git(os.path.join(self.workspace, 'app'),
+                                     'rev-parse', '--abbrev-ref', 'HEAD'),
+                            'feature')
+
+    def test_changed_requirements(self):
+        """ A branch with different requirements builds its own virtualenv """
+        self.git(os.path.join(self.tempdir, 'src', 'app'), 'remote', 'add',
+                 'origin', self.url)
+        self.add_branch('app', 'feature', 'requirements.txt', 'mock\n')
+        unbox.main([self.url, '-j', '1', '--no-venv-cache'])
+        unbox.main(['app', '--worktree', 'feature', '-j', '1',
+                    '--no-venv-cache'])
+        self.assertEqual(self._created(), ['venv', 'venv'])
+
+    def test_missing_branch(self):
+        """ The repo must have the branch """
+        unbox.main([self.url, '-j', '1'])
+        self.assertRaises(ValueError, unbox.unbox, 'app',
+                          worktree='missing')
+
+
+class PackageStoreTest(unittest.TestCase):
+
+    """ Tests for sharing packages between virtualenvs """
+
+    def setUp(self):
+        super(PackageStoreTest, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        patch.dict(os.environ, {
+            'DEVBOX_CACHE': os.path.join(self.tempdir, 'cache')}).start()
+        self.site = 'lib/python3.9/site-packages'
+
+    def tearDown(self):
+        super(PackageStoreTest, self).tearDown()
+        patch.stopall()
+        shutil.rmtree(self.tempdir)
+
+    def _install(self, venv, name='foo', version='1.0', script=None):
+        """ Fake a pip install of a distribution into a virtualenv """
+        site = os.path.join(self.tempdir, venv, self.site)
+        dist_info = '%s-%s.dist-info' % (name, version)
+        files = {
+            '%s/__init__.py' % name: 'VERSION = %r\n\n\ndef main():\n'
+                                     '    print(VERSION)\n' % version,
+            '%s/METADATA' % dist_info: 'Name: %s\n' % name,
+            '%s/INSTALLER' % dist_info: 'pip\n',
+            '%s/entry_points.txt' % dist_info:
+                '[console_scripts]\n%s = %s:main\n' % (name, name),
+            '../../../bin/%s' % (script or name): '#!%s/bin/python\n' % venv,
+        }
+        for path, contents in files.items():
+            filename = os.path.normpath(os.path.join(site, path))
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as outfile:
+                outfile.write(contents)
+        with open(os.path.join(site, dist_info, 'RECORD'), 'w') as outfile:
+            for path in sorted(files):
+                outfile.write('%s,%s,\n' % (path, unbox.file_hash(
+                    os.path.normpath(os.path.join(site, path)))))
+            outfile.write('%s/RECORD,,\n' % dist_info)
+        return os.path.join(self.tempdir, venv)
+
+    def _inode(self, venv, path):
+        """ Get the inode of a file in a virtualenv's site-packages """
+        return os.stat(os.path.join(self.tempdir, venv, self.site,
+                                    path)).st_ino
+
+    def test_dedupe_installed(self):
+        """ The same distribution in two virtualenvs shares its files """
+        unbox.store_packages(self._install('one'))
+        unbox.store_packages(self._install('two'))
+        self.assertEqual(self._inode('one', 'foo/__init__.py'),
+                         self._inode('two', 'foo/__init__.py'))
+        # Scripts have the virtualenv path in them
+        self.assertNotEqual(
+            os.stat(os.path.join(self.tempdir, 'one', 'bin', 'foo')).st_ino,
+            os.stat(os.path.join(self.tempdir, 'two', 'bin', 'foo')).st_ino)
+
+    def test_changed_files(self):
+        """ Files that don't match their RECORD are not shared """
+        unbox.store_packages(self._install('one'))
+        venv = self._install('two')
+        filename = os.path.join(venv, self.site, 'foo', '__init__.py')
+        with open(filename, 'a') as outfile:
+            outfile.write('# patched\n')
+        unbox.store_packages(venv)
+        self.assertNotEqual(self._inode('one', 'foo/__init__.py'),
+                            self._inode('two', 'foo/__init__.py'))
+        with open(filename, 'r') as infile:
+            self.assertTrue(infile.read().endswith('# patched\n'))
+
+    def test_changed_files_not_stored(self):
+        """ A distribution with changed files is not added to the store """
+        venv = self._install('one')
+        with open(os.path.join(venv, self.site, 'foo', '__init__.py'),
+                  'a') as outfile:
+            outfile.write('# patched\n')
+        unbox.store_packages(venv)
+        self.assertEqual(glob.glob(unbox.cache_dir('store', '*', 'RECORD')),
+                         [])
+
+    def test_other_scripts(self):
+        """ Distributions with scripts that aren't entry points are skipped """
+        unbox.store_packages(self._install('one', script='foo-tool'))
+        self.assertEqual(glob.glob(unbox.cache_dir('store', '*', 'RECORD')),
+                         [])
+
+    def test_different_versions(self):
+        """ Different versions are stored separately """
+        unbox.store_packages(self._install('one'))
+        unbox.store_packages(self._install('two', version='2.0'))
+        self.assertNotEqual(self._inode('one', 'foo/__init__.py'),
+                            self._inode('two', 'foo/__init__.py'))
+
+    def test_link_pinned(self):
+        """ Pinned requirements are linked in from the store before pip """
+        unbox.store_packages(self._install('one'))
+        requirements = os.path.join(self.tempdir, 'requirements.txt')
+        with open(requirements, 'w') as outfile:
+            outfile.write('Foo==1.0  # pinned\nbar==2.0\n')
+        venv = os.path.join(self.tempdir, 'two')
+        os.makedirs(os.path.join(venv, self.site))
+        os.makedirs(os.path.join(venv, 'bin'))
+        unbox.link_from_store(venv, [requirements])
+        self.assertEqual(self._inode('one', 'foo/__init__.py'),
+                         self._inode('two', 'foo/__init__.py'))
+        self.assertTrue(os.path.exists(os.path.join(
+            venv, self.site, 'foo-1.0.dist-info', 'RECORD')))
+        # The console script is generated for the new virtualenv
+        script = os.path.join(venv, 'bin', 'foo')
+        with open(script, 'r') as infile:
+            lines = infile.read().splitlines()
+        self.assertEqual(lines[0], '#!' + os.path.join(venv, 'bin', 'python'))
+        self.assertTrue('from foo import main' in lines)
+        self.assertTrue(os.access(script, os.X_OK))
+        env = {'PYTHONPATH': os.path.join(venv, self.site)}
+        output = subprocess.check_output([sys.executable, script], env=env)
+        self.assertEqual(output.decode('utf-8').strip(), '1.0')
+
+
+class StampTest(GitWorkspaceTest):
+
+    """ Tests for skipping setup commands whose inputs haven't changed """
+
+    def setUp(self):
+        super(StampTest, self).setUp()
+        self.log = os.path.join(self.tempdir, 'commands.log')
+        self.url = self.make_remote('repo', {
+            'pre_setup': ['sh -c "echo pre >> %s"' % self.log,
+                          {'command': 'sh -c "echo once >> %s"' % self.log,
+                           'inputs': []}],
+            'post_setup': [{'command': 'sh -c "echo post >> %s"' % self.log,
+                            'inputs': ['deps.txt']}],
+        }, {'deps.txt': 'one'})
+
+    def _ran(self):
+        """ Get the commands that ran """
+        with open(self.log, 'r') as infile:
+            return infile.read().split()
+
+    def test_skip_unchanged(self):
+        """ Commands only run again when their inputs change """
+        unbox.unbox(self.url)
+        unbox.unbox('repo')
+        self.assertEqual(self._ran(), ['pre', 'once', 'post', 'pre'])
+        with open(os.path.join('repo', 'deps.txt'), 'w') as outfile:
+            outfile.write('two')
+        unbox.unbox('repo')
+        self.assertEqual(self._ran(), ['pre', 'once', 'post', 'pre', 'pre',
+                                       'post'])
+        self.assertTrue(os.listdir(os.path.join('repo', '.git',
+                                                unbox.STAMP_DIR)))
+
+    def test_force(self):
+        """ --force runs every command """
+        unbox.main([self.url])
+        unbox.main(['repo', '--force'])
+        self.assertEqual(self._ran(), ['pre', 'once', 'post', 'pre', 'once',
+                                       'post'])
+
+    def test_new_virtualenv(self):
+        """ A rebuilt virtualenv runs the commands in it again """
+        bindir = os.path.join(self.tempdir, 'bin')
+        os.makedirs(bindir)
+        filename = os.path.join(bindir, 'virtualenv')
+        with open(filename, 'w') as outfile:
+            outfile.write(FAKE_VIRTUALENV)
+        os.chmod(filename, 0o755)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['VIRTUALENV_LOG'] = os.path.join(self.tempdir,
+                                                    'virtualenv.log')
+        url = self.make_remote('venvrepo', {
+            'env': {'path': 'venv', 'args': []},
+            'post_setup': [{'command': 'sh -c "echo post >> %s"' % self.log,
+                            'inputs': ['deps.txt']}],
+        }, {'deps.txt': 'one'})
+        unbox.main([url, '--no-venv-cache'])
+        unbox.main(['venvrepo', '--no-venv-cache'])
+        self.assertEqual(self._ran(), ['post'])
+        shutil.rmtree(os.path.join('venvrepo', 'venv'))
+        unbox.main(['venvrepo', '--no-venv-cache'])
+        self.assertEqual(self._ran(), ['post', 'post'])
+
+    def test_pip_inputs(self):
+        """ pip commands depend on requirement and setup files """
+        self.assertEqual(unbox.command_inputs('pip install -r req.txt'),
+                         ['req.txt'])
+        self.assertEqual(unbox.command_inputs(['pip', 'install', '-e', '.']),
+                         [os.path.join('.', name) for name in
+                          unbox.PROJECT_FILES])
+        self.assertEqual(unbox.command_inputs('make docs'), [])
@@ -0,0 +1,101 @@
+""" Tests for the autopep8 runner """
+import os
+import shutil
+import subprocess
+import tempfile
+
+from . import unittest
+from devbox import autoformat
+
+try:
+    import autopep8  # pylint: disable=F0401,W0611
+except ImportError:
+    autopep8 = None
+
+
+UGLY = b'import os,sys\nx=1\n'
+PRETTY = b'import os\nimport sys\nx = 1\n'
+
+
+@unittest.skipIf(autopep8 is None, "autopep8 is not installed")
+class AutoformatTest(unittest.TestCase):
+
+    """ Run the formatter on a real git repository """
+
+    def setUp(self):
+        super(AutoformatTest, self).setUp()
+        self.startdir = os.getcwd()
+        self.repo = tempfile.mkdtemp()
+        os.chdir(self.repo)
+        subprocess.check_call(['git', 'init', '-q'])
+        subprocess.check_call(['git', 'config', 'user.name', 'Test'])
+        subprocess.check_call(['git', 'config', 'user.email', 'test@test'])
+        with open(autoformat.CONF_FILE, 'w') as outfile:
+            outfile.write('[pep8]\nmax-line-length=80\nignore=E501\n')
+
+    def tearDown(self):
+        super(AutoformatTest, self).tearDown()
+        os.chdir(self.startdir)
+        shutil.rmtree(self.repo)
+
+    def _write(self, filename, contents):
+        """ Write a file into the test repo """
+        with open(filename, 'wb') as outfile:
+            outfile.write(contents)
+
+    def _read(self, filename):
+        """ Read a file from the test repo """
+        with open(filename, 'rb') as infile:
+            return infile.read()
+
+    def test_load_options(self):
+        """ Options are read from the pep8 section of the conf file """
+        self.assertEqual(autoformat.load_options(),
+                         ['--ignore=E501', '--max-line-length=80'])
+
+    def test_format_modified(self):
+        """ Staged and unstaged python files are formatted in place """
+        self._write('staged.py', UGLY)
+        self._write('unstaged.py', UGLY)
+        subprocess.check_call(['git', 'add', 'staged.py', 'unstaged.py'])
+        subprocess.check_call(['git', 'commit', '-qm', 'init'])
+        self._write('staged.py', UGLY + b'y=2\n')
+        subprocess.check_call(['git', 'add', 'staged.py'])
+        self._write('unstaged.py', UGLY + b'z=3\n')
+        autoformat.main(['-j', '1'])
+        self.assertEqual(self._read('staged.py'), PRETTY + b'y = 2\n')
+        self.assertEqual(self._read('unstaged.py'), PRETTY + b'z = 3\n')
+
+    def test_skip_cached_blobs(self):
+        """ Files already formatted under the same options are skipped """
+        cache = autoformat.FormatCache(os.path.join(self.repo, 'cache'),
+                                       ['--ignore=E501'])
+        self._write('a.py', UGLY)
+        autoformat.format_files(['a.py'], [], cache, 1)
+        self.assertTrue(autoformat.blob_sha(PRETTY) in cache)
+        # Pretend the ugly version was already formatted
+        cache.add(autoformat.blob_sha(UGLY))
+        self._write('a.py', UGLY)
+        self.assertEqual(autoformat.format_files(['a.py'], [], cache, 1), [])
+        self.assertEqual(self._read('a.py'), UGLY)
+
+    def test_cache_invalidated_by_options(self):
+        """ Changing the options discards the cache """
+        filename = os.path.join(self.repo, 'cache')
+        cache = autoformat.FormatCache(filename, ['--ignore=E501'])
+        cache.add('abc')
+        cache.save()
+        self.assertTrue('abc' in autoformat.FormatCache(filename,
+                                                        ['--ignore=E501']))
+        self.assertFalse('abc' in autoformat.FormatCache(filename, []))
+
+    def test_format_index(self):
+        """ --index formats the staged blob and leaves the working tree """
+        self._write('a.py', UGLY)
+        subprocess.check_call(['git', 'add', 'a.py'])
+        self._write('a.py', UGLY + b'y=2\n')
+        autoformat.main(['--index', '-j', '1'])
+        staged = subprocess.Popen(['git', 'show', ':a.py'],
+                                  stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(staged, PRETTY)
+        self.assertEqual(self._read('a.py'), UGLY + b'y=2\n')
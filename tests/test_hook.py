@@ -1,10 +1,13 @@
 """ Tests for hook file """
+import json
 import os
+import shutil
 import subprocess
+import tempfile
 
-from mock import patch, ANY
+from mock import patch, ANY, MagicMock
 
-from . import FakeFSTest
+from . import FakeFSTest, unittest
 from devbox import hook
 
 
@@ -67,6 +70,831 @@ class HookTest(FakeFSTest):
         subprocess.Popen.assert_called_with(cmdlist + [filename], env=ANY,
                                             stdout=ANY, stderr=ANY)
 
+    def test_record_check_timings(self):
+        """ Every check that runs is recorded in the history """
+        history = MagicMock()
+        subprocess.call.return_value = 0
+        subprocess.Popen.return_value.returncode = 0
+        hook.run_checks(['do it'], [('*', 'check')], ['myfile'], None,
+                        history)
+        calls = history.record_check.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][0][:2], (['do', 'it'], None))
+        self.assertEqual(calls[1][0][:2], (['check'], 'myfile'))
+
+
+class HistoryTest(unittest.TestCase):
+
+    """ Tests for the hook timing history """
+
+    def setUp(self):
+        super(HistoryTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'devbox', 'hook.sqlite')
+
+    def tearDown(self):
+        super(HistoryTest, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _save_run(self, checks, retcode=0):
+        """ Save a run with a list of (command, filename, duration) """
+        history = hook.History(self.filename)
+        history.set_conf({'hooks_all': []})
+        history.files = len(checks)
+        with history.phase('checks'):
+            for command, filename, duration in checks:
+                history.record_check(command, filename, duration, retcode)
+        history.save(retcode)
+
+    def test_percentile(self):
+        """ Percentiles use the nearest rank """
+        values = list(range(1, 101))
+        self.assertEqual(hook.percentile(values, 50), 50)
+        self.assertEqual(hook.percentile(values, 95), 95)
+        self.assertEqual(hook.percentile([], 50), 0.0)
+
+    def test_check_stats(self):
+        """ Stats report latency percentiles per check """
+        for i in range(10):
+            self._save_run([(['pylint'], 'a.py', i + 1)])
+        stats = hook.load_stats(self.filename)
+        self.assertEqual(len(stats['checks']), 1)
+        check = stats['checks'][0]
+        self.assertEqual(check['command'], 'pylint')
+        self.assertEqual(check['count'], 10)
+        self.assertEqual(check['p50'], 5)
+        self.assertEqual(check['p95'], 10)
+        self.assertEqual(stats['runs']['count'], 10)
+        self.assertEqual(len(stats['trend']), 1)
+
+    def test_top_files(self):
+        """ Stats report the files that took the longest to check """
+        self._save_run([(['pylint'], 'slow.py', 10),
+                        (['pylint'], 'fast.py', 1),
+                        (['make'], None, 100)], retcode=1)
+        files = hook.load_stats(self.filename)['files']
+        self.assertEqual([entry['filename'] for entry in files],
+                         ['slow.py', 'fast.py'])
+        self.assertEqual(files[0]['failures'], 1)
+
+    def test_openmetrics(self):
+        """ OpenMetrics output is a terminated set of summaries """
+        self._save_run([(['pylint', '--rcfile=.pylintrc'], 'a.py', 2)])
+        text = hook.format_openmetrics(hook.load_stats(self.filename))
+        lines = text.splitlines()
+        self.assertEqual(lines[-1], '# EOF')
+        self.assertTrue('devbox_hook_check_duration_seconds_count'
+                        '{check="pylint --rcfile=.pylintrc"} 1' in lines)
+
+
+class HookRunnerTest(unittest.TestCase):
+
+    """ Tests for the in-process hook API """
+
+    def setUp(self):
+        super(HookRunnerTest, self).setUp()
+        self.repo = tempfile.mkdtemp()
+        subprocess.check_call(['git', 'init', '-q', self.repo])
+        self._write(hook.CONF_FILE, json.dumps({
+            'hooks_all': ['true'],
+            'hooks_modified': [['*.py', {'command': 'grep -q good',
+                                         'cache': True}]],
+        }))
+        self._write('good.py', 'good = True')
+        self._write('bad.py', 'bad = True')
+        self._write('README', 'bad')
+
+    def tearDown(self):
+        super(HookRunnerTest, self).tearDown()
+        shutil.rmtree(self.repo)
+
+    def _write(self, filename, contents):
+        """ Write a file into the test repo """
+        with open(os.path.join(self.repo, filename), 'w') as outfile:
+            outfile.write(contents)
+
+    def test_structured_results(self):
+        """ Results report the command, file and exit code of each check """
+        results = hook.HookRunner(self.repo).run(['good.py', 'bad.py'])
+        results = dict((result.filename, result) for result in results)
+        self.assertEqual(sorted(results), ['bad.py', 'good.py'])
+        self.assertEqual(results['good.py'].retcode, 0)
+        self.assertNotEqual(results['bad.py'].retcode, 0)
+        self.assertEqual(results['bad.py'].command, ['grep', '-q', 'good'])
+        self.assertFalse(results['bad.py'].cached)
+
+    def test_hooks_all_without_paths(self):
+        """ With no paths, check all modified files and run hooks_all """
+        subprocess.check_call(['git', 'add', 'good.py'], cwd=self.repo)
+        results = hook.HookRunner(self.repo).run()
+        filenames = sorted(str(result.filename) for result in results)
+        self.assertEqual(filenames, ['None', 'good.py'])
+
+    def test_cached_results(self):
+        """ Checking unchanged content again is served from the cache """
+        runner = hook.HookRunner(self.repo)
+        runner.run(['good.py'])
+        result = runner.run([os.path.join(self.repo, 'good.py')])[0]
+        self.assertTrue(result.cached)
+        self.assertEqual(result.retcode, 0)
+        self._write('good.py', 'good = False')
+        self.assertFalse(runner.run(['good.py'])[0].cached)
+
+    def test_cache_persists(self):
+        """ A new runner reuses the results stored by a previous one """
+        hook.HookRunner(self.repo).run(['good.py'])
+        result = hook.HookRunner(self.repo).run(['good.py'])[0]
+        self.assertTrue(result.cached)
+
+    def test_conf_change_invalidates(self):
+        """ Changing the conf file invalidates cached results """
+        runner = hook.HookRunner(self.repo)
+        runner.run(['good.py'])
+        self._write(hook.CONF_FILE, json.dumps({
+            'hooks_modified': [['*.py', {'command': 'grep -q good',
+                                         'cache': True}]],
+            'env': {'path': 'venv'},
+        }))
+        os.utime(os.path.join(self.repo, hook.CONF_FILE), (0, 0))
+        self.assertFalse(runner.run(['good.py'])[0].cached)
+
+    def test_config_change_invalidates(self):
+        """ Changing a tool config file invalidates cached results """
+        self._write(hook.CONF_FILE, json.dumps({
+            'hooks_modified': [['*.py', {'command': 'grep -q -f lint.cfg',
+                                         'cache': True}]],
+        }))
+        self._write('lint.cfg', 'good\n')
+        self._write('setup.cfg', '[lint]\n')
+        runner = hook.HookRunner(self.repo)
+        runner.run(['good.py'])
+        self.assertTrue(runner.run(['good.py'])[0].cached)
+        self._write('setup.cfg', '[lint]\nstrict = 1\n')
+        self.assertFalse(runner.run(['good.py'])[0].cached)
+        self._write('lint.cfg', 'bad\n')
+        result = runner.run(['good.py'])[0]
+        self.assertFalse(result.cached)
+        self.assertNotEqual(result.retcode, 0)
+
+    def test_not_cached_by_default(self):
+        """ Commands are not cached unless they opt in """
+        self._write(hook.CONF_FILE, json.dumps({
+            'hooks_modified': [['*.py', 'grep -q good']],
+        }))
+        runner = hook.HookRunner(self.repo)
+        runner.run(['good.py'])
+        self.assertFalse(runner.run(['good.py'])[0].cached)
+
+    def test_gitattributes_routing(self):
+        """ Files can opt out of checks with git attributes """
+        self._write('gen.py', 'good')
+        self._write('.gitattributes', 'gen.py linguist-generated\n'
+                    'bad.py devbox-check=-grep\n')
+        results = hook.HookRunner(self.repo).run(['good.py', 'bad.py',
+                                                  'gen.py'])
+        results = dict((result.filename, result) for result in results)
+        self.assertEqual(results['good.py'].skipped, None)
+        self.assertEqual(results['bad.py'].skipped, 'devbox-check')
+        self.assertEqual(results['bad.py'].retcode, 0)
+        self.assertEqual(results['gen.py'].skipped, 'generated')
+
+    def test_max_size(self):
+        """ Files over a hook's max_size are skipped """
+        self._write(hook.CONF_FILE, json.dumps({
+            'hooks_modified': [['*.py', {'command': 'grep -q good',
+                                         'max_size': 20}]],
+        }))
+        self._write('big.py', 'good' * 10)
+        results = hook.HookRunner(self.repo).run(['good.py', 'big.py'])
+        results = dict((result.filename, result) for result in results)
+        self.assertEqual(results['good.py'].skipped, None)
+        self.assertEqual(results['big.py'].skipped, 'max_size')
+
+    @unittest.skipIf(hook.asyncio is None, "asyncio is not available")
+    def test_concurrent_async(self):
+        """ Concurrent calls on one runner share its cache safely """
+        runner = hook.HookRunner(self.repo)
+        loop = hook.asyncio.new_event_loop()
+        try:
+            futures = [runner.run_async([name], loop=loop) for name in
+                       ['good.py', 'bad.py'] * 20]
+            results = loop.run_until_complete(
+                hook.asyncio.gather(*futures))
+        finally:
+            loop.close()
+        for i, (result,) in enumerate(results):
+            self.assertEqual(result.filename, ['good.py', 'bad.py'][i % 2])
+            self.assertEqual(result.retcode == 0, i % 2 == 0)
+        self.assertEqual(len(runner.cache.results), 2)
+        results = hook.HookRunner(self.repo).run(['good.py', 'bad.py'])
+        self.assertTrue(all(result.cached for result in results))
+
+    def test_keeps_cwd(self):
+        """ Running checks never changes the working directory """
+        with patch.object(os, 'chdir', side_effect=AssertionError):
+            runner = hook.HookRunner(self.repo)
+            self.assertEqual(runner.run(['good.py'])[0].retcode, 0)
+
+    @unittest.skipIf(hook.asyncio is None, "asyncio is not available")
+    def test_async(self):
+        """ The asyncio variant resolves to the same results """
+        loop = hook.asyncio.new_event_loop()
+        try:
+            future = hook.check_async(self.repo, ['good.py'], loop=loop)
+            results = loop.run_until_complete(future)
+        finally:
+            loop.close()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].retcode, 0)
+
+
+class SkipReasonTest(unittest.TestCase):
+
+    """ Tests for routing checks with git attributes """
+
+    def test_no_attributes(self):
+        """ Files with no attributes are checked """
+        self.assertEqual(hook.skip_reason('pylint', {}), None)
+
+    def test_vendored(self):
+        """ Vendored files are skipped """
+        attrs = {'linguist-vendored': 'set'}
+        self.assertEqual(hook.skip_reason('pylint', attrs), 'vendored')
+
+    def test_unset(self):
+        """ -devbox-check skips all checks """
+        attrs = {'devbox-check': 'unset'}
+        self.assertEqual(hook.skip_reason('pylint', attrs), 'devbox-check')
+
+    def test_exclude_list(self):
+        """ devbox-check=-name skips only the named checks """
+        attrs = {'devbox-check': '-pylint,-jsl'}
+        self.assertEqual(hook.skip_reason('pylint --rcfile=x', attrs),
+                         'devbox-check')
+        self.assertEqual(hook.skip_reason('pep8', attrs), None)
+
+    def test_allow_list(self):
+        """ devbox-check=name runs only the named checks """
+        attrs = {'devbox-check': 'pep8'}
+        self.assertEqual(hook.skip_reason('pylint', attrs), 'devbox-check')
+        self.assertEqual(hook.skip_reason(['pep8'], attrs), None)
+
+    def test_custom_name(self):
+        """ Dict commands can override the check name """
+        attrs = {'devbox-check': '-lint'}
+        command = {'command': 'pylint', 'name': 'lint'}
+        self.assertEqual(hook.skip_reason(command, attrs), 'devbox-check')
+
+    def test_max_size(self):
+        """ Files larger than max_size are skipped """
+        command = {'command': 'pylint', 'max_size': 100}
+        self.assertEqual(hook.skip_reason(command, {}, 100), None)
+        self.assertEqual(hook.skip_reason(command, {}, 101), 'max_size')
+
+
+class GitIndexTest(unittest.TestCase):
+
+    """ Tests for reading the git index without git """
+
+    def setUp(self):
+        super(GitIndexTest, self).setUp()
+        self.repo = tempfile.mkdtemp()
+        subprocess.check_call(['git', 'init', '-q', self.repo])
+        os.makedirs(os.path.join(self.repo, 'pkg', 'sub'))
+        for filename in ('a.py', 'pkg/b.py', 'pkg/sub/c.py', 'pkg/sub/d.py'):
+            with open(os.path.join(self.repo, filename), 'w') as outfile:
+                outfile.write(filename)
+        self._git('add', '.')
+        self._git('update-index', '--add', '--cacheinfo', '160000',
+                  'a' * 40, 'vendor/lib')
+        self.index = os.path.join(self.repo, '.git', 'index')
+
+    def tearDown(self):
+        super(GitIndexTest, self).tearDown()
+        shutil.rmtree(self.repo)
+
+    def _git(self, *args):
+        """ Run a git command in the test repo """
+        return subprocess.check_output(('git',) + args,
+                                       cwd=self.repo).decode('utf-8')
+
+    def _staged(self):
+        """ Get (mode, sha, path) of the index entries from git """
+        entries = []
+        for line in self._git('ls-files', '-s').splitlines():
+            info, path = line.split('\t')
+            mode, sha, _ = info.split()
+            entries.append((int(mode, 8), sha, path))
+        return entries
+
+    def test_versions(self):
+        """ Index versions 2 to 4 match git ls-files """
+        for version in ('2', '3', '4'):
+            self._git('update-index', '--index-version', version)
+            # The cached tree extension must be skipped
+            self._git('write-tree')
+            index = hook.GitIndex(self.index)
+            entries = [index[path][:2] + (path,) for path in index]
+            self.assertEqual(entries, self._staged())
+
+    def test_extended_flags(self):
+        """ Entries with extended flags are parsed """
+        self._git('update-index', '--skip-worktree', 'pkg/b.py')
+        index = hook.GitIndex(self.index)
+        self.assertEqual(len(index), 5)
+        self.assertTrue('pkg/sub/d.py' in index)
+
+    def test_gitlinks(self):
+        """ Submodules are found from their gitlink entries """
+        index = hook.GitIndex(self.index)
+        self.assertEqual(list(index.gitlinks()), [('vendor/lib', 'a' * 40)])
+
+    def test_unsupported(self):
+        """ Split indexes fall back to git """
+        self._git('update-index', '--split-index')
+        self.assertRaises(hook.UnsupportedIndex, hook.GitIndex, self.index)
+        self.assertEqual(hook.GitIndex.load(self.repo), None)
+
+    def test_stat_matches(self):
+        """ Files are unchanged if their stat data matches the index """
+        filename = os.path.join(self.repo, 'a.py')
+        past = os.stat(filename).st_mtime - 10
+        os.utime(filename, (past, past))
+        self._git('add', 'a.py')
+        index = hook.GitIndex(self.index)
+        self.assertTrue(index.stat_matches('a.py', filename))
+        with open(filename, 'w') as outfile:
+            outfile.write('changed')
+        self.assertFalse(index.stat_matches('a.py', filename))
+        self.assertFalse(index.stat_matches('missing.py', filename))
+
+
+class LintTest(unittest.TestCase):
+
+    """ Tests for the built-in devbox-lint checker """
+
+    def _lint(self, source, filename='a.py', **kwargs):
+        """ Lint some source and return the problem codes """
+        options = hook.lint_options(['devbox-lint'])
+        options.update(kwargs)
+        return [problem[2] for problem in
+                hook.lint_file(filename, source, options)]
+
+    def test_clean(self):
+        """ Clean files have no problems """
+        source = (b'import os\n\n\ndef foo(a, b):\n'
+                  b'    return os.path.join(a, b)\n')
+        self.assertEqual(self._lint(source), [])
+
+    def test_syntax_error(self):
+        """ Syntax errors are reported as E999 """
+        self.assertEqual(self._lint(b'def foo(:\n    pass\n'), ['E999'])
+
+    def test_style(self):
+        """ Physical and logical line checks from pep8 """
+        source = (b'import os, sys  \nx = [1,2];\nif x == None:\n'
+                  b'    os.sys, sys.x = True, x == True\n\t\n')
+        self.assertEqual(self._lint(source),
+                         ['E401', 'W291', 'E231', 'E703', 'E711', 'E712',
+                          'W191', 'W293', 'W391'])
+
+    def test_chained_comparisons(self):
+        """ Each comparison of a chain is checked against its own operands """
+        self.assertEqual(self._lint(b'x = 1 < 2 == None\n'), ['E711'])
+        self.assertEqual(self._lint(b'x = 1 == 2 < None\n'), [])
+        self.assertEqual(self._lint(b'x = None < 1 == 2\n'), [])
+
+    def test_line_length(self):
+        """ E501 uses the max line length option """
+        source = b'x = ' + b'1' * 80 + b'\n'
+        self.assertEqual(self._lint(source), ['E501'])
+        self.assertEqual(self._lint(source, max_line_length=100), [])
+
+    def test_unused(self):
+        """ Unused imports and locals are reported """
+        source = (b'from __future__ import print_function\n'
+                  b'import os\nimport sys\n\n\ndef foo():\n'
+                  b'    a = 1\n    _b = 2\n    c = 3\n    return sys, c\n')
+        self.assertEqual(self._lint(source), ['F401', 'F841'])
+        self.assertEqual(self._lint(source, filename='pkg/__init__.py'),
+                         ['F841'])
+
+    def test_unused_nested_scopes(self):
+        """ Assignments in nested scopes belong to those scopes """
+        source = (b'def foo():\n    a = 1\n\n    class Bar(object):\n'
+                  b'        b = 2\n\n    def baz():\n        return a\n'
+                  b'    return Bar, baz\n')
+        self.assertEqual(self._lint(source), [])
+        source = (b'def foo():\n    def bar():\n        a = 1\n'
+                  b'    a = 2\n    return bar, a\n')
+        self.assertEqual(self._lint(source), ['F841'])
+
+    def test_noqa_and_ignore(self):
+        """ '# noqa' lines and ignored codes are not reported """
+        source = b'import os  # noqa\nimport sys\n'
+        self.assertEqual(self._lint(source), ['F401'])
+        self.assertEqual(self._lint(source, ignore=['F']), [])
+        self.assertEqual(self._lint(source, select=['E']), [])
+
+    def test_options_from_config(self):
+        """ --config reads the pep8 section of a conf file """
+        tempdir = tempfile.mkdtemp()
+        try:
+            config = os.path.join(tempdir, 'pep8.ini')
+            with open(config, 'w') as outfile:
+                outfile.write('[pep8]\nmax-line-length=100\nignore=E501,W\n')
+            options = hook.lint_options(['devbox-lint', '--config=' + config,
+                                         '--select=E'])
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(options, {'max_line_length': 100,
+                                   'ignore': ['E501', 'W'],
+                                   'select': ['E']})
+
+    def test_config_relative_to_cwd(self):
+        """ A relative --config is found in the directory the check runs in """
+        tempdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tempdir, 'pep8.ini'), 'w') as outfile:
+                outfile.write('[pep8]\nmax-line-length=100\n')
+            options = hook.lint_options(['devbox-lint', '--config=pep8.ini'],
+                                        tempdir)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(options['max_line_length'], 100)
+
+    def test_run_command(self):
+        """ run_command runs devbox-lint in-process, without an executable """
+        tempdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tempdir, 'a.py'), 'w') as outfile:
+                outfile.write('import os\n')
+            result = hook.run_command(['devbox-lint'], '', 'a.py',
+                                      cwd=tempdir)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(result.retcode, 1)
+        self.assertEqual(result.output,
+                         "a.py:1:1: F401 'os' imported but unused")
+
+    def test_main(self):
+        """ The devbox-lint command exits nonzero on problems """
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'a.py')
+            with open(filename, 'w') as outfile:
+                outfile.write('import os\n')
+            with patch('sys.stdout'):
+                with self.assertRaises(SystemExit) as context:
+                    hook.lint_main(['--select=F', filename])
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(context.exception.code, 1)
+
+    def test_run_in_hook(self):
+        """ devbox-lint runs in-process on every file, in hook format """
+        tempdir = tempfile.mkdtemp()
+        try:
+            for name, source in (('a.py', 'import os\n'), ('b.py', 'x = 1\n')):
+                with open(os.path.join(tempdir, name), 'w') as outfile:
+                    outfile.write(source)
+            with patch.object(hook, 'run_command') as run_command:
+                results = list(hook.iter_checks(
+                    [], [['*.py', 'devbox-lint']], ['a.py', 'b.py'], '',
+                    cwd=tempdir))
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertFalse(run_command.called)
+        results = dict((result.filename, result) for result in results)
+        self.assertEqual(results['a.py'].retcode, 1)
+        self.assertEqual(results['a.py'].output,
+                         "a.py:1:1: F401 'os' imported but unused")
+        self.assertEqual(results['b.py'].retcode, 0)
+
+
+class ShardTest(unittest.TestCase):
+
+    """ Tests for sharding the test command across processes """
+
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, 'hook.sqlite')
+        os.makedirs(os.path.join(self.tmpdir, 'tests', 'sub'))
+        for name in ('test_a.py', 'test_b.py', 'helper.py',
+                     os.path.join('sub', 'test_c.py')):
+            with open(os.path.join(self.tmpdir, 'tests', name), 'w') as ofile:
+                ofile.write('ok')
+
+    def tearDown(self):
+        super(ShardTest, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_find_modules(self):
+        """ Test modules are found recursively by pattern """
+        self.assertEqual(hook.find_test_modules(cwd=self.tmpdir),
+                         ['tests/sub/test_c.py', 'tests/test_a.py',
+                          'tests/test_b.py'])
+
+    def test_balance(self):
+        """ Shards are balanced by estimated duration """
+        estimates = {'a': 10, 'b': 6, 'c': 5, 'd': 1}
+        shards = hook.balance_shards(estimates, 2)
+        self.assertEqual(sorted(shard for _, shard in shards),
+                         [['a', 'd'], ['b', 'c']])
+        self.assertEqual(sorted(total for total, _ in shards), [11, 11])
+
+    def test_more_shards_than_modules(self):
+        """ Never create empty shards """
+        self.assertEqual(len(hook.balance_shards({'a': 1}, 4)), 1)
+
+    def test_estimate_unknown(self):
+        """ Modules with no history get the average duration """
+        estimates = hook.estimate_durations(['a', 'b', 'c'], {'a': 2, 'b': 4})
+        self.assertEqual(estimates['c'], 3)
+
+    def test_run_sharded(self):
+        """ Shards run in parallel and their results are merged """
+        entry = {
+            'command': ['sh', '-c', 'for f in "$@"; do grep -q ok "$f" || '
+                        'exit 1; done', 'sh'],
+            'shards': 2,
+        }
+        result = hook.run_sharded(entry, os.environ['PATH'], self.tmpdir,
+                                  self.db)
+        self.assertEqual(result.retcode, 0)
+        self.assertTrue('Shard 2/2 (passed)' in result.output)
+        durations = hook.load_test_durations(self.db, ' '.join(
+            entry['command']))
+        self.assertEqual(len(durations), 3)
+
+        with open(os.path.join(self.tmpdir, 'tests', 'test_b.py'),
+                  'w') as outfile:
+            outfile.write('fail')
+        result = hook.run_sharded(entry, os.environ['PATH'], self.tmpdir,
+                                  self.db)
+        self.assertNotEqual(result.retcode, 0)
+        self.assertTrue('(failed)' in result.output)
+
+
+class MatrixTest(unittest.TestCase):
+
+    """ Tests for running hooks_all in several virtualenvs """
+
+    def setUp(self):
+        super(MatrixTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(self.src)
+        # Fake virtualenvs whose 'python' reports which env it is
+        for name in ('env_a', 'env_b'):
+            bindir = os.path.join(self.tmpdir, name, 'bin')
+            os.makedirs(bindir)
+            script = os.path.join(bindir, 'whoami')
+            with open(script, 'w') as outfile:
+                outfile.write('#!/bin/sh\necho %s > $(mktemp -p .)\n'
+                              'ls | wc -l\n' % name)
+            os.chmod(script, 0o755)
+
+    def tearDown(self):
+        super(MatrixTest, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_matrix(self):
+        """ The command runs once per virtualenv, each in its own copy """
+        entry = {'command': 'whoami', 'envs': ['env_a', 'env_b']}
+        results = hook.run_hook_all(entry, None, self.src, root=self.tmpdir)
+        self.assertEqual([result.env for result in results],
+                         ['env_a', 'env_b'])
+        for result in results:
+            self.assertEqual(result.retcode, 0)
+            self.assertEqual(result.output.strip(), '1')
+
+    def test_missing_env(self):
+        """ A missing virtualenv is reported as a failure """
+        entry = {'command': 'whoami', 'envs': ['env_a', 'env_missing']}
+        results = hook.run_hook_all(entry, None, self.src, root=self.tmpdir)
+        self.assertEqual(results[0].retcode, 0)
+        self.assertNotEqual(results[1].retcode, 0)
+        self.assertTrue('env_missing' in results[1].output)
+
+
+class DeferredTest(unittest.TestCase):
+
+    """ Tests for deferred hooks_all commands """
+
+    def setUp(self):
+        super(DeferredTest, self).setUp()
+        self.startdir = os.getcwd()
+        self.repo = tempfile.mkdtemp()
+        os.chdir(self.repo)
+        subprocess.check_call(['git', 'init', '-q'])
+        subprocess.check_call(['git', 'config', 'user.name', 'Test'])
+        subprocess.check_call(['git', 'config', 'user.email', 'test@test'])
+        with open(hook.CONF_FILE, 'w') as outfile:
+            json.dump({'hooks_all': [
+                'true',
+                {'command': 'test -f ok', 'deferred': True},
+            ]}, outfile)
+        subprocess.check_call(['git', 'add', hook.CONF_FILE])
+        self.db = os.path.join('.git', hook.HISTORY_FILE)
+
+    def tearDown(self):
+        super(DeferredTest, self).tearDown()
+        os.chdir(self.startdir)
+        shutil.rmtree(self.repo)
+
+    def _commit(self):
+        """ Commit the index and return (commit, tree) """
+        subprocess.check_call(['git', 'commit', '-qm', 'commit'])
+        commit = hook.check_output(['git', 'rev-parse', 'HEAD']).strip()
+        tree = hook.check_output(['git', 'rev-parse',
+                                  'HEAD^{tree}']).strip()
+        return commit, tree
+
+    def test_is_deferred(self):
+        """ Only dict commands with 'deferred' set are deferred """
+        self.assertFalse(hook.is_deferred('python setup.py test'))
+        self.assertFalse(hook.is_deferred({'command': 'make'}))
+        self.assertTrue(hook.is_deferred({'command': 'make',
+                                          'deferred': True}))
+        self.assertEqual(hook.split_command({'command': 'make test'}),
+                         ['make', 'test'])
+
+    def test_run_deferred(self):
+        """ Deferred commands run on the tree and record their status """
+        _, tree = self._commit()
+        self.assertNotEqual(hook.run_deferred(tree), 0)
+        results = hook.get_deferred(self.db)
+        self.assertEqual(list(results), [tree])
+        self.assertEqual(results[tree][0]['command'], 'test -f ok')
+        self.assertEqual(results[tree][0]['status'], 'failed')
+
+    def test_deferred_reads_tree(self):
+        """ Deferred commands check the committed tree, not the worktree """
+        with open('ok', 'w') as outfile:
+            outfile.write('ok')
+        subprocess.check_call(['git', 'add', 'ok'])
+        _, tree = self._commit()
+        os.unlink('ok')
+        self.assertEqual(hook.run_deferred(tree), 0)
+
+    def test_failure_blocks_push(self):
+        """ A failed deferred check blocks pushing that commit """
+        commit, tree = self._commit()
+        hook.run_deferred(tree)
+        line = 'refs/heads/master %s refs/heads/master %s' % (commit,
+                                                              hook.ZERO_SHA)
+        self.assertEqual(hook.prepush([line], False), 1)
+
+    def test_fix_unblocks_push(self):
+        """ A newer passing commit allows the push """
+        _, tree = self._commit()
+        hook.run_deferred(tree)
+        with open('ok', 'w') as outfile:
+            outfile.write('ok')
+        subprocess.check_call(['git', 'add', 'ok'])
+        commit, tree = self._commit()
+        hook.run_deferred(tree)
+        line = 'refs/heads/master %s refs/heads/master %s' % (commit,
+                                                              hook.ZERO_SHA)
+        self.assertEqual(hook.prepush([line], False), 0)
+
+    def test_pending_does_not_block(self):
+        """ Checks that are still running don't block the push """
+        commit, tree = self._commit()
+        hook.set_deferred(self.db, tree, 'test -f ok', 'pending')
+        line = 'refs/heads/master %s refs/heads/master %s' % (commit,
+                                                              hook.ZERO_SHA)
+        self.assertEqual(hook.prepush([line], False), 0)
+
+
+class PreReceiveTest(unittest.TestCase):
+
+    """ Tests for the server-side pre-receive mode """
+
+    def setUp(self):
+        super(PreReceiveTest, self).setUp()
+        self.startdir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        self.work = os.path.join(self.tmpdir, 'work')
+        self.bare = os.path.join(self.tmpdir, 'bare.git')
+        self.log = os.path.join(self.tmpdir, 'log')
+        subprocess.check_call(['git', 'init', '-q', self.work])
+        subprocess.check_call(['git', 'init', '-q', '--bare', self.bare])
+        self._git('config', 'user.name', 'Test')
+        self._git('config', 'user.email', 'test@test')
+        command = 'sh -c "echo run >> %s; grep -q good \\"$0\\""' % self.log
+        self._write(hook.CONF_FILE, json.dumps({
+            'hooks_modified': [['*.py', command]],
+        }))
+
+    def tearDown(self):
+        super(PreReceiveTest, self).tearDown()
+        os.chdir(self.startdir)
+        shutil.rmtree(self.tmpdir)
+
+    def _git(self, *args):
+        """ Run a git command in the working repo """
+        return hook.check_output(['git', '-C', self.work] + list(args))
+
+    def _write(self, filename, contents):
+        """ Write and stage a file in the working repo """
+        with open(os.path.join(self.work, filename), 'w') as outfile:
+            outfile.write(contents)
+        self._git('add', filename)
+
+    def _push(self, *refs):
+        """ Push commits to the bare repo and run pre-receive on them """
+        lines = []
+        sha = self._git('rev-parse', 'HEAD').strip()
+        # Send the objects without updating any branch, like a real push
+        # before the pre-receive hook accepts it
+        self._git('push', '-q', self.bare, 'HEAD:refs/incoming/' + sha)
+        for ref in refs:
+            lines.append('%s %s %s' % (hook.ZERO_SHA, sha, ref))
+        os.chdir(self.bare)
+        try:
+            return hook.prereceive(lines, False, 2)
+        finally:
+            os.chdir(self.startdir)
+
+    def _runs(self):
+        """ Number of times the check command has run """
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log, 'r') as infile:
+            return len(infile.readlines())
+
+    def test_pass(self):
+        """ Pushes pass when the checks pass """
+        self._write('a.py', 'good')
+        self._git('commit', '-qm', 'good')
+        self.assertEqual(self._push('refs/heads/master'), 0)
+        self.assertEqual(self._runs(), 1)
+
+    def test_fail(self):
+        """ Pushes fail when a check fails """
+        self._write('a.py', 'bad')
+        self._git('commit', '-qm', 'bad')
+        self.assertNotEqual(self._push('refs/heads/master'), 0)
+
+    def test_builtin_lint(self):
+        """ The built-in checker from the default conf runs on pushes """
+        self._write(hook.CONF_FILE, json.dumps({
+            'hooks_modified': [['*.py', ['devbox-lint',
+                                         '--config=.pep8.ini']]],
+        }))
+        self._write('.pep8.ini', '[pep8]\nmax-line-length=20\n')
+        self._write('a.py', 'x = 1\n')
+        self._git('commit', '-qm', 'good')
+        self.assertEqual(self._push('refs/heads/master'), 0)
+        self._write('a.py', 'x = "a long line of code"\n')
+        self._git('commit', '-qm', 'long')
+        with patch('sys.stdout') as stdout:
+            self.assertNotEqual(self._push('refs/heads/master'), 0)
+        output = ''.join(call[0][0] for call in stdout.write.call_args_list)
+        self.assertIn('a.py:1:21: E501', output)
+
+    def test_dedupe_refs(self):
+        """ Identical content pushed to several refs is checked once """
+        command = 'sh -c "echo run >> %s; grep -q good \\"$0\\""' % self.log
+        self._write(hook.CONF_FILE, json.dumps({
+            'hooks_modified': [['*.py', {'command': command, 'cache': True}]],
+        }))
+        self._write('a.py', 'good')
+        self._write('b.py', 'good')
+        self._git('commit', '-qm', 'good')
+        self.assertEqual(self._push('refs/heads/one', 'refs/heads/two'), 0)
+        self.assertEqual(self._runs(), 1)
+        self.assertEqual(self._push('refs/heads/three'), 0)
+        self.assertEqual(self._runs(), 1)
+
+    def test_dedupe_trees(self):
+        """ Commands that are not cached by file are reused by tree """
+        self._write('a.py', 'good')
+        self._write('b.py', 'good')
+        self._git('commit', '-qm', 'good')
+        self.assertEqual(self._push('refs/heads/one', 'refs/heads/two'), 0)
+        self.assertEqual(self._runs(), 2)
+        self.assertEqual(self._push('refs/heads/three'), 0)
+        self.assertEqual(self._runs(), 2)
+
+    def test_changed_files_only(self):
+        """ Updates to existing refs only check the changed files """
+        self._write('a.py', 'good')
+        self._git('commit', '-qm', 'one')
+        old = self._git('rev-parse', 'HEAD').strip()
+        self._write('b.py', 'good again')
+        self._git('commit', '-qm', 'two')
+        new = self._git('rev-parse', 'HEAD').strip()
+        self._git('push', '-q', self.bare, 'HEAD:refs/heads/master')
+        os.chdir(self.bare)
+        try:
+            self.assertEqual(hook.changed_files(old, new), ['b.py'])
+        finally:
+            os.chdir(self.startdir)
+
 
 class TestHookMain(FakeFSTest):
 
@@ -87,3 +915,17 @@ class TestHookMain(FakeFSTest):
         """ Passing in 'all' calls precommit() """
         hook.main(['all'])
         self.assertTrue(precommit.called)
+
+    @patch.object(hook, 'git_dir', return_value='.git')
+    @patch.object(hook, 'load_stats')
+    def test_stats_days(self, load_stats, _):
+        """ 'stats --days' passes the number of days to load_stats """
+        with patch.object(hook, 'format_stats', return_value=''):
+            hook.main(['stats', '--days', '7'])
+        load_stats.assert_called_with(os.path.join('.git', hook.HISTORY_FILE),
+                                      7)
+
+    def test_stats_days_missing(self):
+        """ 'stats --days' with no value prints usage and exits """
+        with self.assertRaises(SystemExit):
+            hook.main(['stats', '--days'])